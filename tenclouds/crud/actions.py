@@ -1,9 +1,20 @@
 import functools
 import json
 
-from django.http import HttpResponse
+from django.http import HttpRequest, HttpResponse, QueryDict
+
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
 
 from tenclouds.crud.http import HttpDone, HttpJson
+from tenclouds.crud.selections import pk_query
+from tenclouds.crud.status import Progress, is_status_key
+from tenclouds.crud.streaming import (iter_chunks, stream_csv, stream_ndjson,
+                                      streaming_response)
+from tenclouds.crud.tasks import submit
 
 
 class ActionResponse(object):
@@ -32,6 +43,21 @@ class ActionFileResponse(ActionResponse):
         return response
 
 
+class ActionStreamResponse(ActionResponse):
+    """Attachment whose ``content`` is an iterator, sent to the client as it
+    is produced.
+    """
+    def __init__(self, filename, content, content_type):
+        self.filename = filename
+        self.content = content
+        self.content_type = content_type
+
+    def to_response(self):
+        response = streaming_response(self.content, self.content_type)
+        response["Content-Disposition"] = "attachment; filename=%s" % (self.filename,)
+        return response
+
+
 class ProcessingOffline(ActionResponse):
     def __init__(self, *status_keys):
         self.status_keys = status_keys
@@ -65,19 +91,135 @@ class InvalidFormData(ActionResponse):
 
 
 class ActionHandler(object):
-    def __init__(self, public, name, codename, input_form):
+    def __init__(self, public, name, codename, input_form, chunked=None,
+                 offline=False, func=None):
         self.public = public
         self.name = name
         self.codename = codename
         self.input_form = input_form
+        self.chunked = chunked
+        self.offline = offline
+        self.func = func
+
+
+def iter_pk_ranges(objects, batch_size):
+    """Yield querysets of consecutive batches of up to ``batch_size``
+    ``objects``, in primary key order.
+
+    Batches are selected by primary key ranges, not lists of keys. The
+    upper bound of each is found by one query seeking past the previous
+    batch, so objects changed or deleted by processing a batch don't shift
+    the following ones.
+    """
+    objects = objects.order_by()
+    keys = objects.order_by('pk').values_list('pk', flat=True)
+    last = None
+    while True:
+        rest = keys if last is None else keys.filter(pk__gt=last)
+        bound = list(rest[batch_size - 1:batch_size])
+        if not bound:
+            if rest.exists():
+                yield objects if last is None else objects.filter(pk__gt=last)
+            return
+        batch = objects.filter(pk__lte=bound[0])
+        if last is not None:
+            batch = batch.filter(pk__gt=last)
+        yield batch
+        last = bound[0]
+
+
+def run_batches(call, objects, batch_size, progress):
+    """Call ``call(batch)`` with consecutive batches of ``objects``, each
+    in its own transaction, reporting the progress.
+    """
+    progress.set_total(objects.count())
+    done = 0
+    for batch in iter_pk_ranges(objects, batch_size):
+        with atomic(using=objects.db):
+            call(batch)
+        done = min(done + batch_size, progress.status['total'])
+        progress.update(done)
+
+
+def offline_request(post, user_pk=None):
+    """Return a request standing in for the one an offline action was
+    called with, with its ``post`` data (a list of ``(key, values)``) and
+    user.
+    """
+    request = HttpRequest()
+    request.method = 'POST'
+    request.POST = QueryDict('').copy()
+    for key, values in post:
+        request.POST.setlist(key, values)
+    if user_pk is not None:
+        try:
+            from django.contrib.auth import get_user_model
+        except ImportError:
+            # Django < 1.5
+            from django.contrib.auth.models import User
+        else:
+            User = get_user_model()
+        request.user = User._default_manager.get(pk=user_pk)
+    return request
+
+
+def run_offline_action(progress, spec):
+    """Run the action described by ``spec`` (see
+    ``action_handler.run_offline``) in a task.
+    """
+    resource_class = spec['resource_class']
+    handler = getattr(resource_class, spec['attr']).action_handler
+    resource = resource_class(api_name=spec['api_name'])
+    request = offline_request(spec['post'], spec['user'])
+    objects = spec['model']._default_manager.all()
+    objects.query = spec['query']
+    args = spec['args']
+    kwargs = spec['kwargs']
+
+    extra = []
+    if handler.input_form:
+        form = handler.input_form(request.POST.get('data', {}))
+        form.is_valid()
+        extra.append(form)
+
+    if handler.chunked:
+        run_batches(lambda batch: handler.func(
+            resource, request, *(args + [batch] + extra), **kwargs),
+            objects, handler.chunked, progress)
+        return None
+    return handler.func(resource, request, *(args + [objects] + extra),
+                        **kwargs)
 
 
 class action_handler(object):
-    def __init__(self, public=True, name=None, codename=None, input_form=None):
+    """Decorator of resource methods which are actions.
+
+    The action is called with the selected objects, and the input form if
+    ``input_form`` is given. The selection is a token of a selection
+    stored on the server (see ``tenclouds.crud.selections``), "all" with
+    the filters, or the list of ids.
+
+    With ``chunked`` set to a number, the action is called with consecutive
+    batches of that many objects, each in its own transaction. A batch
+    raising an exception is rolled back and stops the action, the batches
+    before it stay committed.
+
+    With ``offline`` set, the action runs in a worker process (see
+    ``tenclouds.crud.tasks``), with a request holding only the posted data
+    and the user.
+
+    Chunked and offline actions report their progress under a status key
+    returned in ``ProcessingOffline`` (see ``tenclouds.crud.status``). The
+    client may choose the key, sending it as ``statuskey`` in the query.
+    """
+    def __init__(self, public=True, name=None, codename=None, input_form=None,
+                 chunked=None, offline=False):
         self.public = public
         self.name = name
         self.codename = codename
         self.input_form = input_form
+        self.chunked = chunked
+        self.offline = offline
 
     def __call__(self, func):
         codename = self.codename or func.__name__
@@ -90,27 +232,135 @@ class action_handler(object):
 
             # TODO: This should solely rely on filters (eg. move id__in to
             # tastypie filters).
-            if request.POST['all']:
+            selection = request.POST.get('selection')
+            if selection:
+                objects = resource.get_selection_objects(request, selection)
+            elif request.POST['all']:
                 filters = resource.build_filters(request.POST['filter'])
-                args.append(resource.apply_filters(request, filters))
+                objects = resource.apply_filters(request, filters)
             else:
-                args.append(resource.get_object_list(request).filter(
-                    pk__in=request.POST['id__in']))
+                objects = resource.get_object_list(request)
+                objects = objects.filter(
+                    pk_query(request.POST['id__in'], objects.model))
 
+            extra = []
             if self.input_form:
                 data = request.POST.get('data', {})
                 form = self.input_form(data)
                 if not form.is_valid():
                     res = InvalidFormData(form)
-                args.append(form)
+                extra.append(form)
 
             if res is None:
-                res = func(resource, request, *args, **kwargs)
+                if self.offline:
+                    res = self.run_offline(name, codename, resource, request,
+                                           args, objects, kwargs)
+                elif self.chunked:
+                    res = self.run_chunked(func, name, resource, request,
+                                           args, objects, extra, kwargs)
+                else:
+                    res = func(resource, request,
+                               *(args + [objects] + extra), **kwargs)
 
             if isinstance(res, ActionResponse):
                 return res.to_response()
             return res
 
-        wrapper.action_handler = ActionHandler(self.public, name, codename,
-                                               self.input_form)
+        wrapper.action_handler = ActionHandler(
+            self.public, name, codename, self.input_form, self.chunked,
+            self.offline, func)
         return wrapper
+
+    def status_key(self, request):
+        key = request.POST.get('statuskey')
+        return key if is_status_key(key) else None
+
+    def run_chunked(self, func, name, resource, request, args, objects, extra,
+                    kwargs):
+        progress = Progress(self.status_key(request), description=name)
+        try:
+            run_batches(lambda batch: func(
+                resource, request, *(args + [batch] + extra), **kwargs),
+                objects, self.chunked, progress)
+        except Exception, e:
+            progress.fail(unicode(e))
+            raise
+        progress.finish()
+        return ProcessingOffline(progress.key)
+
+    def run_offline(self, name, codename, resource, request, args, objects,
+                    kwargs):
+        """Submit the action to the task pool. The objects are sent as their
+        SQL query, so they are read by the worker.
+        """
+        user = getattr(request, 'user', None)
+        spec = {
+            'resource_class': type(resource),
+            'api_name': resource._meta.api_name,
+            'attr': resource.actions.codename_to_callback(codename),
+            'post': list(request.POST.lists()),
+            'user': getattr(user, 'pk', None),
+            'model': objects.model,
+            'query': objects.query,
+            'args': args,
+            'kwargs': kwargs,
+        }
+        key = submit(run_offline_action, spec, key=self.status_key(request),
+                     description=name)
+        return ProcessingOffline(key)
+
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def export_action(format='csv', public=True, name=None, codename=None,
+                  chunk_size=1000):
+    """Return an action exporting the selected objects as CSV or NDJSON.
+
+    Add it to a resource under its codename (``export_<format>`` by
+    default)::
+
+        export_csv = actions.export_action('csv')
+
+    The selection ("all" with the filters, or the ids) and the sorting
+    come from the action query. Objects are read in chunks of
+    ``chunk_size``, dehydrated by the resource and streamed, so the export
+    takes constant memory however many objects there are. The columns are
+    the fields listed in the schema.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format: %s' % format)
+    codename = codename or 'export_%s' % format
+    name = name or 'Export to %s' % format.upper()
+
+    @action_handler(public=public, name=name, codename=codename)
+    def export(resource, request, objects):
+        sort = request.POST.get('sort')
+        if sort:
+            objects = resource.apply_sorting(objects, {'order_by': sort})
+        objects = resource.apply_related(objects)
+
+        columns = [column for column in
+                   resource._meta.fields or resource.fields.keys()
+                   if column in resource.fields and
+                   getattr(resource.fields[column], 'visible', True)]
+        serializer = resource._meta.serializer
+
+        def dehydrate(chunk):
+            return [serializer.to_simple(obj, {})
+                    for obj in resource.dehydrate_objects(chunk, request)]
+
+        chunks = iter_chunks(objects, chunk_size)
+        if format == 'csv':
+            header = [resource.fields[column].title or column.capitalize()
+                      for column in columns]
+            content = stream_csv(chunks, columns, header, dehydrate)
+        else:
+            content = stream_ndjson(chunks, columns, dehydrate)
+        filename = '%s.%s' % (resource._meta.resource_name, format)
+        return ActionStreamResponse(filename, content, EXPORT_FORMATS[format])
+
+    return export
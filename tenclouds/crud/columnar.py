@@ -0,0 +1,453 @@
+"""Datasets stored as memory-mapped columns.
+
+Large, rarely changing datasets (eg. precomputed reports) served from lists
+of dicts cost a copy in every worker process. ``ColumnarDataset.write``
+stores records in a directory, one NumPy array file per field, and
+``ColumnarDataset(path)`` opens them memory-mapped, so worker processes
+share the pages of the OS cache and read only what a request touches.
+
+Fields may hold numbers, booleans or strings, and ``None``. Strings are
+stored as codes of a sorted dictionary of the field's values, so they're
+compared and ordered as codes. Store dates as ISO strings.
+
+``ColumnarDataset.all()`` returns a ``ColumnarQuerySet``, which supports
+the same subset of the QuerySet API as ``tenclouds.crud.dataset``, with
+filters and sorting computed on whole columns by NumPy. Only the records
+of the requested slice are turned into dicts.
+
+Requires NumPy.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.db.models import Q
+
+from tenclouds.crud.dataset import SPARSE
+from tenclouds.crud.queryset import QuerySetAdapter
+
+
+META_FILE = 'meta.json'
+# Number of records turned into dicts at once while iterating.
+CHUNK_SIZE = 1000
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def _column_type(values):
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, bool) for v in present):
+        return 'bool' if present else 'str'
+    if all(isinstance(v, (int, long)) and not isinstance(v, bool)
+           for v in present):
+        return 'int'
+    if all(isinstance(v, (int, long, float)) and not isinstance(v, bool)
+           for v in present):
+        return 'float'
+    if all(isinstance(v, basestring) for v in present):
+        return 'str'
+    raise TypeError("Values must be numbers, booleans or strings.")
+
+
+class Column(object):
+    """Values of a field: the ``data`` array, the ``nulls`` mask (``None``
+    if there are no nulls) and, for strings, the sorted ``strings`` array
+    the data holds codes of (``-1`` being null).
+    """
+    DTYPES = {'bool': 'bool', 'int': 'int64', 'float': 'float64'}
+
+    def __init__(self, data, nulls=None, strings=None):
+        self.data = data
+        self.nulls = nulls
+        self.strings = strings
+        # Lower case strings, for ``icontains``.
+        self.lowered = None
+
+    @classmethod
+    def build(cls, values):
+        kind = _column_type(values)
+        if kind == 'str':
+            values = [None if v is None else _text(v) for v in values]
+            strings = sorted(set(v for v in values if v is not None))
+            codes = dict((s, i) for i, s in enumerate(strings))
+            data = numpy.array([-1 if v is None else codes[v]
+                                for v in values], dtype='int32')
+            return cls(data, strings=numpy.array(strings, dtype=unicode))
+
+        nulls = numpy.array([v is None for v in values], dtype=bool)
+        data = numpy.array([0 if v is None else v for v in values],
+                           dtype=cls.DTYPES[kind])
+        return cls(data, nulls if nulls.any() else None)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        def load(suffix):
+            name = prefix + suffix
+            if os.path.exists(name):
+                return numpy.load(name, mmap_mode=mmap_mode)
+
+        return cls(load('.npy'), load('.nulls.npy'), load('.strings.npy'))
+
+    def save(self, prefix):
+        numpy.save(prefix + '.npy', self.data)
+        if self.nulls is not None:
+            numpy.save(prefix + '.nulls.npy', self.nulls)
+        if self.strings is not None:
+            numpy.save(prefix + '.strings.npy', self.strings)
+
+    def null_mask(self):
+        if self.strings is not None:
+            return self.data < 0
+        if self.nulls is not None:
+            return numpy.array(self.nulls)
+        return numpy.zeros(len(self.data), dtype=bool)
+
+    def codes_in(self, selected):
+        """Return mask of records holding the ``selected`` strings, given
+        as codes or a mask of the dictionary.
+        """
+        # The extra last item is read for null codes.
+        table = numpy.zeros(len(self.strings) + 1, dtype=bool)
+        table[:-1][selected] = True
+        return table[self.data]
+
+    def code(self, value):
+        """Return code of string ``value`` or ``None`` if it's not found."""
+        i = numpy.searchsorted(self.strings, value)
+        if i < len(self.strings) and self.strings[i] == value:
+            return int(i)
+
+    def scalar(self, value):
+        if self.strings is not None:
+            return _text(value)
+        return self.data.dtype.type(value)
+
+    def lookup(self, kind, value):
+        """Return mask of records matching the ``kind`` lookup."""
+        if kind == 'isnull' or (kind == 'exact' and value is None):
+            nulls = self.null_mask()
+            return nulls if kind == 'exact' or value else ~nulls
+        if self.strings is not None:
+            return self.lookup_string(kind, value)
+
+        data = self.data
+        if kind == 'exact':
+            mask = data == self.scalar(value)
+        elif kind == 'in':
+            mask = numpy.in1d(data, [self.scalar(v) for v in value])
+        elif kind == 'gt':
+            mask = data > self.scalar(value)
+        elif kind == 'gte':
+            mask = data >= self.scalar(value)
+        elif kind == 'lt':
+            mask = data < self.scalar(value)
+        elif kind == 'lte':
+            mask = data <= self.scalar(value)
+        elif kind == 'range':
+            low, high = value
+            mask = (data >= self.scalar(low)) & (data <= self.scalar(high))
+        else:
+            raise FieldError("Unsupported lookup %r of a numeric column."
+                             % kind)
+        if self.nulls is not None:
+            mask &= ~self.nulls
+        return mask
+
+    def lookup_string(self, kind, value):
+        strings = self.strings
+        data = self.data
+        if kind == 'exact':
+            code = self.code(self.scalar(value))
+            return self.codes_in([] if code is None else [code])
+        if kind == 'in':
+            codes = [self.code(self.scalar(v)) for v in value]
+            return self.codes_in([c for c in codes if c is not None])
+        if kind == 'contains':
+            return self.codes_in(
+                numpy.char.find(strings, self.scalar(value)) >= 0)
+        if kind == 'icontains':
+            if self.lowered is None:
+                self.lowered = numpy.char.lower(strings)
+            return self.codes_in(numpy.char.find(
+                self.lowered, self.scalar(value).lower()) >= 0)
+        if kind not in ('gt', 'gte', 'lt', 'lte', 'range'):
+            raise FieldError("Unsupported lookup %r of a string column."
+                             % kind)
+
+        # Codes are ordered as the strings, so comparisons are translated
+        # into ranges of codes.
+        if kind == 'range':
+            low, high = value
+        else:
+            low = high = value
+        first = 0
+        last = len(strings)
+        if kind in ('gt', 'gte', 'range'):
+            first = numpy.searchsorted(strings, self.scalar(low),
+                                       'right' if kind == 'gt' else 'left')
+        if kind in ('lt', 'lte', 'range'):
+            last = numpy.searchsorted(strings, self.scalar(high),
+                                      'left' if kind == 'lt' else 'right')
+        return (data >= first) & (data < last)
+
+    def sort_keys(self, positions, descending=False):
+        """Return ``numpy.lexsort`` keys of records at ``positions``, the
+        most significant last. Nulls go first, or last if ``descending``.
+        """
+        data = self.data[positions]
+        if self.strings is not None:
+            # Null code is the lowest.
+            return [-data if descending else data]
+        if data.dtype == bool:
+            data = data.astype('int8')
+        keys = [-data if descending else data]
+        if self.nulls is not None:
+            nulls = self.nulls[positions]
+            keys.append(nulls if descending else ~nulls)
+        return keys
+
+    def values(self, positions):
+        """Return list of Python values of records at ``positions``."""
+        if self.strings is not None:
+            codes = self.data[positions]
+            if not len(self.strings):
+                return [None] * len(codes)
+            values = self.strings[codes].tolist()
+            nulls = numpy.flatnonzero(codes < 0)
+        else:
+            values = self.data[positions].tolist()
+            if self.nulls is None:
+                return values
+            nulls = numpy.flatnonzero(self.nulls[positions])
+        for i in nulls:
+            values[i] = None
+        return values
+
+
+class ColumnarDataset(object):
+    """Records stored by ``write`` in the ``path`` directory."""
+
+    def __init__(self, path, mmap_mode='r'):
+        if numpy is None:
+            raise ImproperlyConfigured("ColumnarDataset requires NumPy.")
+        self.path = path
+        # The version ``path`` links to when it's opened.
+        directory = os.path.realpath(path)
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        self.pk = meta['pk']
+        self.length = meta['length']
+        self.fields = [str(field['name']) for field in meta['fields']]
+        self.columns = dict(
+            (str(field['name']),
+             Column.load(os.path.join(directory, field['file']), mmap_mode))
+            for field in meta['fields'])
+        self._orderings = {}
+
+    @classmethod
+    def write(cls, path, records, pk='id', fields=None):
+        """Store ``records`` (dicts or objects) at ``path`` and return the
+        dataset opened from it.
+
+        The files are written to a new directory next to ``path``, which is
+        then atomically switched to it (``path`` is a symbolic link). So a
+        dataset is never read half written, and processes which have the
+        previous version open keep reading it: its files are removed, but
+        freed by the system only once they're closed.
+
+        :param fields: names of the fields to store, by default the keys of
+                       the first record
+        """
+        if numpy is None:
+            raise ImproperlyConfigured("ColumnarDataset requires NumPy.")
+        records = list(records)
+        if fields is None:
+            fields = sorted(records[0]) if records else [pk]
+        path = os.path.abspath(path)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        version = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                                   dir=parent)
+        try:
+            os.chmod(version, 0755)
+            meta = {'pk': pk, 'length': len(records), 'fields': []}
+            for i, name in enumerate(fields):
+                if records and isinstance(records[0], dict):
+                    values = [record.get(name) for record in records]
+                else:
+                    values = [getattr(record, name) for record in records]
+                Column.build(values).save(os.path.join(version, 'c%d' % i))
+                meta['fields'].append({'name': name, 'file': 'c%d' % i})
+            with open(os.path.join(version, META_FILE), 'w') as f:
+                json.dump(meta, f)
+
+            link = version + '.link'
+            os.symlink(os.path.basename(version), link)
+        except:
+            shutil.rmtree(version)
+            raise
+
+        previous = None
+        if os.path.islink(path):
+            previous = os.path.realpath(path)
+        elif os.path.isdir(path):
+            # A directory of files can't be replaced atomically.
+            shutil.rmtree(path)
+        os.rename(link, path)
+        if previous is not None:
+            shutil.rmtree(previous, ignore_errors=True)
+        return cls(path)
+
+    def __len__(self):
+        return self.length
+
+    def all(self):
+        return ColumnarQuerySet(self)
+
+    def field_name(self, name):
+        return self.pk if name == 'pk' else name
+
+    def column(self, field):
+        field = self.field_name(field)
+        try:
+            return self.columns[field]
+        except KeyError:
+            raise FieldError("Cannot resolve keyword %r into field." % field)
+
+    def lookup(self, lookup, value):
+        """Return mask of records matching ``lookup``."""
+        field, _, kind = lookup.partition('__')
+        return self.column(field).lookup(kind or 'exact', value)
+
+    def match(self, q):
+        """Return mask of records matching ``q``, or ``None`` if all of
+        them match.
+        """
+        matched = None
+        for child in q.children:
+            if isinstance(child, Q):
+                found = self.match(child)
+            else:
+                found = self.lookup(*child)
+
+            if q.connector == Q.OR:
+                if found is None:
+                    matched = None
+                    break
+                matched = found if matched is None else matched | found
+            elif found is not None:
+                matched = found if matched is None else matched & found
+
+        if q.negated:
+            if matched is None:
+                return numpy.zeros(self.length, dtype=bool)
+            return ~matched
+        return matched
+
+    def sort(self, positions, order_by):
+        """Return ``positions`` ordered by ``order_by`` field names."""
+        keys = []
+        for name in reversed(order_by):
+            column = self.column(name.lstrip('-'))
+            keys.extend(column.sort_keys(positions, name.startswith('-')))
+        return positions[numpy.lexsort(keys)]
+
+    def ordering(self, order_by):
+        """Return array of positions of all records ordered by
+        ``order_by``, kept for the next requests.
+        """
+        order_by = tuple(order_by)
+        positions = self._orderings.get(order_by)
+        if positions is None:
+            positions = self.sort(numpy.arange(self.length), order_by)
+            self._orderings[order_by] = positions
+        return positions
+
+    def rows(self, positions):
+        """Return list of dicts of records at ``positions``."""
+        columns = [self.columns[name].values(positions)
+                   for name in self.fields]
+        return [dict(zip(self.fields, values)) for values in zip(*columns)]
+
+
+class ColumnarQuerySet(QuerySetAdapter):
+    """Records of a ``ColumnarDataset`` matching the filters, in the given
+    order.
+    """
+
+    def __init__(self, dataset, matched=None, ordering=(), **extra):
+        self.dataset = dataset
+        # Mask of the matching records, ``None`` if all match.
+        self.matched = matched
+        self.ordering = tuple(ordering)
+        super(ColumnarQuerySet, self).__init__(self, self.count_matched,
+                                               **extra)
+
+    def count_matched(self):
+        if self.matched is None:
+            return len(self.dataset)
+        return int(numpy.count_nonzero(self.matched))
+
+    def _clone(self, matched=None, ordering=None):
+        if ordering is None:
+            ordering = self.ordering
+        return ColumnarQuerySet(self.dataset, matched, ordering,
+                                **self._extra)
+
+    def all(self):
+        return self._clone(self.matched)
+
+    def filter(self, *args, **kwargs):
+        found = self.dataset.match(Q(*args, **kwargs))
+        if found is None:
+            return self.all()
+        if self.matched is not None:
+            found = found & self.matched
+        return self._clone(found)
+
+    def exclude(self, *args, **kwargs):
+        return self.filter(~Q(*args, **kwargs))
+
+    def order_by(self, *field_names):
+        return self._clone(self.matched, field_names)
+
+    def positions(self):
+        """Return array of positions of matching records, in order."""
+        dataset = self.dataset
+        matched = self.matched
+        if not self.ordering:
+            if matched is None:
+                return numpy.arange(len(dataset))
+            return numpy.flatnonzero(matched)
+
+        order_by = [name[:name.startswith('-')] +
+                    dataset.field_name(name.lstrip('-'))
+                    for name in self.ordering]
+        if matched is None:
+            return dataset.ordering(order_by)
+        if self.count() * SPARSE < len(dataset):
+            return dataset.sort(numpy.flatnonzero(matched), order_by)
+        ordering = dataset.ordering(order_by)
+        return ordering[matched[ordering]]
+
+    def __iter__(self):
+        positions = self.positions()
+        for start in xrange(0, len(positions), CHUNK_SIZE):
+            for row in self.dataset.rows(positions[start:start + CHUNK_SIZE]):
+                yield row
+
+    def slice_source(self, start, stop, step=None):
+        return self.dataset.rows(self.positions()[start:stop:step])
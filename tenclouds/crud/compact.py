@@ -0,0 +1,65 @@
+"""Compact encoding of list objects.
+
+Requested with the ``compact`` list parameter. Instead of ``objects``, the
+page data has the field names in ``fieldsOrder`` once and ``rows`` of
+values in that order. With ``compact=dict`` the string columns with
+repeated values are also dictionary encoded: their distinct values are
+listed in ``dictionaries`` under the field name and the rows hold indexes
+into that list (``null`` stays ``null``).
+"""
+
+
+def should_encode(values):
+    """Return whether a column of ``values`` is worth dictionary encoding:
+    it holds strings only, at least half of them repeated.
+    """
+    distinct = set()
+    count = 0
+    for value in values:
+        if value is None:
+            continue
+        if not isinstance(value, basestring):
+            return False
+        distinct.add(value)
+        count += 1
+    return count > 1 and len(distinct) * 2 <= count
+
+
+def encode_column(rows, index):
+    """Replace values in ``index`` column of ``rows`` with their positions
+    in the returned list of distinct values.
+    """
+    dictionary = []
+    positions = {}
+    for row in rows:
+        value = row[index]
+        if value is None:
+            continue
+        position = positions.get(value)
+        if position is None:
+            position = positions[value] = len(dictionary)
+            dictionary.append(value)
+        row[index] = position
+    return dictionary
+
+
+def compact_objects(objects, dictionary=False):
+    """Return ``(fields_order, rows, dictionaries)`` encoding a list of
+    dicts. ``dictionaries`` is empty unless ``dictionary`` is set.
+    """
+    fields_order = []
+    seen = set()
+    for obj in objects:
+        for name in obj:
+            if name not in seen:
+                seen.add(name)
+                fields_order.append(name)
+
+    rows = [[obj.get(name) for name in fields_order] for obj in objects]
+
+    dictionaries = {}
+    if dictionary:
+        for index, name in enumerate(fields_order):
+            if should_encode(row[index] for row in rows):
+                dictionaries[name] = encode_column(rows, index)
+    return fields_order, rows, dictionaries
@@ -0,0 +1,100 @@
+"""Running database queries in a thread pool, concurrently with the request.
+
+The pool is created lazily (so it is never inherited by forked workers) and
+is bounded by the ``CRUD_QUERY_THREADS`` setting (4 by default). Each query
+runs on the worker thread's own database connection, which is kept open and
+reused by the next queries of the thread (for Django >= 1.6, as long as the
+``CONN_MAX_AGE`` setting allows). A connection is closed after a database
+error, so that the next query reconnects.
+
+Concurrent counting is off by default (see ``concurrent_count`` in the
+resource's Meta). It pays off only when the database has spare cores and
+the count and the page are both slow. So far no gain has been measured
+(see the ``crud_benchmark count`` command of the books test app), so
+measure it on your database before enabling it.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, 'CRUD_QUERY_THREADS', 4))
+    return _pool
+
+
+def can_query_concurrently(using):
+    """Return whether queries on the ``using`` database may be run on
+    another connection.
+
+    They may not when the current thread is inside a transaction, since the
+    other connection would not see its changes, nor for in-memory SQLite
+    databases, which are private to a connection.
+    """
+    connection = connections[using]
+    if connection.vendor == 'sqlite' and \
+            connection.settings_dict['NAME'] in ('', ':memory:'):
+        return False
+    if getattr(connection, 'in_atomic_block', False):
+        return False
+    # Django < 1.6
+    is_managed = getattr(transaction, 'is_managed', None)
+    if is_managed is not None and is_managed(using=using):
+        return False
+    return True
+
+
+class DeferredResult(object):
+    """Result of a call that could not be run concurrently. The call is run
+    by ``get()``, mimicking ``multiprocessing.pool.AsyncResult``.
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def get(self, timeout=None):
+        return self.func(*self.args, **self.kwargs)
+
+
+def _call(using, func, args, kwargs):
+    connection = connections[using]
+    # Django >= 1.6
+    close_if_obsolete = getattr(connection, 'close_if_unusable_or_obsolete',
+                                None)
+    if close_if_obsolete is not None:
+        close_if_obsolete()
+    try:
+        return func(*args, **kwargs)
+    except DatabaseError:
+        connection.close()
+        raise
+    finally:
+        if not hasattr(connection, 'get_autocommit'):
+            # Django < 1.6 leaves the transaction of the queries open, it
+            # mustn't stay idle until the thread's next query.
+            transaction.rollback_unless_managed(using=using)
+
+
+def run_async(objects, func, *args, **kwargs):
+    """Start ``func(*args, **kwargs)``, which queries ``objects``, in the
+    pool and return an object whose ``get()`` method waits for the result.
+
+    If ``objects`` is not a queryset or its database can not be queried
+    concurrently, ``func`` is called by ``get()`` in the current thread.
+    """
+    using = getattr(objects, 'db', None)
+    if using is None or not can_query_concurrently(using):
+        return DeferredResult(func, args, kwargs)
+    return get_pool().apply_async(_call,
+                                  (using, func, args, kwargs))
@@ -0,0 +1,155 @@
+"""Strategies computing the total number of objects for paginated lists.
+
+A strategy is picked with the ``count_strategy`` resource Meta option, for
+example::
+
+    class Meta:
+        count_strategy = CappedCount(limit=10000)
+
+Every strategy returns a ``(total, kind)`` pair. The ``kind`` is passed to
+the frontend as ``total_kind``, so it knows how to present the total:
+
+    * ``exact`` - the exact number of objects,
+    * ``cached`` - exact number, but possibly a little outdated,
+    * ``estimate`` - an approximate number coming from the database planner,
+    * ``capped`` - there are more than ``total`` objects.
+"""
+import hashlib
+
+from django.core.cache import cache
+from django.db import connections
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+
+def exact_count(objects):
+    """Return number of elements in a queryset or any sized iterable."""
+    try:
+        return objects.count()
+    except (AttributeError, TypeError):
+        return len(objects)
+
+
+class CountStrategy(object):
+    kind = 'exact'
+
+    def count(self, objects):
+        """Return ``(total, kind)`` pair for given ``objects``."""
+        raise NotImplementedError
+
+
+class ExactCount(CountStrategy):
+    """Run a full ``COUNT(*)`` on every request. This is the default."""
+
+    def count(self, objects):
+        return exact_count(objects), self.kind
+
+
+class CachedCount(CountStrategy):
+    """Cache exact counts for ``timeout`` seconds.
+
+    The cache key is built from the SQL of the filtered, unordered queryset,
+    so every distinct set of filters (including the ones applied by the
+    authorization) is counted separately, no matter in which order the
+    filters were given.
+    """
+    kind = 'cached'
+
+    def __init__(self, timeout=300, key_prefix='crud:count'):
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def cache_key(self, objects):
+        sql, params = objects.order_by().query.sql_with_params()
+        digest = hashlib.md5(repr((objects.db, sql, params))).hexdigest()
+        return '%s:%s' % (self.key_prefix, digest)
+
+    def count(self, objects):
+        if not hasattr(objects, 'query'):
+            return exact_count(objects), ExactCount.kind
+        try:
+            key = self.cache_key(objects)
+        except EmptyResultSet:
+            return 0, ExactCount.kind
+
+        total = cache.get(key)
+        if total is None:
+            total = exact_count(objects)
+            cache.set(key, total, self.timeout)
+        return total, self.kind
+
+
+class EstimatedCount(CountStrategy):
+    """Use the planner's row estimate for unfiltered lists.
+
+    Filtered lists, databases that provide no estimate (eg. SQLite) and
+    tables estimated to have less than ``threshold`` rows are counted
+    exactly.
+    """
+    kind = 'estimate'
+
+    queries = {
+        'postgresql': "SELECT reltuples::bigint FROM pg_class "
+                      "WHERE oid = %s::regclass",
+        'mysql': "SELECT table_rows FROM information_schema.tables "
+                 "WHERE table_schema = DATABASE() AND table_name = %s",
+    }
+
+    def __init__(self, threshold=10000):
+        self.threshold = threshold
+
+    def is_filtered(self, objects):
+        query = objects.query
+        return bool(query.where.children or query.distinct or
+                    query.low_mark or query.high_mark is not None)
+
+    def estimate(self, objects):
+        """Return the planner's estimate of rows in the table of
+        ``objects`` or ``None`` if it is not available.
+        """
+        connection = connections[objects.db]
+        sql = self.queries.get(connection.vendor)
+        if sql is None:
+            return None
+
+        table = objects.model._meta.db_table
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(table)
+        cursor = connection.cursor()
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def count(self, objects):
+        if not hasattr(objects, 'query') or self.is_filtered(objects):
+            return exact_count(objects), ExactCount.kind
+
+        total = self.estimate(objects)
+        if total is None or total < self.threshold:
+            return exact_count(objects), ExactCount.kind
+        return int(total), self.kind
+
+
+class CappedCount(CountStrategy):
+    """Stop counting after ``limit`` objects.
+
+    When there are more objects, ``limit`` is returned, which the frontend
+    displays as eg. "10000+".
+    """
+    kind = 'capped'
+
+    def __init__(self, limit=10000):
+        self.limit = limit
+
+    def count(self, objects):
+        if not hasattr(objects, 'query'):
+            return exact_count(objects), ExactCount.kind
+
+        total = objects.order_by()[:self.limit + 1].count()
+        if total > self.limit:
+            return self.limit, self.kind
+        return total, ExactCount.kind
@@ -0,0 +1,394 @@
+"""In-memory datasets queried like Django querysets.
+
+``Dataset(records)`` keeps a list of records, dicts or objects with the
+fields as attributes, and ``Dataset.all()`` returns a ``DatasetQuerySet``:
+a ``QuerySetAdapter`` which also supports
+
+    * ``filter()`` and ``exclude()`` with keyword lookups and Q objects,
+      the lookups being ``exact``, ``in``, ``isnull``, ``contains``,
+      ``icontains``, ``gt``, ``gte``, ``lt``, ``lte`` and ``range`` on the
+      fields of the records (``pk`` names the ``pk`` field),
+    * ``order_by()`` with many fields, ``-`` reversing the order.
+
+So CRUD's filters and sorting work for resources whose ``get_object_list``
+returns it.
+
+The dataset builds indexes of a field on first use and keeps them: a hash
+index (value to positions of records) for equality lookups and a sorted
+one for comparisons and ordering. Full orderings are kept too, so a page
+of a filtered list is read without scanning the records. Keep the dataset
+around (eg. at the module level) to reuse the indexes across requests and
+call ``invalidate()`` after changing the records.
+
+``NULL`` (``None``) values are ordered first and never match comparisons.
+Lookup values are converted to the type of the field's values, so filters
+with strings read from the query string work like with the ORM.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+from heapq import nsmallest
+from itertools import islice
+from operator import attrgetter
+
+from django.core.exceptions import FieldError
+from django.db.models import Q
+
+from tenclouds.crud.queryset import QuerySetAdapter
+
+
+# A filtered list with fewer matches than this part of the records is
+# sorted, not read from the full ordering.
+SPARSE = 16
+
+# Types lookup values are converted to, if the field's values have them.
+CONVERTED_TYPES = (basestring, bool, int, long, float, Decimal)
+
+
+def _to_bool(value):
+    if value in ('t', 'True', 'true', '1'):
+        return True
+    if value in ('f', 'False', 'false', '0'):
+        return False
+    return bool(value)
+
+
+class Dataset(object):
+    """Records with indexes of their fields."""
+
+    def __init__(self, records, pk='id'):
+        self.records = list(records)
+        self.pk = pk
+        self.invalidate()
+
+    def __len__(self):
+        return len(self.records)
+
+    def invalidate(self):
+        """Drop the indexes, eg. after the records have changed."""
+        self._columns = {}
+        self._hash = {}
+        self._sorted = {}
+        self._ranks = {}
+        self._orderings = {}
+        self._types = {}
+
+    def all(self):
+        return DatasetQuerySet(self)
+
+    def field_name(self, name):
+        return self.pk if name == 'pk' else name
+
+    def column(self, field):
+        """Return list of ``field`` values, by position of the record."""
+        field = self.field_name(field)
+        column = self._columns.get(field)
+        if column is None:
+            if self.records and isinstance(self.records[0], dict):
+                if not any(field in record for record in self.records):
+                    raise FieldError("Cannot resolve keyword %r into field."
+                                     % field)
+                column = [record.get(field) for record in self.records]
+            else:
+                try:
+                    column = map(attrgetter(field), self.records)
+                except AttributeError:
+                    raise FieldError("Cannot resolve keyword %r into field."
+                                     % field)
+            self._columns[field] = column
+        return column
+
+    def field_type(self, field):
+        """Return type lookup values of ``field`` are converted to, the
+        one of its values, or ``None`` if they aren't converted.
+        """
+        field = self.field_name(field)
+        if field not in self._types:
+            field_type = None
+            for value in self.column(field):
+                if isinstance(value, basestring):
+                    field_type = basestring
+                elif isinstance(value, CONVERTED_TYPES):
+                    field_type = type(value)
+                if value is not None:
+                    break
+            self._types[field] = field_type
+        return self._types[field]
+
+    def convert(self, field, value):
+        """Return lookup ``value`` converted to the type of ``field``."""
+        field_type = self.field_type(field)
+        if value is None or field_type is None or \
+                isinstance(value, field_type):
+            return value
+        if field_type is basestring:
+            return unicode(value)
+        if field_type is bool:
+            return _to_bool(value)
+        return field_type(value)
+
+    def hash_index(self, field):
+        """Return dict of ``field`` values to lists of positions."""
+        field = self.field_name(field)
+        index = self._hash.get(field)
+        if index is None:
+            index = {}
+            for position, value in enumerate(self.column(field)):
+                index.setdefault(value, []).append(position)
+            self._hash[field] = index
+        return index
+
+    def sorted_index(self, field):
+        """Return ``(values, positions)`` of records having a ``field``
+        value, ordered by it.
+        """
+        field = self.field_name(field)
+        index = self._sorted.get(field)
+        if index is None:
+            values = self.column(field)
+            positions = sorted((p for p, v in enumerate(values)
+                                if v is not None), key=values.__getitem__)
+            index = ([values[p] for p in positions], array('l', positions))
+            self._sorted[field] = index
+        return index
+
+    def ranks(self, field):
+        """Return array of places of records in the ``field`` ordering,
+        equal values sharing a place.
+        """
+        field = self.field_name(field)
+        ranks = self._ranks.get(field)
+        if ranks is None:
+            ranks = array('l', [0]) * len(self.records)
+            rank = 0
+            previous = object()
+            for value, position in zip(*self.sorted_index(field)):
+                if value != previous:
+                    rank += 1
+                    previous = value
+                ranks[position] = rank
+            self._ranks[field] = ranks
+        return ranks
+
+    def sort_key(self, order_by):
+        """Return key function of positions ordering by ``order_by``."""
+        keys = [(self.ranks(name.lstrip('-')), name.startswith('-'))
+                for name in order_by]
+        if len(keys) == 1 and not keys[0][1]:
+            return keys[0][0].__getitem__
+        return lambda p: tuple(-ranks[p] if desc else ranks[p]
+                               for ranks, desc in keys)
+
+    def ordering(self, order_by):
+        """Return array of positions of all records ordered by
+        ``order_by`` field names.
+        """
+        order_by = tuple(order_by)
+        positions = self._orderings.get(order_by)
+        if positions is None:
+            if len(order_by) == 1:
+                field = order_by[0].lstrip('-')
+                nulls = self.hash_index(field).get(None, [])
+                positions = array('l', nulls) + self.sorted_index(field)[1]
+                if order_by[0].startswith('-'):
+                    positions.reverse()
+            else:
+                positions = array('l', sorted(xrange(len(self.records)),
+                                              key=self.sort_key(order_by)))
+            self._orderings[order_by] = positions
+        return positions
+
+    def _lookup(self, field, kind, value):
+        """Return ``(lists, test)``: lists of positions of records matching
+        the lookup and the test of a value matching it.
+        """
+        if kind == 'isnull':
+            value = _to_bool(value)
+        elif kind in ('in', 'range'):
+            value = [self.convert(field, v) for v in value]
+        elif kind in ('contains', 'icontains'):
+            if not isinstance(value, basestring):
+                value = unicode(value)
+        else:
+            value = self.convert(field, value)
+        if kind == 'exact':
+            return ([self.hash_index(field).get(value, [])],
+                    lambda v: v == value)
+        if kind == 'in':
+            index = self.hash_index(field)
+            value = set(value)
+            return ([index.get(v, []) for v in value], lambda v: v in value)
+        if kind == 'isnull':
+            if value:
+                return ([self.hash_index(field).get(None, [])],
+                        lambda v: v is None)
+            return [self.sorted_index(field)[1]], lambda v: v is not None
+        if kind in ('contains', 'icontains'):
+            if kind == 'icontains':
+                value = value.lower()
+                test = lambda v: (isinstance(v, basestring) and
+                                  value in v.lower())
+            else:
+                test = lambda v: isinstance(v, basestring) and value in v
+            return ([positions for v, positions
+                     in self.hash_index(field).iteritems() if test(v)], test)
+
+        values, positions = self.sorted_index(field)
+        if kind == 'gt':
+            return ([positions[bisect_right(values, value):]],
+                    lambda v: v is not None and v > value)
+        if kind == 'gte':
+            return ([positions[bisect_left(values, value):]],
+                    lambda v: v is not None and v >= value)
+        if kind == 'lt':
+            return ([positions[:bisect_left(values, value)]],
+                    lambda v: v is not None and v < value)
+        if kind == 'lte':
+            return ([positions[:bisect_right(values, value)]],
+                    lambda v: v is not None and v <= value)
+        if kind == 'range':
+            low, high = value
+            return ([positions[bisect_left(values, low):
+                               bisect_right(values, high)]],
+                    lambda v: v is not None and low <= v <= high)
+        raise FieldError("Unsupported lookup %r of an in-memory dataset."
+                         % '__'.join((field, kind)))
+
+    def resolve(self, lookup, value):
+        """Return ``(field, lists, test)`` of ``lookup``, see ``_lookup``."""
+        field, _, kind = lookup.partition('__')
+        field = self.field_name(field)
+        return (field,) + self._lookup(field, kind or 'exact', value)
+
+    def select(self, (field, lists, test), within=None):
+        """Return set of positions of records matching a resolved lookup,
+        of those ``within`` the given set if it's not ``None``.
+        """
+        if within is not None and len(within) < sum(map(len, lists)):
+            # Testing fewer values is cheaper than building a bigger set.
+            column = self.column(field)
+            return set(p for p in within if test(column[p]))
+        matched = set()
+        for positions in lists:
+            matched.update(positions)
+        return matched if within is None else matched & within
+
+    def match(self, q, within=None):
+        """Return set of positions of records matching ``q``, of those
+        ``within`` the given set if it's not ``None``. Returns ``None`` if
+        all of them match.
+        """
+        nodes = [child for child in q.children if isinstance(child, Q)]
+        resolved = [self.resolve(*child) for child in q.children
+                    if not isinstance(child, Q)]
+        if q.connector == Q.OR:
+            matched = set()
+            for child in resolved:
+                matched |= self.select(child, within)
+            for child in nodes:
+                found = self.match(child, within)
+                if found is None:
+                    matched = None
+                    break
+                matched |= found
+        else:
+            # The most selective lookups go first, narrowing the others.
+            resolved.sort(key=lambda child: sum(map(len, child[1])))
+            matched = None
+            for child in resolved + nodes:
+                current = within if matched is None else matched
+                if isinstance(child, Q):
+                    found = self.match(child, current)
+                else:
+                    found = self.select(child, current)
+                if found is not None:
+                    matched = found
+
+        if q.negated:
+            if matched is None:
+                return set()
+            if within is None:
+                within = set(xrange(len(self)))
+            return within - matched
+        return matched
+
+
+class DatasetQuerySet(QuerySetAdapter):
+    """Records of a ``Dataset`` matching the filters, in the given order."""
+
+    def __init__(self, dataset, matched=None, ordering=(), **extra):
+        self.dataset = dataset
+        # Positions of the matching records, ``None`` if all match.
+        self.matched = matched
+        self.ordering = tuple(ordering)
+        super(DatasetQuerySet, self).__init__(self, self.count_matched,
+                                              **extra)
+
+    def count_matched(self):
+        if self.matched is None:
+            return len(self.dataset)
+        return len(self.matched)
+
+    def _clone(self, matched=None, ordering=None):
+        if ordering is None:
+            ordering = self.ordering
+        return DatasetQuerySet(self.dataset, matched, ordering, **self._extra)
+
+    def all(self):
+        return self._clone(self.matched)
+
+    def filter(self, *args, **kwargs):
+        found = self.dataset.match(Q(*args, **kwargs), self.matched)
+        if found is None:
+            return self.all()
+        return self._clone(found)
+
+    def exclude(self, *args, **kwargs):
+        return self.filter(~Q(*args, **kwargs))
+
+    def order_by(self, *field_names):
+        return self._clone(self.matched, field_names)
+
+    def positions(self, stop=None):
+        """Return iterable of positions of matching records, in order. With
+        ``stop`` given only that many first positions are needed.
+        """
+        dataset = self.dataset
+        matched = self.matched
+        dense = matched is None or len(matched) * SPARSE >= len(dataset)
+        if not self.ordering:
+            if matched is None:
+                return xrange(len(dataset))
+            if not dense:
+                if stop is not None:
+                    return nsmallest(stop, matched)
+                return sorted(matched)
+            return (p for p in xrange(len(dataset)) if p in matched)
+
+        order_by = [name[:name.startswith('-')] +
+                    dataset.field_name(name.lstrip('-'))
+                    for name in self.ordering]
+        if matched is None:
+            return dataset.ordering(order_by)
+        if not dense:
+            key = dataset.sort_key(order_by)
+            if stop is not None:
+                return nsmallest(stop, matched, key=key)
+            return sorted(matched, key=key)
+        # Many records match, the page is found early in the ordering.
+        return (p for p in dataset.ordering(order_by) if p in matched)
+
+    def __iter__(self):
+        records = self.dataset.records
+        return (records[p] for p in self.positions())
+
+    def slice_source(self, start, stop, step=None):
+        positions = self.positions(stop)
+        if isinstance(positions, (list, array)):
+            positions = positions[start:stop:step]
+        else:
+            positions = islice(positions, start, stop, step)
+        records = self.dataset.records
+        if stop is None:
+            return (records[p] for p in positions)
+        return [records[p] for p in positions]
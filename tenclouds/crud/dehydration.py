@@ -0,0 +1,288 @@
+import inspect
+
+from tastypie import fields, resources
+from tastypie.bundle import Bundle
+from tastypie.exceptions import ApiFieldError
+
+from django.db.models.fields import FieldDoesNotExist
+
+
+def make_reader(field, attribute):
+    """Return a function reading the value of ``field`` from an object, the
+    same way tastypie's ``ApiField.dehydrate`` does, but with the
+    ``attribute`` lookup split up front.
+    """
+    attrs = attribute.split('__')
+    has_default = field.has_default()
+    null = field.null
+    convert = field.convert
+
+    def read(obj):
+        value = obj
+        for attr in attrs:
+            previous = value
+            value = getattr(value, attr, None)
+            if value is None:
+                if has_default:
+                    value = field._default
+                    break
+                elif null:
+                    break
+                raise ApiFieldError(
+                    "The object '%r' has an empty attribute '%s' and doesn't "
+                    "allow a default or null value." % (previous, attr))
+        if callable(value):
+            value = value()
+        return convert(value)
+    return read
+
+
+def is_builtin(method, base_method):
+    return getattr(method, 'im_func', None) is base_method.im_func
+
+
+def has_stock_dehydrate(field):
+    """Return whether ``field`` is dehydrated by tastypie's
+    ``ApiField.dehydrate``, so its value can be read without calling it.
+    """
+    return is_builtin(type(field).dehydrate, fields.ApiField.dehydrate)
+
+
+def used_in_lists(field):
+    """Return whether ``field`` may be dehydrated for list pages. Like in
+    tastypie's ``get_list``, lists are dehydrated in the detail mode, so
+    only fields used just in the list mode are skipped. Fields with a
+    callable ``use_in`` may be used.
+    """
+    use_in = getattr(field, 'use_in', 'all')
+    return callable(use_in) or use_in != 'list'
+
+
+def dehydrate_field(field):
+    """Return a function dehydrating ``field`` of a bundle, passing
+    ``for_list=False`` (lists are dehydrated in the detail mode) if the
+    field's ``dehydrate`` takes it.
+    """
+    try:
+        takes_for_list = 'for_list' in inspect.getargspec(field.dehydrate)[0]
+    except TypeError:
+        takes_for_list = False
+    if takes_for_list:
+        return lambda bundle: field.dehydrate(bundle, for_list=False)
+    return field.dehydrate
+
+
+class DehydrationPlan(object):
+    """Dehydration metadata of a resource class.
+
+    Compiled once per class by ``ModelDeclarativeMetaclass`` from the
+    declared fields: the order in which fields are dehydrated with their
+    attribute lookups and ``dehydrate_<name>`` hooks, the model field to API
+    field map and the url-field pairs.
+    """
+
+    def __init__(self, resource_class):
+        # (name, attribute, hook name) in the order of dehydration
+        self.fields = []
+        self.hooks = []
+        self.model_to_api = {}
+        self.url_fields = {}
+
+        for name, field in resource_class.base_fields.items():
+            if hasattr(field, 'attribute'):
+                self.model_to_api[field.attribute] = name
+            if getattr(field, 'url', None):
+                self.url_fields[name] = field.url
+
+            hook = 'dehydrate_%s' % name
+            if hasattr(resource_class, hook):
+                self.hooks.append(hook)
+            else:
+                hook = None
+            self.fields.append((name, getattr(field, 'attribute', None), hook))
+
+    def bind(self, resource):
+        return BoundDehydrationPlan(self, resource)
+
+
+class BoundDehydrationPlan(object):
+    """Dehydration plan bound to fields and hooks of a resource instance.
+
+    ``dehydrate(obj, request)`` returns the same bundle as
+    ``resource.full_dehydrate(resource.build_bundle(obj, request=request))``
+    without looking anything up per object.
+    """
+
+    def __init__(self, plan, resource):
+        self.plan = plan
+        self.resource = resource
+        self.finish = resource.dehydrate
+
+        # (name, dehydrate, reader, hook, use_in) of dehydrated fields
+        self.entries = []
+        for name, attribute, hook in plan.fields:
+            field = resource.fields[name]
+            if not used_in_lists(field):
+                continue
+            use_in = getattr(field, 'use_in', 'all')
+            if not callable(use_in):
+                use_in = None
+
+            if getattr(field, 'dehydrated_type', None) == 'related':
+                # A touch leaky, like in full_dehydrate.
+                field.api_name = resource._meta.api_name
+                field.resource_name = resource._meta.resource_name
+                reader = None
+            elif isinstance(attribute, basestring) and has_stock_dehydrate(field):
+                reader = make_reader(field, attribute)
+            else:
+                # Eg. a custom field overriding ``dehydrate``.
+                reader = None
+
+            if hook is not None:
+                hook = getattr(resource, hook)
+            self.entries.append((name, dehydrate_field(field), reader, hook,
+                                 use_in))
+
+    def dehydrate(self, obj, request):
+        bundle = Bundle(obj=obj, request=request)
+        data = bundle.data
+        for name, dehydrate, reader, hook, use_in in self.entries:
+            if use_in is not None and not use_in(bundle):
+                continue
+            if reader is not None:
+                data[name] = reader(obj)
+            else:
+                data[name] = dehydrate(bundle)
+            if hook is not None:
+                data[name] = hook(bundle)
+        return self.finish(bundle)
+
+    def dehydrate_page(self, objects, request):
+        dehydrate = self.dehydrate
+        return [dehydrate(obj, request) for obj in objects]
+
+
+class ProjectedRow(object):
+    """Stand-in for a model instance built from a ``values()`` row. Has
+    just the columns selected, which is enough to build a resource URI.
+    """
+
+    def __init__(self, row):
+        self.__dict__.update(row)
+
+
+class Projection(object):
+    """Dehydrates list pages of a resource from rows restricted to the
+    columns backing its fields.
+
+    When no field has a custom ``dehydrate_<name>`` method (the built-in
+    ``resource_uri`` one is fine) and the resource does not override
+    ``dehydrate``, the rows are fetched with ``values()`` and the page is
+    dehydrated to plain dicts. Otherwise model instances are loaded with
+    ``only()`` the needed columns and dehydrated with the bound plan.
+
+    Resources with related fields, or fields used depending on a callable,
+    can't be projected (``projectable`` is ``False``).
+    """
+
+    def __init__(self, bound_plan):
+        self.bound_plan = bound_plan
+        self.resource = resource = bound_plan.resource
+        self.model = resource._meta.object_class
+        self.projectable = self.model is not None
+        self.use_values = is_builtin(resource.dehydrate,
+                                     resources.Resource.dehydrate)
+
+        # (name, field, attribute) of fields read straight from the columns
+        self.plain = []
+        # names of fields dehydrated by the built-in resource_uri hook
+        self.uri_fields = []
+
+        attributes = []
+        for name, attribute, hook in bound_plan.plan.fields:
+            field = resource.fields[name]
+            use_in = getattr(field, 'use_in', 'all')
+            if callable(use_in) or \
+                    getattr(field, 'dehydrated_type', None) == 'related':
+                self.projectable = False
+                return
+            if not used_in_lists(field):
+                continue
+            if not has_stock_dehydrate(field):
+                self.use_values = False
+
+            if attribute is not None:
+                if not isinstance(attribute, basestring):
+                    self.projectable = False
+                    return
+                attributes.append(attribute)
+
+            hook = hook and getattr(resource, hook)
+            if hook is None:
+                self.plain.append((name, field, attribute))
+            elif attribute is None and is_builtin(
+                    hook, resources.Resource.dehydrate_resource_uri):
+                self.uri_fields.append(name)
+            else:
+                self.use_values = False
+
+        self.columns = ['pk', resource._meta.detail_uri_name]
+        self.only_columns = []
+        for attribute in attributes:
+            if attribute not in self.columns:
+                self.columns.append(attribute)
+            name = attribute.split('__')[0]
+            try:
+                field, _, direct, m2m = \
+                    self.model._meta.get_field_by_name(name)
+            except FieldDoesNotExist:
+                # Not a field, can't be fetched with values() nor only().
+                self.use_values = False
+                self.only_columns = None
+                continue
+            if not direct or m2m:
+                # Multi-valued relations would multiply values() rows.
+                self.use_values = False
+            if self.only_columns is not None and direct and not m2m:
+                self.only_columns.append(name)
+
+    def restrict(self, objects):
+        """Return ``objects`` restricted to the projected columns, including
+        the ordering columns, so that paginators can read them.
+        """
+        if self.use_values:
+            columns = list(self.columns)
+            ordering = objects.query.order_by or self.model._meta.ordering
+            for name in ordering:
+                if name.lstrip('-') not in columns:
+                    columns.append(name.lstrip('-'))
+            return objects.values(*columns)
+        if self.only_columns:
+            return objects.only(*self.only_columns)
+        return objects
+
+    def dehydrate_page(self, objects, request):
+        """Return dehydrated ``objects`` fetched from the restricted
+        queryset: dicts for ``values()`` rows or bundles otherwise.
+        """
+        if self.use_values:
+            return [self.dehydrate_row(row, request) for row in objects]
+        return self.bound_plan.dehydrate_page(objects, request)
+
+    def dehydrate_row(self, row, request):
+        data = {}
+        for name, field, attribute in self.plain:
+            if attribute is None:
+                data[name] = field.dehydrate(None)
+                continue
+            value = row[attribute]
+            if value is None and field.has_default():
+                value = field._default
+            data[name] = field.convert(value)
+        if self.uri_fields:
+            uri = self.resource.dehydrate_resource_uri(
+                Bundle(obj=ProjectedRow(row), data=data, request=request))
+            for name in self.uri_fields:
+                data[name] = uri
+        return data
@@ -0,0 +1,102 @@
+"""Counting objects matching filter choices (facets).
+
+``count_facets`` counts the objects of a queryset matching each of the
+given Q objects in one query, a conditional aggregation over the queryset::
+
+    SELECT SUM(CASE WHEN <condition 1> THEN 1 ELSE 0 END), ...
+    FROM (SELECT DISTINCT <columns> FROM <queryset>) facets
+
+Equality lookups on the model's own columns are compared with the columns
+selected by the queryset. Other conditions are tested with a ``pk IN``
+subquery of the objects matching them.
+"""
+from django.db import connections
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # Django < 1.6
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+
+def simple_condition(model, q):
+    """Return ``(field, value)`` if ``q`` is an equality lookup on a column
+    of ``model`` own table, otherwise ``None``.
+    """
+    if q.negated or len(q.children) != 1 or isinstance(q.children[0], Q):
+        return None
+    lookup, value = q.children[0]
+    if lookup.endswith('__exact'):
+        lookup = lookup[:-len('__exact')]
+    if '__' in lookup or value is None or hasattr(value, 'query') or \
+            isinstance(value, (list, tuple, set, Q)):
+        return None
+    if lookup == 'pk':
+        field = model._meta.pk
+    else:
+        try:
+            field = model._meta.get_field(lookup)
+        except FieldDoesNotExist:
+            return None
+    # Relations and inherited fields (living in the parent's table) are
+    # left to subqueries.
+    if field.rel is not None or field not in model._meta.local_fields:
+        return None
+    return field, value
+
+
+def count_facets(queryset, choices):
+    """Return a dict of numbers of ``queryset`` objects matching the Q
+    objects in ``choices``, a list of ``(key, q)`` pairs.
+    """
+    if not choices:
+        return {}
+    model = queryset.model
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+
+    pk = model._meta.pk
+    columns = [pk]
+    conditions = []
+    params = []
+    for key, q in choices:
+        if not q.children:
+            conditions.append('1 = 1')
+            continue
+        simple = simple_condition(model, q)
+        if simple is not None:
+            field, value = simple
+            if field not in columns:
+                columns.append(field)
+            conditions.append('facets.%s = %%s' % qn(field.column))
+            params.append(field.get_db_prep_value(field.get_prep_value(value),
+                                                  connection=connection))
+            continue
+        matching = model._default_manager.using(queryset.db).filter(q)
+        try:
+            sql, sub_params = matching.values('pk').query.sql_with_params()
+        except EmptyResultSet:
+            conditions.append('1 = 0')
+            continue
+        conditions.append('facets.%s IN (%s)' % (qn(pk.column), sql))
+        params.extend(sub_params)
+
+    names = [field.name if field is not pk else 'pk' for field in columns]
+    try:
+        # Filters joining multi-valued relations repeat the objects, each
+        # one must be counted once.
+        sql, base_params = queryset.order_by().values(*names).distinct() \
+            .query.sql_with_params()
+    except EmptyResultSet:
+        return dict((key, 0) for key, q in choices)
+
+    sums = ', '.join('SUM(CASE WHEN %s THEN 1 ELSE 0 END)' % condition
+                     for condition in conditions)
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s FROM (%s) facets' % (sums, sql),
+                   params + list(base_params))
+    row = cursor.fetchone()
+    return dict((key, int(count or 0))
+                for (key, q), count in zip(choices, row))
@@ -0,0 +1,116 @@
+"""Per-model generation counters for invalidating cached data.
+
+Each tracked model has a counter stored in Django's default cache, bumped
+whenever an instance is saved or deleted, or its many-to-many relations
+change. Data cached under a key containing the generations of the models it
+was read from is never served after a write, without having to find and
+delete the stale entries.
+
+Counters start from the current time in milliseconds, so a counter evicted
+from the cache comes back with a value it has never had before. Bulk
+operations that send no signals (``QuerySet.update``, ``bulk_create``,
+raw SQL) must call ``bump_generation`` themselves.
+
+Counters not tied to a model, eg. for data invalidated by hand, are read
+with ``get_counters`` and bumped with ``bump_counter``.
+
+The default cache must be shared by all processes serving the site (eg.
+memcached or the database cache). With the local memory cache a write
+handled by one process bumps the counters of that process only, and the
+others keep serving cached lists and ``304 Not Modified`` responses for the
+stale data. ``track_models`` warns about it.
+"""
+import time
+import warnings
+
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import signals
+
+
+KEY_PREFIX = 'crud:generation'
+# Longest relative timeout understood by memcached.
+TIMEOUT = 60 * 60 * 24 * 30
+
+_tracked = set()
+
+
+def generation_key(model):
+    return '%s:%s' % (KEY_PREFIX, model._meta.db_table)
+
+
+def _initial_generation():
+    return int(time.time() * 1000)
+
+
+def get_counters(keys):
+    """Return a list of current values of counters stored under ``keys``."""
+    found = cache.get_many(keys)
+    values = []
+    for key in keys:
+        value = found.get(key)
+        if value is None:
+            value = _initial_generation()
+            if not cache.add(key, value, TIMEOUT):
+                value = cache.get(key, value)
+        values.append(value)
+    return values
+
+
+def bump_counter(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _initial_generation(), TIMEOUT)
+
+
+def get_generations(models):
+    """Return a list of current generations of ``models``."""
+    return get_counters([generation_key(model) for model in models])
+
+
+def get_generation(model):
+    return get_generations([model])[0]
+
+
+def bump_generation(model):
+    """Invalidate data cached for ``model`` and the models it inherits
+    from, whose tables are written too.
+    """
+    for model in [model] + list(model._meta.get_parent_list()):
+        bump_counter(generation_key(model))
+
+
+def _instance_changed(sender, **kwargs):
+    bump_generation(sender)
+
+
+def _relations_changed(sender, instance, action, model, **kwargs):
+    if not action.startswith('post_'):
+        return
+    for changed in (instance.__class__, model, sender):
+        if changed._meta.db_table in _tracked:
+            bump_generation(changed)
+
+
+def track_models(models):
+    """Bump the generations of ``models`` on every change sent by model
+    signals.
+    """
+    if models and isinstance(cache, LocMemCache):
+        warnings.warn("Generations of changed models are stored in the "
+                      "local memory cache, other processes won't see them. "
+                      "Use a cache shared between processes as the default "
+                      "one.", RuntimeWarning)
+    for model in models:
+        table = model._meta.db_table
+        if table in _tracked:
+            continue
+        _tracked.add(table)
+        uid = 'crud:generation:%s' % table
+        signals.post_save.connect(_instance_changed, sender=model,
+                                  weak=False, dispatch_uid=uid)
+        signals.post_delete.connect(_instance_changed, sender=model,
+                                    weak=False, dispatch_uid=uid)
+    signals.m2m_changed.connect(_relations_changed, weak=False,
+                                dispatch_uid='crud:generation')
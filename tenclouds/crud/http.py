@@ -1,6 +1,8 @@
+import hashlib
 import json
 
 from django.http import HttpResponse
+from tastypie.http import HttpNotModified
 
 
 class HttpDone(HttpResponse):
@@ -13,3 +15,41 @@ class HttpJson(HttpResponse):
             content=json.dumps(content, ensure_ascii=False).encode('utf-8'),
             content_type='application/json; charset=UTF-8',
             status=status)
+
+
+def content_etag(content):
+    return '"%s"' % hashlib.md5(content).hexdigest()
+
+
+def etag_matches(request, etag):
+    """Return whether ``etag`` is one of the request's ``If-None-Match``
+    validators.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    # Weak comparison, as If-None-Match requires.
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    return '*' in tags or etag in tags
+
+
+def not_modified(etag):
+    response = HttpNotModified()
+    response['ETag'] = etag
+    return response
+
+
+def conditional_response(request, response, etag=None):
+    """Set the ``ETag`` of a successful ``response`` (by default the hash
+    of its content) and return ``HttpNotModified`` instead if the client
+    has it already.
+    """
+    if response.status_code != 200:
+        return response
+    if etag is None:
+        etag = content_etag(response.content)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response['ETag'] = etag
+    return response
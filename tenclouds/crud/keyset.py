@@ -0,0 +1,150 @@
+"""Keyset (seek) reading of ordered querysets.
+
+Instead of slicing with ``OFFSET``, which makes the database read and drop
+every row before the slice, the next rows are selected with a predicate on
+the values of the ordering columns in the last row read. The ordering is
+completed with the primary key, so every row has a unique position.
+
+Used by ``tenclouds.crud.paginator.CursorPaginator`` and by exports, see
+``tenclouds.crud.streaming.iter_chunks``.
+"""
+from django.core.exceptions import FieldError
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+
+
+def expand_ordering(model, ordering, seen=()):
+    """Return ``ordering`` of ``model`` with relations replaced by the
+    columns Django orders them by: the related model's default ordering (in
+    the relation's direction), or the related primary key.
+    """
+    expanded = []
+    for name in ordering:
+        path = name.lstrip('-')
+        field = None if name == '?' else ordering_field(model, path)
+        if field is None or not field.rel:
+            expanded.append(name)
+            continue
+        if path in seen:
+            raise FieldError("Infinite loop caused by ordering.")
+
+        related = field.rel.to._meta
+        if not related.ordering:
+            expanded.append('%s__%s' % (name, related.pk.name))
+            continue
+        descending = name.startswith('-')
+        names = []
+        for item in related.ordering:
+            if item == '?':
+                names.append(item)
+                continue
+            sign = '-' if item.startswith('-') != descending else ''
+            names.append('%s%s__%s' % (sign, path, item.lstrip('-')))
+        expanded.extend(expand_ordering(model, names, seen + (path,)))
+    return expanded
+
+
+def query_ordering(objects):
+    """Return the effective ordering of queryset ``objects``, with the
+    primary key appended as the tie-breaker. Relations are expanded, see
+    ``expand_ordering``.
+    """
+    query = objects.query
+    ordering = list(query.order_by)
+    if not ordering and query.default_ordering:
+        ordering = list(objects.model._meta.ordering)
+    ordering = expand_ordering(objects.model, ordering)
+
+    pk_name = objects.model._meta.pk.name
+    if not any(name.lstrip('-') in ('pk', pk_name) for name in ordering):
+        ordering.append('pk')
+    return ordering
+
+
+def ordering_field(model, name):
+    """Return the model field the ``name`` ordering column (a lookup which
+    may span relations) reads, or ``None`` if it isn't a field.
+    """
+    if name == 'pk':
+        return model._meta.pk
+    parts = name.split('__')
+    for i, part in enumerate(parts):
+        try:
+            field, _, direct, m2m = model._meta.get_field_by_name(part)
+        except FieldDoesNotExist:
+            return None
+        if not direct or m2m:
+            return None
+        if i == len(parts) - 1:
+            return field
+        if not field.rel:
+            return None
+        model = field.rel.to
+    return None
+
+
+def can_seek(model, ordering):
+    """Return whether rows of ``model`` in ``ordering`` can be sought.
+
+    Every column must be a non-nullable field, reached through
+    non-nullable foreign keys, since ``NULL`` can't be compared by the seek
+    predicate. Relations must have been expanded, see ``expand_ordering``.
+    """
+    for name in ordering:
+        name = name.lstrip('-')
+        if name == '?':
+            return False
+        path = name.split('__')
+        for i in range(len(path)):
+            field = ordering_field(model, '__'.join(path[:i + 1]))
+            if field is None or field.null:
+                return False
+        if field.rel and not field.primary_key:
+            return False
+    return True
+
+
+def ordering_value(obj, name):
+    """Return value of the ``name`` ordering column for ``obj``, following
+    relations spanned by ``__`` (``None`` if one of them is empty). Rows
+    fetched with ``values()`` are supported too.
+    """
+    if isinstance(obj, dict):
+        return obj[name]
+    for attr in name.split('__'):
+        obj = getattr(obj, attr)
+        if obj is None:
+            return None
+    # Ordering by a relation compares the related primary keys.
+    return getattr(obj, 'pk', obj)
+
+
+def seek_filter(ordering, values, backwards=False):
+    """Return Q object selecting rows placed after (or before, if
+    ``backwards`` is set) the row with given ordering ``values``.
+    """
+    q = None
+    for i, name in enumerate(ordering):
+        descending = name.startswith('-')
+        lookup = 'lt' if descending != backwards else 'gt'
+        clause = Q(**{'%s__%s' % (name.lstrip('-'), lookup): values[i]})
+        for prev_name, prev_value in zip(ordering[:i], values[:i]):
+            clause &= Q(**{prev_name.lstrip('-'): prev_value})
+        q = clause if q is None else q | clause
+    return q
+
+
+def iter_sought(objects, ordering, chunk_size):
+    """Yield lists of up to ``chunk_size`` of ``objects`` in ``ordering``
+    (see ``query_ordering``), one query seeking past the last row per list.
+    """
+    objects = objects.order_by(*ordering)
+    chunk = list(objects[:chunk_size])
+    while chunk:
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        values = [ordering_value(chunk[-1], name.lstrip('-'))
+                  for name in ordering]
+        chunk = list(objects.filter(seek_filter(ordering, values))
+                     [:chunk_size])
@@ -1,13 +1,25 @@
+import base64
+import json
+
 from tastypie import paginator
 from tastypie.exceptions import BadRequest
 
 from django.conf import settings
 
+from tenclouds.crud.concurrency import run_async
+from tenclouds.crud.counting import ExactCount
+from tenclouds.crud.keyset import (can_seek, ordering_value,
+                                   query_ordering, seek_filter)
+
 
 class Paginator(paginator.Paginator):
+    # Kinds of totals the page number is clamped to. Capped and estimated
+    # totals may be lower than the real one, so pages past them can be
+    # requested and ``has_next`` tells if there are more.
+    clamped_total_kinds = ('exact', 'cached')
 
     def __init__(self, request_data, objects, resource_uri=None, per_page=None,
-                 offset=0):
+                 offset=0, count_strategy=None, concurrent=False):
         """
         Instantiates the ``Paginator`` and allows for some configuration.
 
@@ -24,12 +36,21 @@ class Paginator(paginator.Paginator):
 
         Optionally accepts an ``offset`` argument, which specifies where in
         the ``objects`` to start displaying results from. Defaults to 0.
+
+        Optionally accepts a ``count_strategy`` argument, an instance of
+        ``tenclouds.crud.counting.CountStrategy`` used to compute the total.
+        Defaults to ``ExactCount``.
+
+        Optionally accepts a ``concurrent`` flag. If set, the total is
+        computed in a thread pool while the page objects are fetched.
         """
         self.request_data = request_data
         self.objects = objects
         self.per_page = per_page
         self.offset = offset
         self.resource_uri = resource_uri
+        self.count_strategy = count_strategy or ExactCount()
+        self.concurrent = concurrent
 
     def get_per_page(self):
         """
@@ -67,50 +88,269 @@ class Paginator(paginator.Paginator):
 
         return per_page
 
-    def page(self):
+    def get_total(self):
         """
-        Generates all pertinent data about the requested page.
-
-        Handles getting the correct ``per_page`` & ``offset``, then slices off
-        the correct set of results and returns all pertinent metadata.
+        Returns a ``(total, kind)`` pair computed by the count strategy, or
+        ``(None, None)`` if the client asked for an ``endless`` list and does
+        not need the total.
         """
-        per_page = self.get_per_page()
-
-        # Check whether to compute the total number of objects available.
         endless = self.request_data.get("endless", "0")
         if endless in ("1", "y", "true"):
-            total = None
+            return None, None
         elif endless in ("0", "n", "false"):
-            total = self.get_count()
-        else:
-            raise BadRequest("Invalid endless flag '%s' provided. Please "
-                             "provide an on of: 0, 1, n, y, false, true."
-                             % endless)
+            return self.count_strategy.count(self.objects)
+        raise BadRequest("Invalid endless flag '%s' provided. Please "
+                         "provide an on of: 0, 1, n, y, false, true."
+                         % endless)
 
-        # Compute valid page number.
+    def get_page_number(self, per_page, total, total_kind='exact'):
+        """
+        Returns the requested page number, clamped to the available range
+        when the ``total`` is known and exact (see ``clamped_total_kinds``).
+        """
         page_number = self.request_data.get("page", 1)
         try:
             page_number = int(page_number)
         except ValueError:
             raise BadRequest("Invalid page '%s' provided. Please provide an "
                              "integer." % page_number)
+
+        # Clamp request-specified page number.
+        if page_number < 1:
+            page_number = 1
+        elif total is not None and total_kind in self.clamped_total_kinds:
+            # First page an be empty.
+            max_page = max(1, total // per_page + bool(total % per_page))
+            if page_number > max_page:
+                page_number = max_page
+        return page_number
+
+    def get_page_objects(self, per_page, page_number):
+        """
+        Returns a list of objects on the given page, with one extra object
+        from the next page if there is any.
+        """
+        offset = self.offset or per_page * (page_number - 1)
+        return list(self.get_slice(per_page + 1, offset))
+
+    def page(self):
+        """
+        Generates all pertinent data about the requested page.
+
+        Handles getting the correct ``per_page`` & ``offset``, then slices off
+        the correct set of results and returns all pertinent metadata.
+
+        One extra object is fetched and dropped to tell whether there is a
+        next page, so that clients don't need the total (which is not
+        computed for ``endless`` lists) to know it.
+        """
+        per_page = self.get_per_page()
+
+        if self.concurrent:
+            # Count in the query pool while the page is fetched here. The
+            # page number can be clamped only when the total is known, so an
+            # out of range page has to be fetched again.
+            pending_total = run_async(self.objects, self.get_total)
+            page_number = self.get_page_number(per_page, None)
+            objects = self.get_page_objects(per_page, page_number)
+            total, total_kind = pending_total.get()
+            clamped_page_number = self.get_page_number(per_page, total,
+                                                       total_kind)
+            if clamped_page_number != page_number:
+                page_number = clamped_page_number
+                objects = self.get_page_objects(per_page, page_number)
         else:
-            # Clamp request-specified page number.
-            if page_number < 1:
-                page_number = 1
-            elif total is not None:
-                # First page an be empty.
-                max_page = max(1, total // per_page + bool(total % per_page))
-                if page_number > max_page:
-                    page_number = max_page
+            # Check whether to compute the total number of objects available.
+            total, total_kind = self.get_total()
+
+            # Compute valid page number.
+            page_number = self.get_page_number(per_page, total, total_kind)
+            objects = self.get_page_objects(per_page, page_number)
+
+        offset = self.offset or per_page * (page_number - 1)
+        has_next = len(objects) > per_page
 
+        return {
+            'offset': offset,
+            'per_page': per_page,
+            'page': page_number,
+            'total': total,
+            'total_kind': total_kind,
+            'has_next': has_next,
+            'objects': objects[:per_page],
+        }
+
+    def stream_page(self):
+        """
+        Generates the data about the requested page like ``page``, but with
+        ``objects`` left unevaluated, for streaming. The slice has one extra
+        object from the next page and ``has_next`` is left out, since it is
+        known only after the objects have been read.
+        """
+        per_page = self.get_per_page()
+        total, total_kind = self.get_total()
+        page_number = self.get_page_number(per_page, total, total_kind)
         offset = self.offset or per_page * (page_number - 1)
-        objects = self.get_slice(per_page, offset)
 
         return {
             'offset': offset,
             'per_page': per_page,
             'page': page_number,
             'total': total,
+            'total_kind': total_kind,
+            'objects': self.get_slice(per_page + 1, offset),
+        }
+
+
+def _cursor_default(value):
+    # Dates and times must keep their full precision, otherwise the seek
+    # predicate would skip or repeat rows.
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return unicode(value)
+
+
+class CursorPaginator(Paginator):
+    """
+    Paginator that seeks to the requested page using the values of the
+    ordering columns instead of slicing with ``OFFSET``, so that fetching a
+    deep page costs the same as fetching the first one.
+
+    The ordering is taken from the queryset, as set by
+    ``ModelResource.apply_sorting`` (or the model's default ordering), and
+    completed with the primary key so every row has a unique position. The
+    page data contains opaque ``next`` and ``prev`` cursors, which the client
+    sends back in the ``cursor`` parameter to get the neighbouring page.
+    Requests without a cursor fall back to offset pagination, so jumping to
+    an arbitrary page keeps working.
+
+    Enable it with ``paginator_class = CursorPaginator`` in resource's Meta.
+    Ordering by a relation seeks on the columns Django orders it by, see
+    ``tenclouds.crud.keyset``. Orderings which can't be sought, eg. by
+    nullable columns (``NULL`` can not be compared by the seek predicate),
+    are paginated with offsets only: their pages have no cursors.
+
+    Unlike ``Paginator``, the ``concurrent`` flag is ignored (the total is
+    counted before the page is read) and ``stream_page`` returns the page
+    with its objects already fetched.
+    """
+
+    def get_ordering(self):
+        """
+        Returns the effective ordering of ``objects`` with the primary key
+        appended as the tie-breaker.
+        """
+        ordering = query_ordering(self.objects)
+        if '?' in ordering:
+            raise BadRequest("Random ordering can not be used with cursor "
+                             "pagination.")
+        return ordering
+
+    def get_value(self, obj, name):
+        """
+        Returns value of the ``name`` ordering column for ``obj``, following
+        relations spanned by ``__``. Rows fetched with ``values()`` are
+        supported too.
+        """
+        return ordering_value(obj, name)
+
+    def encode_cursor(self, direction, ordering, obj):
+        values = [self.get_value(obj, name.lstrip('-')) for name in ordering]
+        data = json.dumps([direction, ordering, values],
+                          default=_cursor_default)
+        return base64.urlsafe_b64encode(data)
+
+    def decode_cursor(self, cursor, ordering):
+        """
+        Returns ``(direction, values)`` stored in the ``cursor``. The cursor
+        must have been created for the same ``ordering``.
+        """
+        try:
+            direction, cursor_ordering, values = json.loads(
+                base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+        if (direction not in ('next', 'prev') or cursor_ordering != ordering
+                or len(values) != len(ordering)):
+            raise BadRequest("Cursor '%s' does not match the current "
+                             "ordering." % cursor)
+        return direction, values
+
+    def seek_filter(self, ordering, values, backwards=False):
+        """
+        Returns Q object selecting rows placed after (or before, if
+        ``backwards`` is set) the row with given ordering ``values``.
+        """
+        return seek_filter(ordering, values, backwards)
+
+    def page(self):
+        """
+        Generates all pertinent data about the requested page, including the
+        ``next`` and ``prev`` cursors.
+
+        One extra row is fetched to know whether there is a next (or
+        previous, when seeking backwards) page.
+        """
+        per_page = self.get_per_page()
+        total, total_kind = self.get_total()
+        page_number = self.get_page_number(per_page, total, total_kind)
+        offset = self.offset or per_page * (page_number - 1)
+        ordering = self.get_ordering()
+
+        # Pages read with an offset must have the same tie-breaker as the
+        # sought ones.
+        objects = self.objects.order_by(*ordering)
+        seekable = can_seek(self.objects.model, ordering)
+        cursor = self.request_data.get('cursor')
+        if cursor:
+            if not seekable:
+                raise BadRequest("Cursor '%s' can not be used with the "
+                                 "current ordering." % cursor)
+            direction, values = self.decode_cursor(cursor, ordering)
+            backwards = direction == 'prev'
+            objects = objects.filter(
+                self.seek_filter(ordering, values, backwards))
+            if backwards:
+                objects = objects.order_by(*[
+                    name[1:] if name.startswith('-') else '-' + name
+                    for name in ordering])
+            objects = list(objects[:per_page + 1])
+            has_more = len(objects) > per_page
+            objects = objects[:per_page]
+            if backwards:
+                objects.reverse()
+                has_prev, has_next = has_more, True
+            else:
+                has_prev, has_next = True, has_more
+        else:
+            objects = list(objects[offset:offset + per_page + 1])
+            has_next = len(objects) > per_page
+            objects = objects[:per_page]
+            has_prev = offset > 0
+
+        next_cursor = prev_cursor = None
+        if objects and has_next and seekable:
+            next_cursor = self.encode_cursor('next', ordering, objects[-1])
+        if objects and has_prev and seekable:
+            prev_cursor = self.encode_cursor('prev', ordering, objects[0])
+
+        return {
+            'offset': offset,
+            'per_page': per_page,
+            'page': page_number,
+            'total': total,
+            'total_kind': total_kind,
+            'has_next': has_next,
             'objects': objects,
+            'next': next_cursor,
+            'prev': prev_cursor,
         }
+
+    def stream_page(self):
+        """
+        Returns ``page()``: cursors are built from the first and last objects
+        of the page, so it is fetched as a whole rather than streamed from
+        the database. Its dehydration and serialization are still streamed.
+        """
+        return self.page()
@@ -1,7 +1,118 @@
 import copy
+import hashlib
+import threading
+import time
 
+from django.core.cache import cache
 from django.db.models import Q
 
+from tenclouds.crud.facets import count_facets
+from tenclouds.crud.generations import TIMEOUT, get_generations, track_models
+from tenclouds.crud.search import QSearch
+
+
+class CachePolicy(object):
+    """How long values computed by dynamic filters may be reused.
+
+    :param timeout: (optional) number of seconds a value is valid for,
+        forever by default.
+    :param invalidate: (optional) ``True`` to drop values when data of the
+        filter's source models changes, or a list of models to watch.
+        Changes are detected with model signals, see
+        ``tenclouds.crud.generations``.
+    :param shared: (optional) share values with other processes through
+        Django's cache, rather than keeping them in this process only.
+
+    For example, to read the choices of a ``QueryFilter`` at most once an
+    hour, or whenever they change::
+
+        QueryFilter(Category.objects.values_list('pk', 'name'), 'category',
+                    cache=CachePolicy(timeout=3600, invalidate=True))
+    """
+
+    key_prefix = 'crud:filter'
+
+    def __init__(self, timeout=None, invalidate=False, shared=False):
+        self.timeout = timeout
+        self.invalidate = invalidate
+        self.shared = shared
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def watched_models(self, source_models):
+        if self.invalidate is True:
+            return list(source_models)
+        return list(self.invalidate or ())
+
+    def get(self, key, compute, source_models=()):
+        """Return the value stored under ``key`` if it is still valid,
+        otherwise store and return the result of ``compute()``.
+        """
+        models = self.watched_models(source_models)
+        if models:
+            track_models(models)
+            version = get_generations(models)
+        else:
+            version = []
+        now = time.time()
+
+        entry = self._values.get(key)
+        if entry is not None and entry[0] == version and \
+                (entry[1] is None or entry[1] > now):
+            return entry[2]
+
+        shared_key = None
+        value = None
+        if self.shared:
+            shared_key = '%s:%s' % (self.key_prefix, hashlib.md5(
+                repr((key, version))).hexdigest())
+            value = cache.get(shared_key)
+        if value is None:
+            value = compute()
+            if shared_key is not None:
+                cache.set(shared_key, value, self.timeout or TIMEOUT)
+
+        expires = now + self.timeout if self.timeout is not None else None
+        with self._lock:
+            self._values[key] = (version, expires, value)
+        return value
+
+
+class FilterIndex(object):
+    """Finds filters affected by a key without walking all of them.
+
+    Filters matching keys exactly (the ``BaseFilter.affected_by`` default)
+    are indexed by key, ``PrefixKeyFilter`` ones by the key part before the
+    first colon. Filters with a custom ``affected_by`` are asked in turn.
+    Like a linear search, ``get`` returns the first filter (in the order
+    they were given) affected by the key.
+    """
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.exact = {}
+        self.prefix = {}
+        self.other = []
+        for position, f in enumerate(self.filters):
+            affected_by = getattr(type(f).affected_by, 'im_func', None)
+            if affected_by is BaseFilter.affected_by.im_func:
+                self.exact.setdefault(f.key, (position, f))
+            elif affected_by is PrefixKeyFilter.affected_by.im_func:
+                self.prefix.setdefault(f.key, (position, f))
+            else:
+                self.other.append((position, f))
+
+    def get(self, key):
+        found = [self.exact.get(key), self.prefix.get(key.split(':', 1)[0])]
+        for position, f in self.other:
+            if f.affected_by(key):
+                found.append((position, f))
+                break
+        found = [item for item in found if item is not None]
+        if not found:
+            return None
+        return min(found)[1]
+
 
 class Group(object):
     def __init__(self, name, *fields, **kwargs):
@@ -11,14 +122,76 @@ class Group(object):
         if self.query_joiner not in ['and', 'or']:
             raise TypeError('Unknown query joiner: %s' % self.query_joiner)
 
+        # Filters of static fields are built once. Dynamic ones are ``None``,
+        # built for every request.
+        self.compiled = []
+        for f in fields:
+            if not isinstance(f, DynamicFilter):
+                self.compiled.append([f])
+            elif f.is_static():
+                self.compiled.append(list(f.filter_fields(None)))
+            else:
+                self.compiled.append(None)
+        self.dynamic = None in self.compiled
+        self.static_index = None
+        if not self.dynamic:
+            self.static_index = FilterIndex(self.filter_fields(None))
+
     def filter_fields(self, request):
         """Yield filters"""
-        for f in self.fields:
-            if isinstance(f, DynamicFilter):
+        for f, compiled in zip(self.fields, self.compiled):
+            if compiled is None:
                 for ff in f.filter_fields(request):
                     yield ff
             else:
-                yield f
+                for ff in compiled:
+                    yield ff
+
+    def filter_index(self, request):
+        """Return ``FilterIndex`` of the group's filters for ``request``.
+
+        The index of a group with dynamic filters is built once per request,
+        so their filters are created (and their queries run) once, no matter
+        how many keys are looked up.
+        """
+        if not self.dynamic:
+            return self.static_index
+        if request is None:
+            return FilterIndex(self.filter_fields(request))
+
+        indexes = getattr(request, '_crud_filter_indexes', None)
+        if indexes is None:
+            indexes = request._crud_filter_indexes = {}
+        index = indexes.get(id(self))
+        if index is None:
+            index = indexes[id(self)] = FilterIndex(self.filter_fields(request))
+        return index
+
+    def source_models(self):
+        """Return models whose data the group's filters are built from."""
+        models = []
+        for f in self.fields:
+            if isinstance(f, DynamicFilter):
+                for model in f.source_models():
+                    if model not in models:
+                        models.append(model)
+        return models
+
+    def signature(self):
+        """Return JSONable description of the group's definition, which
+        doesn't need any data to be read.
+        """
+        fields = []
+        for f, compiled in zip(self.fields, self.compiled):
+            if compiled is not None:
+                fields.append([ff.to_raw_field() for ff in compiled])
+            elif f.source_models():
+                fields.append([f.__class__.__name__,
+                               getattr(f, 'filter_attr', None)])
+            else:
+                fields.append([ff.to_raw_field()
+                               for ff in f.filter_fields(None)])
+        return [self.name, self.query_joiner, fields]
 
     def filter_fields_raw(self, request):
         """Return raw, JSONable list of filters.
@@ -32,27 +205,23 @@ class Group(object):
         """Return filter with given ``key`` or ``None`` if not found in
         current group.
         """
-        for field in self.filter_fields(request):
-            if field.affected_by(key):
-                return field
-        return None
+        return self.filter_index(request).get(key)
 
-    def apply_filters(self, request, query, filter_keys):
-        """Apply filters to given `query`. `filter_keys` list may contain keys
-        that do not belong to current filter group.
+    def build_queries(self, request, filter_keys):
+        """Return a list of Q objects of filters affected by `filter_keys`,
+        each to be applied with its own ``filter()`` call. `filter_keys` list
+        may contain keys that do not belong to current filter group.
         """
-        filters = ((self.filter_by_key(key, request), key)
-                   for key in filter_keys)
+        index = self.filter_index(request)
+        filters = ((index.get(key), key) for key in filter_keys)
         filters = [(f, k) for f, k in filters if f]
 
         if not filters:
-            return query
+            return []
 
         # filter using AND
         if self.query_joiner == 'and':
-            for f, key in filters:
-                query = query.filter(f.build_filters(key))
-            return query
+            return [f.build_filters(key) for f, key in filters]
 
         # filter using OR
         elif self.query_joiner == 'or':
@@ -62,10 +231,27 @@ class Group(object):
                     q = f.build_filters(key)
                 else:
                     q |= f.build_filters(key)
-            return query.filter(q)
+            return [q]
 
         raise TypeError('Unknown query joiner: %s' % self.query_joiner)
 
+    def apply_filters(self, request, query, filter_keys):
+        """Apply filters to given `query`. `filter_keys` list may contain keys
+        that do not belong to current filter group.
+        """
+        for q in self.build_queries(request, filter_keys):
+            query = query.filter(q)
+        return query
+
+    def facet_counts(self, request, query):
+        """Return a dict of numbers of `query` objects matching each choice
+        of the group's filters, by filter key, counted in one query.
+        """
+        choices = []
+        for f in self.filter_index(request).filters:
+            choices.extend(f.facets())
+        return count_facets(query, choices)
+
 
 class BaseFilter(object):
     def affected_by(self, key):
@@ -74,6 +260,12 @@ class BaseFilter(object):
     def build_filters(self, raw_key):
         raise NotImplementedError
 
+    def facets(self):
+        """Return a list of `(key, q)` pairs of choices whose objects are
+        counted by facets. Filters of free-form values have none.
+        """
+        return []
+
     def to_raw_field(self):
         """
         Return value will be available in the JS filter code
@@ -113,6 +305,9 @@ class Filter(BaseFilter):
         """
         return self.query or Q(**self.filters)
 
+    def facets(self):
+        return [(self.key, self.build_filters(self.key))]
+
     def to_raw_field(self):
         return {
             'key': self.key,
@@ -148,11 +343,34 @@ class RadioNoFilterField(RadioFilterField):
     def group_key(self):
         return self.key
 
+    def facets(self):
+        return [(self.key, Q())]
+
+
+class PrefixKeyFilter(BaseFilter):
+    """Filter affected by keys starting with its ``key`` and a colon. The
+    rest of the key holds the filter values.
+    """
+    def affected_by(self, key):
+        return key.split(':', 1)[0] == self.key
+
 
 class DynamicFilter(object):
     def filter_fields(self, request):
         raise NotImplementedError
 
+    def is_static(self):
+        """Return whether the filters don't depend on the request nor any
+        data, so they can be built once.
+        """
+        return False
+
+    def source_models(self):
+        """Return models whose data the filters are built from. Cached
+        schemas listing the filters are rebuilt when they change.
+        """
+        return ()
+
 
 class ChoicesFilter(DynamicFilter):
     def __init__(self, choices, filter_attr):
@@ -163,6 +381,11 @@ class ChoicesFilter(DynamicFilter):
         for query_value, name in self.choices:
             yield Filter(name, **{self.filter_attr: query_value})
 
+    def is_static(self):
+        # Other iterables (eg. querysets) may change and must not be read
+        # when the filter is defined.
+        return isinstance(self.choices, (list, tuple))
+
 
 class RadioFilter(DynamicFilter):
     def __init__(self, choices, filter_attr, no_filter=None):
@@ -177,45 +400,77 @@ class RadioFilter(DynamicFilter):
             f = {self.filter_attr: query_value}
             yield RadioFilterField(name, **f)
 
+    def is_static(self):
+        return isinstance(self.choices, (list, tuple))
+
 
 class QueryFilter(DynamicFilter):
-    def __init__(self, query, filter_attr):
+    def __init__(self, query, filter_attr, cache=None):
+        """Initialize the filter.
+
+        :param query: a queryset (or any iterable) of ``(value, name)`` pairs
+        :param filter_attr: the lookup filtered by the values
+        :param cache: (optional) ``CachePolicy`` of the choices, which are
+            read on every use by default
+        """
         self._query = query
         self.filter_attr = filter_attr
+        self.cache = cache
 
     @property
     def query(self):
-        # hope this would help us to avoid query cache
+        # Querysets must be cloned: copying them evaluates the original,
+        # whose result cache would be served forever.
+        if hasattr(self._query, 'all'):
+            return self._query.all()
         return copy.copy(self._query)
 
+    def choices(self):
+        if self.cache is None:
+            return self.query
+        query = getattr(self._query, 'query', None)
+        key = ('choices', self.filter_attr,
+               unicode(query) if query is not None else repr(self._query))
+        return self.cache.get(key, lambda: list(self.query),
+                              self.source_models())
+
     def filter_fields(self, request):
-        for key, name in self.query:
+        for key, name in self.choices():
             yield Filter(name, **{self.filter_attr: key})
 
+    def source_models(self):
+        model = getattr(self._query, 'model', None)
+        return (model,) if model is not None else ()
+
+
+class FullTextSearch(PrefixKeyFilter):
+    """Search the text given in the key in ``filters`` lookups.
 
-class FullTextSearch(BaseFilter):
+    The search is done by the ``backend`` keyword argument, a
+    ``tenclouds.crud.search.SearchBackend``, ``QSearch`` by default.
+    """
     field_type = 'text'
 
-    def __init__(self, key, *filters):
+    def __init__(self, key, *filters, **kwargs):
         self.key = key
         self.filters = filters
         self.name = None
-
-    def affected_by(self, key):
-        try:
-            return key.split(':', 1)[0] == self.key
-        except IndexError:
-            return False
+        self.backend = kwargs.get('backend') or QSearch()
 
     def build_filters(self, raw_key):
-        q = None
         value = raw_key.split(':', 1)[1]
-        for f in self.filters:
-            if q is None:
-                q = Q(**{f: value})
-            else:
-                q |= Q(**{f: value})
-        return q
+        return self.backend.build_filters(self.filters, value)
+
+    def rank(self, raw_key):
+        """Return ``(sql, params)`` ranking matches of the search, or
+        ``None`` if the backend can't rank them.
+        """
+        return self.backend.rank(self.filters, raw_key.split(':', 1)[1])
+
+    def install(self, using=None):
+        """Create the search index of the backend."""
+        fields = self.backend.split_lookups(self.filters)[0]
+        self.backend.install(fields, using=using)
 
     def to_raw_field(self):
         return {
@@ -225,6 +480,17 @@ class FullTextSearch(BaseFilter):
         }
 
 
+class AliasedFilter(Filter):
+    """Filter with an explicit ``key``, built by ``AliasFilter``."""
+
+    def __init__(self, name, key, query=None):
+        self.alias_key = key
+        super(AliasedFilter, self).__init__(name, query=query)
+
+    def build_key(self):
+        return self.alias_key
+
+
 class AliasFilter(DynamicFilter):
     """A filter that consists of filter "aliases", to hide internal DB
     structure, or to simplify join queries.
@@ -242,10 +508,15 @@ class AliasFilter(DynamicFilter):
     Such defined filter may be used now in this way:
         ``http://some.api.url?filters=param_name:param_value1``
 
+    Q objects returned by the callables can be reused according to the
+    ``cache`` policy (see ``CachePolicy``), in which case they must not
+    depend on the request. Models to ``invalidate`` on must be listed.
+
     TODO make it more flexible?
     """
-    def __init__(self, aliases):
+    def __init__(self, aliases, cache=None):
         self.aliases = aliases
+        self.cache = cache
 
     def filter_fields(self, request):
         """Will yield new Filter objects basing on aliases config"""
@@ -254,20 +525,39 @@ class AliasFilter(DynamicFilter):
             for alias, query in values.iteritems():
                 # determine whether "query" is a callable or not
                 if callable(query) and request is not None:
-                    q = query(request)
+                    q = self.resolve(name, alias, query, request)
                 else:
                     q = query
 
-                # define Filter classes on the fly: make them "respond"
-                # to param_name:param_value queries.
-                class F(Filter):
-                    def build_key(self):
-                        return "{0}:{1}".format(name, alias)
-
-                yield F(alias, query=q)
+                # make the filters "respond" to param_name:param_value queries
+                yield AliasedFilter(alias, "{0}:{1}".format(name, alias),
+                                    query=q)
 
-
-class MultiSelectFilter(BaseFilter):
+    def resolve(self, name, alias, query, request):
+        """Return Q returned by the ``query`` callable, or a copy of its
+        cached result (Q objects are combined in place, they mustn't be
+        shared between requests).
+        """
+        if self.cache is None:
+            return query(request)
+        query_name = getattr(query, '__name__', None)
+        if query_name is not None:
+            query_key = (getattr(query, '__module__', None), query_name)
+        elif not self.cache.shared:
+            # Callables without a name (eg. partials) are told apart by
+            # their identity, which only holds in this process.
+            query_key = id(query)
+        else:
+            return query(request)
+        key = ('alias', name, alias, query_key)
+        return copy.deepcopy(self.cache.get(key, lambda: query(request)))
+
+    def is_static(self):
+        return not any(callable(query) for values in self.aliases.itervalues()
+                       for query in values.itervalues())
+
+
+class MultiSelectFilter(PrefixKeyFilter):
     field_type = 'multiselect'
 
     def __init__(self, choices, key, join='and'):
@@ -278,12 +568,6 @@ class MultiSelectFilter(BaseFilter):
             raise ValueError('Wrong join parameter %s' % join)
         self.join = join
 
-    def affected_by(self, key):
-        try:
-            return key.split(':', 1)[0] == self.key
-        except IndexError:
-            return False
-
     def build_filters(self, raw_key):
         q = None
         values = raw_key.split(':')[1:]
@@ -305,3 +589,7 @@ class MultiSelectFilter(BaseFilter):
             'type': self.field_type,
             'choices': self.choices,
         }
+
+    def facets(self):
+        return [('%s:%s' % (self.key, value), Q(**{self.key: value}))
+                for value, name in self.choices]
@@ -0,0 +1,156 @@
+"""Normalization of Q objects built by CRUD filters.
+
+Filters are combined naively: ``MultiSelectFilter`` and "or" groups OR one
+equality per value, search filters OR the same lookups over and over.
+``optimize`` rewrites a Q object into an equivalent, smaller one:
+
+    * nested nodes with the same connector (and single child nodes) are
+      flattened into their parent,
+    * repeated children are dropped, as are empty nodes,
+    * ORed equalities on the same field become one ``__in`` lookup.
+
+For example ``Q(a=1) | (Q(a=2) | Q(a=1)) | Q(b=3)`` becomes
+``Q(a__in=[1, 2]) | Q(b=3)``.
+"""
+from django.db.models import Q
+from django.db.models.expressions import ExpressionNode
+
+
+def _value_key(value):
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_value_key(v) for v in value))
+    try:
+        hash(value)
+    except TypeError:
+        return (type(value), id(value))
+    return (type(value), value)
+
+
+def child_key(child):
+    """Return hashable key identifying a child of a Q object."""
+    if isinstance(child, Q):
+        return ('Q', child.connector, child.negated,
+                tuple(child_key(c) for c in child.children))
+    lookup, value = child
+    return (lookup, _value_key(value))
+
+
+def lookups(q):
+    """Yield the lookups used by ``q``."""
+    for child in q.children:
+        if isinstance(child, Q):
+            for lookup in lookups(child):
+                yield lookup
+        else:
+            yield child[0]
+
+
+def _is_scalar(value):
+    if value is None or isinstance(value, (list, tuple, set, dict, Q,
+                                           ExpressionNode)):
+        return False
+    if hasattr(value, 'query') or hasattr(value, 'as_sql') or \
+            hasattr(value, 'evaluate') or \
+            hasattr(value, 'resolve_expression'):
+        # Querysets and expressions (F() is hashable), which can't be
+        # values of an ``__in`` lookup.
+        return False
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _in_values(child):
+    """Return ``(field_lookup, values)`` if ``child`` is an equality or an
+    ``__in`` lookup of plain values, otherwise ``None``.
+    """
+    if isinstance(child, Q):
+        return None
+    lookup, value = child
+    if lookup.endswith('__in'):
+        if not isinstance(value, (list, tuple)) or \
+                not all(_is_scalar(v) for v in value):
+            return None
+        return lookup[:-len('__in')], list(value)
+    if lookup.endswith('__exact'):
+        lookup = lookup[:-len('__exact')]
+    elif '__' in lookup:
+        # Possibly another lookup type on a related field.
+        return None
+    if not _is_scalar(value):
+        return None
+    return lookup, [value]
+
+
+def _merge_in(children):
+    """Replace ORed equalities on the same field with ``__in`` lookups, at
+    the position of the first one.
+    """
+    values = {}
+    counts = {}
+    for child in children:
+        found = _in_values(child)
+        if found is not None:
+            field, field_values = found
+            values.setdefault(field, []).extend(field_values)
+            counts[field] = counts.get(field, 0) + 1
+
+    merged = []
+    done = set()
+    for child in children:
+        found = _in_values(child)
+        if found is None or counts[found[0]] < 2:
+            merged.append(child)
+            continue
+        field = found[0]
+        if field in done:
+            continue
+        done.add(field)
+        distinct = []
+        seen = set()
+        for value in values[field]:
+            key = _value_key(value)
+            if key not in seen:
+                seen.add(key)
+                distinct.append(value)
+        merged.append(('%s__in' % field, distinct))
+    return merged
+
+
+def make_q(children, connector=Q.AND, negated=False):
+    q = Q(*children)
+    q.connector = connector
+    q.negated = negated
+    return q
+
+
+def optimize(q):
+    """Return a normalized copy of ``q``, see the module docs."""
+    children = []
+    for child in q.children:
+        if isinstance(child, Q):
+            child = optimize(child)
+            if not child.children:
+                continue
+            if not child.negated and (child.connector == q.connector or
+                                      len(child.children) == 1):
+                children.extend(child.children)
+                continue
+        children.append(child)
+
+    distinct = []
+    seen = set()
+    for child in children:
+        key = child_key(child)
+        if key not in seen:
+            seen.add(key)
+            distinct.append(child)
+
+    if q.connector == Q.OR:
+        distinct = _merge_in(distinct)
+
+    if len(distinct) == 1 and isinstance(distinct[0], Q) and not q.negated:
+        return distinct[0]
+    return make_q(distinct, q.connector, q.negated)
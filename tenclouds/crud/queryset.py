@@ -1,4 +1,4 @@
-import types
+from itertools import islice
 
 
 class QuerySetAdapter(object):
@@ -13,10 +13,18 @@ class QuerySetAdapter(object):
 
     What works:
         - iteration
-        - ``count()`` / ``len()``
+        - ``count()`` / ``len()``, the count is computed once
+        - slicing and indexing, so it can be paginated
+
+    Slices are lazy. If the iterable supports slicing itself (eg. it's a
+    list, a queryset or an object running a query with ``LIMIT`` in its
+    ``__getitem__``), the slice is passed to it. Otherwise the elements
+    before the slice are skipped and the ones in it taken as they are
+    iterated, so a page of a generator costs reading up to its end only.
 
     What's to do:
-        - ``filter()``, ``exclude()``
+        - ``filter()``, ``exclude()``, see ``tenclouds.crud.dataset`` for
+          records kept in memory
         - possibly, other things.
     """
 
@@ -29,10 +37,13 @@ class QuerySetAdapter(object):
         """
         self.iterable = iterable
 
-        if type(count_or_func) == types.FunctionType:
+        if callable(count_or_func):
             self.count_func = count_or_func
+            self._count = None
         else:
-            self.count_func = lambda: count_or_func
+            self.count_func = None
+            self._count = count_or_func
+        self._extra = extra
 
         for k, v in extra.iteritems():
             setattr(self, k, v)
@@ -44,4 +55,38 @@ class QuerySetAdapter(object):
         return self.count()
 
     def count(self):
-        return self.count_func()
+        if self._count is None:
+            self._count = self.count_func()
+        return self._count
+
+    def slice_source(self, start, stop, step=None):
+        """Return lazy slice of the iterable, pushed down to the iterable if
+        it supports slicing.
+        """
+        source = self.iterable
+        if hasattr(source, '__getitem__') and not isinstance(source, dict):
+            return source[start:stop:step]
+        return islice(source, start, stop, step)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.start or 0, k.stop, k.step
+            if start < 0 or (stop is not None and stop < 0):
+                raise ValueError('Negative indexing is not supported.')
+
+            def count():
+                total = max(self.count() - start, 0)
+                if stop is not None:
+                    total = min(total, max(stop - start, 0))
+                if step:
+                    total = (total + step - 1) // step
+                return total
+
+            return QuerySetAdapter(self.slice_source(start, stop, step), count,
+                                   **self._extra)
+
+        if k < 0:
+            raise ValueError('Negative indexing is not supported.')
+        for item in self.slice_source(k, k + 1):
+            return item
+        raise IndexError('QuerySetAdapter index out of range')
@@ -1,9 +1,13 @@
+import hashlib
+import json
+
 from tastypie.authorization import Authorization
 from tastypie.cache import SimpleCache
 from tastypie.exceptions import ImmediateHttpResponse
 from tastypie import http
 from tastypie import resources
 from tastypie.utils import trailing_slash
+from tastypie.utils.mime import build_content_type
 
 try:
     from django.conf.urls.defaults import url
@@ -11,10 +15,40 @@ except ImportError:
     # Django 1.6+
     from django.conf.urls import url
 
-from django.http import QueryDict
+from django.db.models.fields import FieldDoesNotExist
+from django.http import HttpResponse, QueryDict
 
 from tenclouds.crud import fields
+from tenclouds.crud.compact import compact_objects
+from tenclouds.crud.dehydration import (DehydrationPlan, Projection,
+                                        is_builtin, used_in_lists)
+from tenclouds.crud.generations import (bump_counter, generation_key,
+                                        get_counters, get_generations,
+                                        track_models)
+from tenclouds.crud.http import (HttpJson, conditional_response, etag_matches,
+                                 not_modified)
 from tenclouds.crud.paginator import Paginator
+from tenclouds.crud.qtree import child_key, lookups, make_q, optimize
+from tenclouds.crud.selections import load_selection, pk_query, store_selection
+from tenclouds.crud.status import (MAX_KEYS, get_status, get_statuses,
+                                   is_status_key, status_events)
+from tenclouds.crud.streaming import stream_page, streaming_response
+
+
+# Schemas built in this process, by resource class: (version, schema).
+_schemas = {}
+
+# Pseudo field ordering searched lists by the rank of matches.
+SEARCH_RANK = 'search_rank'
+
+
+def getlist(options, key):
+    if hasattr(options, 'getlist'):
+        return options.getlist(key)
+    values = options.get(key, [])
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    return list(values)
 
 
 class Actions(object):
@@ -27,6 +61,64 @@ class Actions(object):
         return self.mapping[codename]
 
 
+def follow_relations(model, attribute):
+    """Yield ``(name, related_model, multi_valued)`` for each relation
+    crossed by the ``attribute`` lookup on ``model``. ``multi_valued`` tells
+    whether the lookup has crossed a multi-valued relation so far.
+    """
+    multi_valued = False
+    for name in attribute.split('__'):
+        try:
+            field, _, direct, m2m = model._meta.get_field_by_name(name)
+        except FieldDoesNotExist:
+            return
+        if direct and m2m:
+            related_model = field.rel.to
+            multi_valued = True
+        elif direct and field.rel:
+            related_model = field.rel.to
+        elif not direct:
+            # Reverse relation, single-valued only for one-to-one fields.
+            related_model = field.model
+            if not field.field.unique:
+                multi_valued = True
+        else:
+            return
+
+        yield name, related_model, multi_valued
+        model = related_model
+
+
+def crosses_multi_valued(model, attribute):
+    """Return whether the ``attribute`` lookup on ``model`` crosses a
+    multi-valued relation.
+    """
+    multi_valued = False
+    for _, _, multi_valued in follow_relations(model, attribute):
+        pass
+    return multi_valued
+
+
+def related_paths(model, attribute):
+    """Return ``(select_related, prefetch_related)`` paths of relations
+    crossed by the ``attribute`` lookup on ``model``. Each path is ``None`` if
+    there's nothing to fetch that way.
+
+    Single-valued relations are selected with a join, until the lookup
+    crosses a multi-valued relation. Then the whole path is prefetched.
+    """
+    path = []
+    select_path = None
+    multi_valued = False
+    for name, _, multi_valued in follow_relations(model, attribute):
+        path.append(name)
+        if not multi_valued:
+            select_path = '__'.join(path)
+
+    prefetch_path = '__'.join(path) if multi_valued else None
+    return select_path, prefetch_path
+
+
 class ModelDeclarativeMetaclass(resources.ModelDeclarativeMetaclass):
 
     def __new__(cls, name, bases, attrs):
@@ -47,6 +139,22 @@ class ModelDeclarativeMetaclass(resources.ModelDeclarativeMetaclass):
             new_class._meta.static_data = {}
         if not hasattr(new_class._meta, 'per_page'):
             new_class._meta.per_page = None
+        if not hasattr(new_class._meta, 'count_strategy'):
+            new_class._meta.count_strategy = None
+        if not hasattr(new_class._meta, 'concurrent_count'):
+            new_class._meta.concurrent_count = False
+        if not hasattr(new_class._meta, 'projection'):
+            new_class._meta.projection = False
+        if not hasattr(new_class._meta, 'stream_list'):
+            new_class._meta.stream_list = False
+        if not hasattr(new_class._meta, 'stream_chunk_size'):
+            new_class._meta.stream_chunk_size = 100
+        if not hasattr(new_class._meta, 'cache_list'):
+            new_class._meta.cache_list = False
+        if not hasattr(new_class._meta, 'track_changes'):
+            new_class._meta.track_changes = new_class._meta.cache_list
+        if not hasattr(new_class._meta, 'cache_schema'):
+            new_class._meta.cache_schema = None
         # we have to replace some meta fields which were set in  super __new__
         # as default when they were not defined in Meta subclass
         opts = getattr(new_class, 'Meta', None)
@@ -58,12 +166,56 @@ class ModelDeclarativeMetaclass(resources.ModelDeclarativeMetaclass):
         if 'cache' not in opts_dir:
             new_class._meta.cache = SimpleCache()
 
+        # Find relations followed by the fields, so that lists can fetch the
+        # related objects along with the page instead of once per object.
+        select_related = list(getattr(new_class._meta, 'select_related', ()))
+        prefetch_related = list(getattr(new_class._meta, 'prefetch_related', ()))
+        model = new_class._meta.object_class
+        if getattr(new_class._meta, 'infer_related', True) and model is not None:
+            for field in new_class.base_fields.values():
+                attribute = getattr(field, 'attribute', None)
+                if not isinstance(attribute, basestring) or \
+                        not used_in_lists(field):
+                    continue
+                select_path, prefetch_path = related_paths(model, attribute)
+                if select_path and select_path not in select_related:
+                    select_related.append(select_path)
+                if prefetch_path and prefetch_path not in prefetch_related:
+                    prefetch_related.append(prefetch_path)
+        new_class._meta.select_related = select_related
+        new_class._meta.prefetch_related = prefetch_related
+
+        # Models read by lists, whose changes invalidate cached lists.
+        list_models = []
+        if model is not None:
+            list_models.append(model)
+            for path in select_related + prefetch_related:
+                for _, related_model, _ in follow_relations(model, path):
+                    if related_model not in list_models:
+                        list_models.append(related_model)
+        new_class._meta.list_models = list_models
+        if new_class._meta.track_changes:
+            track_models(list_models)
+
+        # Models the filters are built from, whose changes invalidate
+        # cached schemas.
+        schema_models = []
+        for group in new_class._meta.filters:
+            for source_model in group.source_models():
+                if source_model not in schema_models:
+                    schema_models.append(source_model)
+        new_class._meta.schema_models = schema_models
+        new_class._meta.schema_signature = None
+        track_models(schema_models)
+
         # Set up the fields with url values
         for name, field in new_class.base_fields.items():
             if not field.url:
                 continue
             new_class.base_fields[field.url] = fields.CharField(readonly=True)
 
+        new_class._meta.dehydration_plan = DehydrationPlan(new_class)
+
         return new_class
 
     def __init__(cls, name, bases, dt):
@@ -79,6 +231,8 @@ class ModelDeclarativeMetaclass(resources.ModelDeclarativeMetaclass):
             }
             if attr.action_handler.input_form:
                 action_info['form'] = str(attr.action_handler.input_form().as_p())
+            if attr.action_handler.chunked:
+                action_info['chunked'] = True
             if attr.action_handler.public:
                 actions.public.append(action_info)
             else:
@@ -105,6 +259,8 @@ class ModelResource(resources.ModelResource):
 
     def __init__(self, api_name=None):
         super(ModelResource, self).__init__(api_name)
+        self._bound_dehydration_plan = None
+        self._projection = None
 
     def get_ordering(self, request):
         """Adds default ``order_by`` if the key is not present in the query
@@ -121,11 +277,7 @@ class ModelResource(resources.ModelResource):
         names.
 
         """
-        fmap = {}
-        for api_field, field in self.fields.items():
-            if hasattr(field, 'attribute'):
-                fmap[field.attribute] = api_field
-        return fmap
+        return self._meta.dehydration_plan.model_to_api
 
     def get_ordering_in_api_names(self, objects):
         """Returns queryset ordering arguments mapped to api fieldsOrder.
@@ -138,14 +290,121 @@ class ModelResource(resources.ModelResource):
         # get model_field: api_field mapping
         mp = self.get_model_fields_to_api_fields_map()
         mapped = []
-        for f in objects.query.order_by:
+        if hasattr(objects, 'query'):
+            ordering = objects.query.order_by
+        else:
+            # Eg. ``tenclouds.crud.dataset.DatasetQuerySet``.
+            ordering = getattr(objects, 'ordering', ())
+        for f in ordering:
+            if f.lstrip('-') == SEARCH_RANK:
+                # Ordered descending by the rank for the client's
+                # ``search_rank`` (best first), see ``apply_sorting``.
+                mapped.append(f[1:] if f.startswith('-') else '-' + f)
             # mind the '-' modifier
-            if f.startswith('-'):
-                mapped.append('-{}'.format(mp[f[1:]]))
+            elif f.startswith('-'):
+                mapped.append('-{}'.format(mp.get(f[1:], f[1:])))
             else:
-                mapped.append(mp[f])
+                mapped.append(mp.get(f, f))
         return mapped
 
+    def apply_sorting(self, obj_list, options=None):
+        """
+        Applies the ``order_by`` option, which besides fields may have the
+        ``search_rank`` pseudo field: the rank of matches of the active
+        ``FullTextSearch`` filter, best first (``-search_rank`` reverses it).
+        It's ignored if the list isn't searched or the search backend can't
+        rank.
+        """
+        order_bits = getlist(options or {}, 'order_by')
+        ranked = [bit for bit in order_bits if bit.lstrip('-') == SEARCH_RANK]
+        if not ranked or not hasattr(obj_list, 'extra'):
+            return super(ModelResource, self).apply_sorting(obj_list, options)
+
+        options = dict((key, getlist(options, key)) for key in options)
+        options['order_by'] = [bit for bit in order_bits if bit not in ranked]
+        if not options['order_by']:
+            del options['order_by']
+        obj_list = super(ModelResource, self).apply_sorting(obj_list, options)
+
+        rank = self.search_rank(options)
+        if rank is None:
+            return obj_list
+        sql, params = rank
+        obj_list = obj_list.extra(select={SEARCH_RANK: sql},
+                                  select_params=params)
+        ordering = '-' + SEARCH_RANK if ranked[0] == SEARCH_RANK else SEARCH_RANK
+        return obj_list.order_by(ordering, *obj_list.query.order_by)
+
+    def search_rank(self, options):
+        """
+        Returns ``(sql, params)`` ranking matches of the first
+        ``FullTextSearch`` filter in ``options``, or ``None``.
+        """
+        keys = getlist(options, 'filters')
+        for group in self._meta.filters:
+            index = group.filter_index(None)
+            for key in keys:
+                f = index.get(key)
+                if f is not None and hasattr(f, 'rank'):
+                    return f.rank(key)
+        return None
+
+    def obj_get_list(self, bundle, **kwargs):
+        """
+        Fetches the list of objects, selecting and prefetching the related
+        objects needed by the fields.
+
+        The relations are worked out from fields' attributes when the class
+        is created. Set ``infer_related = False`` in Meta to disable it, and
+        ``select_related`` or ``prefetch_related`` to add more paths.
+        """
+        objects = super(ModelResource, self).obj_get_list(bundle=bundle, **kwargs)
+        return self.apply_related(objects)
+
+    def apply_related(self, objects):
+        if self._meta.select_related and hasattr(objects, 'select_related'):
+            objects = objects.select_related(*self._meta.select_related)
+        if self._meta.prefetch_related and hasattr(objects, 'prefetch_related'):
+            objects = objects.prefetch_related(*self._meta.prefetch_related)
+        return objects
+
+    def get_projection(self):
+        """
+        Returns the ``Projection`` used to fetch and dehydrate list pages when
+        ``projection`` is enabled in Meta, or ``None`` if the list should
+        be dehydrated the regular way.
+
+        Projected pages have only the columns backing the fields fetched
+        from the database. Unless some fields have custom ``dehydrate_*``
+        methods, the objects passed to ``alter_list_data_to_serialize`` are
+        plain dicts instead of bundles.
+        """
+        if not self._meta.projection:
+            return None
+        plan = self.get_dehydration_plan()
+        if plan is None:
+            return None
+        if self._projection is None:
+            self._projection = Projection(plan)
+        if not self._projection.projectable:
+            return None
+        return self._projection
+
+    def get_dehydration_plan(self):
+        """
+        Returns the class' ``DehydrationPlan`` bound to this resource, used
+        to dehydrate list pages in a tight loop. Returns ``None`` if
+        ``build_bundle`` or ``full_dehydrate`` are overridden, so lists must
+        be dehydrated by calling them.
+        """
+        if not (is_builtin(self.build_bundle, resources.Resource.build_bundle)
+                and is_builtin(self.full_dehydrate,
+                               resources.Resource.full_dehydrate)):
+            return None
+        if self._bound_dehydration_plan is None:
+            self._bound_dehydration_plan = self._meta.dehydration_plan.bind(self)
+        return self._bound_dehydration_plan
+
     def get_list(self, request, **kwargs):
         """
         Returns a serialized list of resources.
@@ -155,26 +414,232 @@ class ModelResource(resources.ModelResource):
 
         Should return a HttpResponse (200 OK).
         """
-        # TODO: Uncached for now. Invalidation that works for everyone may be
-        #       impossible.
+        digest = self.get_list_digest(request, **kwargs)
+        etag = None
+        if digest is not None:
+            # Nothing read by the list has changed if the digest is the same,
+            # so the client can be told so before running any query.
+            etag = '"%s"' % digest
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+        cache_key = self.get_list_cache_key(request, digest)
+        if cache_key is not None:
+            cached = self._meta.cache.get(cache_key)
+            if cached is not None:
+                content, content_type = cached
+                return conditional_response(
+                    request, HttpResponse(content, content_type=content_type),
+                    etag)
+
         bundle = self.build_bundle(request=request)
         objects = self.obj_get_list(bundle=bundle, **self.remove_api_resource_names(kwargs))
 
         sorting_params = self.get_ordering(request)
         sorted_objects = self.apply_sorting(objects, options=sorting_params)
 
-        paginator = self._meta.paginator_class(request.GET, sorted_objects,
+        projection = None
+        paged_objects = sorted_objects
+        if hasattr(sorted_objects, 'query'):
+            projection = self.get_projection()
+            if projection is not None:
+                paged_objects = projection.restrict(sorted_objects)
+
+        paginator_kwargs = {}
+        if issubclass(self._meta.paginator_class, Paginator):
+            # Custom paginators not based on ours may not take these.
+            paginator_kwargs = {
+                'count_strategy': self._meta.count_strategy,
+                'concurrent': self._meta.concurrent_count,
+            }
+        paginator = self._meta.paginator_class(request.GET, paged_objects,
                                                resource_uri=self.get_resource_uri(),
-                                               per_page=self._meta.per_page)
+                                               per_page=self._meta.per_page,
+                                               **paginator_kwargs)
+        facets = None
+        if self.should_count_facets(request):
+            facets = self.get_facets(bundle, **kwargs)
+
+        if self.should_stream_list(request):
+            to_be_serialized = paginator.stream_page()
+            to_be_serialized['ordering'] = self.get_ordering_in_api_names(
+                sorted_objects)
+            if facets is not None:
+                to_be_serialized['facets'] = facets
+            response = self.create_streaming_response(
+                request, to_be_serialized, projection)
+            if etag is not None:
+                response['ETag'] = etag
+            return response
+
         to_be_serialized = paginator.page()
         to_be_serialized['ordering'] = self.get_ordering_in_api_names(
             sorted_objects)
+        if facets is not None:
+            to_be_serialized['facets'] = facets
 
         # Dehydrate the bundles in preparation for serialization.
-        bundles = [self.build_bundle(obj=obj, request=request) for obj in to_be_serialized['objects']]
-        to_be_serialized['objects'] = [self.full_dehydrate(bundle) for bundle in bundles]
+        to_be_serialized['objects'] = self.dehydrate_objects(
+            to_be_serialized['objects'], request, projection)
         to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
-        return self.create_response(request, to_be_serialized)
+        if self.should_compact_list(request):
+            to_be_serialized = self.compact_list_data(
+                to_be_serialized,
+                dictionary=request.GET.get('compact') == 'dict')
+        response = self.create_response(request, to_be_serialized)
+        if cache_key is not None:
+            self._meta.cache.set(cache_key,
+                                 (response.content, response['Content-Type']))
+        return conditional_response(request, response, etag)
+
+    def should_count_facets(self, request):
+        """
+        Returns whether the list should have ``facets``, requested with the
+        ``facets`` parameter.
+        """
+        facets = request.GET.get('facets')
+        return bool(facets) and facets not in ('0', 'n', 'false')
+
+    def get_facets(self, bundle, **kwargs):
+        """
+        Returns the facets of the list: for each filter group, the numbers of
+        objects matching its filters' choices, by filter key.
+
+        The numbers are counted under the filters selected in the other
+        groups. Filters selected in the group itself narrow its counts only if
+        the group joins them with "and"; choices of "or" groups add to the
+        list. Each group's counts are read in one query, see
+        ``tenclouds.crud.facets``.
+        """
+        request = bundle.request
+        filters = request.GET.copy()
+        filters.update(self.remove_api_resource_names(kwargs))
+        orm_filters, crud_filters = self.build_filters(filters=filters)
+        objects = super(ModelResource, self).apply_filters(request, orm_filters)
+        objects = self.authorized_read_list(objects, bundle)
+
+        facets = []
+        for group in self._meta.filters:
+            queries = []
+            for other in self._meta.filters:
+                if other is not group or group.query_joiner == 'and':
+                    queries.extend(other.build_queries(request, crud_filters))
+            query = self.apply_queries(objects, queries)
+            facets.append({
+                'title': group.name,
+                'counts': group.facet_counts(request, query),
+            })
+        return facets
+
+    def get_list_digest(self, request, **kwargs):
+        """
+        Returns a digest identifying the list response, or ``None`` if
+        changes to the models read by the list are not tracked (enable
+        ``track_changes`` or ``cache_list`` in Meta).
+
+        The digest is built from the query parameters (filters, ordering,
+        page etc.), the format, the user and the generations of models read
+        by the list, so it changes whenever the response could.
+        The generations are kept in the default cache, which must be
+        shared between processes (not the local memory one), otherwise
+        writes handled by other processes go unnoticed, see
+        ``tenclouds.crud.generations``.
+        """
+        if not self._meta.track_changes:
+            return None
+
+        params = sorted((key, sorted(request.GET.getlist(key)))
+                        for key in request.GET if key != '_')
+        user = getattr(request, 'user', None)
+        key = repr((params, sorted(kwargs.items()),
+                    self.determine_format(request),
+                    self.should_stream_list(request),
+                    getattr(user, 'pk', None),
+                    get_generations(self._meta.list_models)))
+        return hashlib.md5(key).hexdigest()
+
+    def get_list_cache_key(self, request, digest):
+        """
+        Returns the key under which the list response with given ``digest``
+        is cached in Meta ``cache``, or ``None`` if it should not be cached.
+
+        Lists are cached when ``cache_list`` is enabled in Meta, except the
+        streamed ones. Like Meta ``cache``, the default cache holding the
+        generations must be shared between processes.
+        """
+        if digest is None or not self._meta.cache_list or \
+                self.should_stream_list(request):
+            return None
+        return self.generate_cache_key('list', digest)
+
+    def dehydrate_objects(self, objects, request, projection=None):
+        """
+        Returns list page ``objects`` dehydrated with the ``projection`` (if
+        the objects were fetched through it), the dehydration plan or by
+        ``full_dehydrate``.
+        """
+        if projection is not None:
+            return projection.dehydrate_page(objects, request)
+        plan = self.get_dehydration_plan()
+        if plan is not None:
+            return plan.dehydrate_page(objects, request)
+        bundles = [self.build_bundle(obj=obj, request=request) for obj in objects]
+        return [self.full_dehydrate(bundle) for bundle in bundles]
+
+    def compact_list_data(self, data, dictionary=False):
+        """
+        Returns the page ``data`` with ``objects`` replaced by compact
+        ``fieldsOrder`` and ``rows`` (and ``dictionaries`` if
+        ``dictionary`` is set). See ``tenclouds.crud.compact``.
+        """
+        serializer = self._meta.serializer
+        objects = [serializer.to_simple(obj, {}) for obj in data.pop('objects')]
+        fields_order, rows, dictionaries = compact_objects(objects, dictionary)
+        data['fieldsOrder'] = fields_order
+        data['rows'] = rows
+        if dictionaries:
+            data['dictionaries'] = dictionaries
+        return data
+
+    def should_compact_list(self, request):
+        """
+        Returns whether the compact encoding of the list is requested with
+        the ``compact`` parameter (``dict`` also asks for dictionaries).
+        """
+        compact = request.GET.get('compact')
+        return bool(compact) and compact not in ('0', 'n', 'false')
+
+    def should_stream_list(self, request):
+        """
+        Returns whether the list should be streamed: ``stream_list`` is
+        enabled in Meta, JSON is requested without the compact encoding and
+        the page data is not altered by ``alter_list_data_to_serialize``,
+        which needs the whole page.
+        """
+        if not self._meta.stream_list or self.should_compact_list(request):
+            return False
+        if not is_builtin(self.alter_list_data_to_serialize,
+                          resources.Resource.alter_list_data_to_serialize):
+            return False
+        return self.determine_format(request) == 'application/json'
+
+    def create_streaming_response(self, request, data, projection=None):
+        """
+        Returns a response streaming the JSON page ``data``, with objects
+        read, dehydrated and serialized in chunks of ``stream_chunk_size``.
+        """
+        serializer = self._meta.serializer
+
+        def dehydrate(objects):
+            return self.dehydrate_objects(objects, request, projection)
+
+        def to_simple(obj):
+            return serializer.to_simple(obj, {})
+
+        content = stream_page(data, dehydrate, to_simple,
+                              chunk_size=self._meta.stream_chunk_size)
+        return streaming_response(
+            content, build_content_type('application/json'))
 
     def dispatch_actions(self, request, **kwargs):
         """
@@ -182,9 +647,18 @@ class ModelResource(resources.ModelResource):
 
         Get the POST request, deserialize it, check wether the methods
         are allowed and return the action result.
+
+        The action may also be posted by a form, in its JSON ``data`` field,
+        so that the browser handles file downloads.
         """
-        deserialized = self._meta.serializer.deserialize(request.raw_post_data,
-                                                         format='application/json')
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if content_type.startswith(('application/x-www-form-urlencoded',
+                                    'multipart/form-data')) \
+                and 'data' in request.POST:
+            deserialized = json.loads(request.POST['data'])
+        else:
+            deserialized = self._meta.serializer.deserialize(
+                request.raw_post_data, format='application/json')
         action_name = deserialized.get("action", None)
         if not action_name or not self.actions.mapping.get(action_name, None):
             raise ImmediateHttpResponse(response=http.HttpNotImplemented())
@@ -205,7 +679,7 @@ class ModelResource(resources.ModelResource):
         self.method_check(request, allowed=self._meta.allowed_methods)
 
         # Get the action method
-        action = getattr(self, action_name, None)
+        action = getattr(self, self.actions.codename_to_callback(action_name), None)
         if action is None:
             raise ImmediateHttpResponse(response=http.HttpNotImplemented())
 
@@ -224,8 +698,221 @@ class ModelResource(resources.ModelResource):
             url(r"^(?P<resource_name>%s)/_actions%s$" % (self._meta.resource_name, trailing_slash()),
                 self.wrap_view('dispatch_actions'),
                 name="api_dispatch_actions"),
+            url(r"^(?P<resource_name>%s)/_selection%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('register_selection'),
+                name="api_register_selection"),
+            url(r"^(?P<resource_name>%s)/_status%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_action_statuses'),
+                name="api_get_action_statuses"),
+            url(r"^(?P<resource_name>%s)/_status/stream%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('stream_action_statuses'),
+                name="api_stream_action_statuses"),
+            url(r"^(?P<resource_name>%s)/_status/(?P<status_key>[\w-]+)%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_action_status'),
+                name="api_get_action_status"),
         ]
 
+    def register_selection(self, request, **kwargs):
+        """
+        Stores the posted selection and returns its token, see
+        ``tenclouds.crud.selections``.
+
+        The selection is JSON with either ``all`` set, the ``filter`` of the
+        list and optionally the ``exclude`` list of ids, or the ``id__in``
+        list of selected ids.
+        """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        deserialized = self._meta.serializer.deserialize(
+            request.raw_post_data, format='application/json')
+        if not isinstance(deserialized, dict):
+            raise ImmediateHttpResponse(response=http.HttpBadRequest())
+
+        user = getattr(request, 'user', None)
+        selection = {
+            'resource': self._meta.resource_name,
+            'user': getattr(user, 'pk', None),
+            'all': bool(deserialized.get('all')),
+            'filter': deserialized.get('filter') or {},
+            'ids': list(deserialized.get('id__in') or []),
+            'exclude': list(deserialized.get('exclude') or []),
+        }
+        return HttpJson({'selection': store_selection(selection)}, status=201)
+
+    def get_selection_objects(self, request, token):
+        """
+        Returns the objects of the selection stored under ``token``. Responds
+        with ``410 Gone`` if the selection has expired or belongs to another
+        resource or user.
+        """
+        selection = load_selection(token)
+        user = getattr(request, 'user', None)
+        if selection is None or \
+                selection['resource'] != self._meta.resource_name or \
+                selection['user'] != getattr(user, 'pk', None):
+            raise ImmediateHttpResponse(response=http.HttpGone())
+
+        if selection['all']:
+            filters = self.build_filters(selection['filter'])
+            objects = self.apply_filters(request, filters)
+            if selection['exclude']:
+                objects = objects.exclude(
+                    pk_query(selection['exclude'], objects.model))
+            return objects
+        objects = self.get_object_list(request)
+        return objects.filter(pk_query(selection['ids'], objects.model))
+
+    def get_action_status(self, request, status_key, **kwargs):
+        """
+        Returns the progress of an action reported under ``status_key``, see
+        ``tenclouds.crud.status``.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        status = get_status(status_key)
+        if status is None:
+            return http.HttpNotFound()
+        return HttpJson(status)
+
+    def get_status_keys(self, request):
+        """
+        Returns the valid status keys from the ``keys`` parameters, which
+        may hold many keys separated by commas.
+        """
+        keys = []
+        for value in request.GET.getlist('keys'):
+            for key in value.split(','):
+                if is_status_key(key) and key not in keys:
+                    keys.append(key)
+        return keys[:MAX_KEYS]
+
+    def get_action_statuses(self, request, **kwargs):
+        """
+        Returns the ``objects`` list of statuses of the ``keys``, with an
+        ``ETag``, or ``304 Not Modified`` if none has changed.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        statuses = get_statuses(self.get_status_keys(request))
+        return conditional_response(request, HttpJson({'objects': statuses}))
+
+    def stream_action_statuses(self, request, **kwargs):
+        """
+        Returns a stream of server-sent events with the statuses of the
+        ``keys`` as they change, see ``tenclouds.crud.status.status_events``.
+
+        The stream holds a worker for as long as it lasts and is buffered as
+        a whole by Django < 1.5, so the JavaScript client uses it only when
+        ``crud.collection.Messages.useStream`` is set.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        keys = self.get_status_keys(request)
+        if not keys:
+            return http.HttpBadRequest()
+        response = streaming_response(status_events(keys), 'text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def get_schema(self, request, **kwargs):
+        """
+        Returns the serialized schema with an ``ETag`` derived from its
+        version, or ``304 Not Modified`` if the client has it already.
+
+        The schema comes from ``get_cached_schema``, or straight from
+        ``build_schema`` (without an ``ETag``) if it isn't cached, see
+        ``should_cache_schema``.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+        bundle = self.build_bundle(request=request)
+        self.authorized_read_detail(self.get_object_list(bundle.request), bundle)
+
+        if not self.should_cache_schema():
+            return self.create_response(request, self.build_schema())
+
+        version = self.get_schema_version()
+        etag = '"%s"' % hashlib.md5('%s:%s' % (
+            version, self.determine_format(request))).hexdigest()
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response = self.create_response(request, self.get_cached_schema(version))
+        response['ETag'] = etag
+        return response
+
+    def should_cache_schema(self):
+        """
+        Returns whether the schema is cached, as set by the ``cache_schema``
+        Meta option. By default it is, unless ``build_schema`` or
+        ``filter_groups`` is overridden: the version can't tell when the
+        schemas they build change, eg. per request or user.
+        """
+        if self._meta.cache_schema is not None:
+            return self._meta.cache_schema
+        return (is_builtin(self.build_schema, ModelResource.build_schema) and
+                is_builtin(self.filter_groups, ModelResource.filter_groups))
+
+    @classmethod
+    def schema_key(cls):
+        return 'crud:schema:%s.%s' % (cls.__module__, cls.__name__)
+
+    def get_schema_version(self):
+        """
+        Returns the version of the schema, which changes when its definition
+        (fields, filters, actions etc.) or data of the models the filters
+        are built from change, or ``invalidate_schema`` is called.
+        """
+        meta = self._meta
+        if meta.schema_signature is None:
+            # The code can't change while the process runs.
+            static = [self.build_static_schema(),
+                      [group.signature() for group in meta.filters]]
+            meta.schema_signature = hashlib.md5(json.dumps(
+                static, sort_keys=True, default=unicode)).hexdigest()
+        keys = [self.schema_key()]
+        keys.extend(generation_key(model) for model in meta.schema_models)
+        counters = get_counters(keys)
+        return '%s:%s' % (meta.schema_signature,
+                          ':'.join(str(counter) for counter in counters))
+
+    def get_cached_schema(self, version=None):
+        """
+        Returns the schema of given ``version`` (the current one by default)
+        built by ``build_schema``.
+
+        Schemas are built once per resource class and version, kept in the
+        process and shared with other processes through Meta ``cache``.
+        """
+        if version is None:
+            version = self.get_schema_version()
+        key = self.schema_key()
+        cached = _schemas.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        cache_key = '%s:%s' % (key, hashlib.md5(version).hexdigest())
+        schema = self._meta.cache.get(cache_key)
+        if schema is None:
+            schema = self.build_schema()
+            self._meta.cache.set(cache_key, schema)
+        _schemas[key] = (version, schema)
+        return schema
+
+    @classmethod
+    def invalidate_schema(cls):
+        """
+        Makes all processes rebuild the schema of the resource. Call it when
+        data the filter groups are built from changes and the filters can't
+        tell it by their ``source_models``.
+        """
+        bump_counter(cls.schema_key())
+
     def build_schema(self):
         """
         Returns a dictionary of all the fields on the resource and some
@@ -233,12 +920,20 @@ class ModelResource(resources.ModelResource):
 
         Used by the ``schema/`` endpoint to describe what will be available.
         """
+        schema = self.build_static_schema()
+        schema['filterGroups'] = self.filter_groups(None)
+        return schema
 
+    def build_static_schema(self):
+        """
+        Returns the part of the schema which depends on the code only, ie.
+        everything but the filter groups.
+        """
         fields_order = self._meta.fields or self.fields.keys()
 
         fields_title = dict([(name, field.title or name.capitalize())
                              for name, field in self.fields.items()])
-        fields_url = dict([(name, field.url) for name, field in self.fields.items() if field.url])
+        fields_url = self._meta.dehydration_plan.url_fields
 
         return {
             'fieldsOrder': fields_order,
@@ -246,7 +941,6 @@ class ModelResource(resources.ModelResource):
             'fieldsURL': fields_url,
             'fieldsSortable': self._meta.ordering,
             'default_format': self._meta.default_format,
-            'filterGroups': self.filter_groups(None),
             'perPage': self._meta.per_page,
             'actions': self.actions.public,
             'data': self._meta.static_data,
@@ -285,8 +979,43 @@ class ModelResource(resources.ModelResource):
     def apply_filters(self, request, (orm_filters, crud_filters)):
         query = super(ModelResource, self).apply_filters(request, orm_filters)
         if crud_filters:
+            queries = []
             for group in self._meta.filters:
-                query = group.apply_filters(request, query, crud_filters)
+                queries.extend(group.build_queries(request, crud_filters))
+            query = self.apply_queries(query, queries)
+        return query
+
+    def apply_queries(self, query, queries):
+        """
+        Applies Q objects built by CRUD filters to ``query``, normalized by
+        ``tenclouds.crud.qtree.optimize``.
+
+        Every ``filter()`` call joins multi-valued relations anew, so the Q
+        objects crossing them are applied one by one, as they were built.
+        The others are combined and applied with a single call, which
+        gives the same result with fewer joins. Lists which aren't querysets
+        (eg. in-memory datasets) have no joins, all is applied at once.
+        """
+        model = getattr(query, 'model', None)
+        combined = []
+        separate = []
+        seen = set()
+        for q in queries:
+            q = optimize(q)
+            key = child_key(q)
+            if key in seen:
+                continue
+            seen.add(key)
+            if model is not None and any(crosses_multi_valued(model, lookup)
+                                         for lookup in lookups(q)):
+                separate.append(q)
+            else:
+                combined.append(q)
+
+        if combined:
+            query = query.filter(optimize(make_q(combined)))
+        for q in separate:
+            query = query.filter(q)
         return query
 
     @classmethod
@@ -0,0 +1,241 @@
+"""Full-text search backends for ``qfilters.FullTextSearch``.
+
+A backend turns the searched text into a Q object, and optionally into an
+SQL expression ranking the matches, selected as ``search_rank`` when a list
+is ordered by it. ``QSearch`` ORs ``Q(lookup=value)`` over the lookups (eg.
+``title__icontains``), which needs a full table scan. The other backends
+search a full-text index of the model's own text columns:
+
+    * ``PostgresSearch`` - ``tsvector`` matching, backed by a GIN index,
+    * ``SqliteFTSSearch`` - an FTS5 table kept up to date by triggers.
+
+Their index is created by ``install()``, eg. from a migration::
+
+    FullTextSearch('q', 'title__icontains', 'author_name__icontains',
+                   backend=PostgresSearch(Book, config='english'))
+
+Lookups spanning relations can't be indexed and fall back to ``QSearch``.
+Words are matched as prefixes (unless ``prefix=False``), so searching as
+you type works.
+"""
+import re
+
+from django.db import connections
+from django.db.models import Q
+
+
+def tokens(value):
+    return re.findall(r'\w+', value, re.UNICODE)
+
+
+class SearchBackend(object):
+
+    def build_filters(self, lookups, value):
+        """Return Q object selecting objects matching ``value``."""
+        raise NotImplementedError
+
+    def rank(self, lookups, value):
+        """Return ``(sql, params)`` of an expression ranking the matches,
+        higher is better, or ``None`` if the backend can't rank them.
+        """
+        return None
+
+
+class QSearch(SearchBackend):
+    """The default backend, ORing ``Q(lookup=value)`` over the lookups."""
+
+    def build_filters(self, lookups, value):
+        q = None
+        for f in lookups:
+            if q is None:
+                q = Q(**{f: value})
+            else:
+                q |= Q(**{f: value})
+        return q
+
+
+class IndexedSearch(SearchBackend):
+    """Base of backends searching an index of ``model`` text columns.
+
+    The indexed ``fields`` default to the model fields the lookups are made
+    on.
+    """
+
+    def __init__(self, model, fields=None, prefix=True, using=None):
+        self.model = model
+        self.fields = fields
+        self.prefix = prefix
+        self.using = using
+
+    def split_lookups(self, lookups):
+        """Return ``(fields, lookups)``: names of the indexed fields and
+        lookups which can't be searched in the index.
+        """
+        fields = []
+        rest = []
+        field_names = set(f.name for f in self.model._meta.fields
+                          if f.rel is None)
+        for lookup in lookups:
+            name = lookup.split('__')[0]
+            if name in field_names and lookup.count('__') <= 1:
+                if name not in fields:
+                    fields.append(name)
+            else:
+                rest.append(lookup)
+        if self.fields is not None:
+            fields = list(self.fields)
+        return fields, rest
+
+    def columns(self, fields):
+        qn = self.connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        return ['%s.%s' % (table, qn(self.model._meta.get_field(name).column))
+                for name in fields]
+
+    @property
+    def connection(self):
+        return connections[self.using or 'default']
+
+    def match(self, fields, words):
+        """Return ``(where, params)`` of the SQL condition matching
+        ``words`` in the index of ``fields``.
+        """
+        raise NotImplementedError
+
+    def build_filters(self, lookups, value):
+        fields, rest = self.split_lookups(lookups)
+        words = tokens(value)
+        if not fields or not words:
+            return QSearch().build_filters(lookups, value)
+
+        where, params = self.match(fields, words)
+        matching = self.model._default_manager.extra(
+            where=[where], params=params).values('pk')
+        q = Q(pk__in=matching)
+        if rest:
+            q |= QSearch().build_filters(rest, value)
+        return q
+
+    def install(self, fields, using=None):
+        """Create the index of ``fields``."""
+        raise NotImplementedError
+
+
+class PostgresSearch(IndexedSearch):
+    """Matches ``to_tsvector`` of the columns with ``to_tsquery``.
+
+    ``install()`` creates a GIN index on the same expression, so matching
+    is index-backed. Alternatively, point ``vector`` at a maintained
+    ``tsvector`` column.
+    """
+
+    def __init__(self, model, fields=None, config='simple', vector=None,
+                 **kwargs):
+        super(PostgresSearch, self).__init__(model, fields, **kwargs)
+        if not re.match(r'^\w+$', config):
+            raise ValueError('Invalid text search configuration: %s' % config)
+        self.config = config
+        self.vector = vector
+
+    def document(self, fields):
+        if self.vector is not None:
+            qn = self.connection.ops.quote_name
+            return '%s.%s' % (qn(self.model._meta.db_table), qn(self.vector))
+        text = " || ' ' || ".join("coalesce(%s, '')" % column
+                                  for column in self.columns(fields))
+        return "to_tsvector('%s', %s)" % (self.config, text)
+
+    def query(self, words):
+        words = list(words)
+        if self.prefix:
+            words[-1] += ':*'
+        return ' & '.join(words)
+
+    def match(self, fields, words):
+        return ("%s @@ to_tsquery('%s', %%s)" % (self.document(fields),
+                                                 self.config),
+                [self.query(words)])
+
+    def rank(self, lookups, value):
+        fields = self.split_lookups(lookups)[0]
+        words = tokens(value)
+        if not fields or not words:
+            return None
+        return ("ts_rank(%s, to_tsquery('%s', %%s))" % (self.document(fields),
+                                                        self.config),
+                [self.query(words)])
+
+    def install(self, fields, using=None):
+        qn = self.connection.ops.quote_name
+        name = '%s_search' % self.model._meta.db_table
+        cursor = connections[using or self.using or 'default'].cursor()
+        cursor.execute('CREATE INDEX %s ON %s USING gin (%s)' % (
+            qn(name), qn(self.model._meta.db_table), self.document(fields)))
+
+
+class SqliteFTSSearch(IndexedSearch):
+    """Matches words in an FTS5 table shadowing the model's table.
+
+    ``install()`` creates the table (``<db_table>_fts`` by default), fills
+    it and creates triggers keeping it up to date. Rows are ranked with
+    bm25.
+    """
+
+    def __init__(self, model, fields=None, table=None, **kwargs):
+        super(SqliteFTSSearch, self).__init__(model, fields, **kwargs)
+        self.table = table or '%s_fts' % model._meta.db_table
+
+    def query(self, words):
+        phrases = ['"%s"' % word.replace('"', '""') for word in words]
+        if self.prefix:
+            phrases[-1] += '*'
+        return ' '.join(phrases)
+
+    def match(self, fields, words):
+        qn = self.connection.ops.quote_name
+        pk = '%s.%s' % (qn(self.model._meta.db_table),
+                        qn(self.model._meta.pk.column))
+        return ('%s IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+            pk, qn(self.table), qn(self.table)), [self.query(words)])
+
+    def rank(self, lookups, value):
+        words = tokens(value)
+        if not self.split_lookups(lookups)[0] or not words:
+            return None
+        qn = self.connection.ops.quote_name
+        pk = '%s.%s' % (qn(self.model._meta.db_table),
+                        qn(self.model._meta.pk.column))
+        # FTS5 rank is lower for better matches.
+        return ('(SELECT -rank FROM %s WHERE %s MATCH %%s AND rowid = %s)' % (
+            qn(self.table), qn(self.table), pk), [self.query(words)])
+
+    def install(self, fields, using=None):
+        qn = self.connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(self.table)
+        columns = [qn(opts.get_field(name).column) for name in fields]
+        pk = qn(opts.pk.column)
+
+        def values(prefix):
+            return ', '.join('%s.%s' % (prefix, column) for column in columns)
+
+        delete = "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.%s, %s);" % (
+            table, table, ', '.join(columns), pk, values('old'))
+        insert = 'INSERT INTO %s(rowid, %s) VALUES (new.%s, %s);' % (
+            table, ', '.join(columns), pk, values('new'))
+        statements = [
+            "CREATE VIRTUAL TABLE %s USING fts5(%s, content=%s, "
+            "content_rowid=%s)" % (table, ', '.join(columns),
+                                   qn(opts.db_table), pk),
+            "INSERT INTO %s(%s) VALUES ('rebuild')" % (table, table),
+        ]
+        for event, body in (('INSERT', insert), ('DELETE', delete),
+                            ('UPDATE', delete + ' ' + insert)):
+            statements.append(
+                'CREATE TRIGGER %s AFTER %s ON %s BEGIN %s END' % (
+                    qn('%s_%s' % (self.table, event.lower())), event,
+                    qn(opts.db_table), body))
+
+        cursor = connections[using or self.using or 'default'].cursor()
+        for statement in statements:
+            cursor.execute(statement)
@@ -0,0 +1,101 @@
+"""Selections of objects stored on the server.
+
+Instead of posting the selected ids (or the filters of "select all") with
+every action, the client registers the selection once with the resource's
+``_selection/`` URL and gets a token, which it sends as ``selection`` in
+the action query. A selection is either the list of ``ids`` or the
+``filter`` snapshot of "select all" with the ``exclude`` list of ids
+deselected afterwards. Selections are kept in Django's cache and expire
+``TIMEOUT`` seconds after they were last used.
+
+Lists of ids of models with integer primary keys are turned into primary
+key ranges where the ids are consecutive, so selecting thousands of rows by
+shift-clicking doesn't put thousands of literals into the query. Other
+primary keys are looked up as they were sent.
+"""
+import uuid
+
+from django.core.cache import cache
+from django.db.models import Q
+
+
+KEY_PREFIX = 'crud:selection'
+TIMEOUT = 60 * 60
+
+INTEGER_FIELDS = ('AutoField', 'BigAutoField', 'IntegerField',
+                  'BigIntegerField', 'SmallIntegerField',
+                  'PositiveIntegerField', 'PositiveSmallIntegerField')
+
+
+def selection_cache_key(token):
+    return '%s:%s' % (KEY_PREFIX, token)
+
+
+def store_selection(selection):
+    """Store ``selection`` dict and return its token."""
+    token = uuid.uuid4().hex
+    cache.set(selection_cache_key(token), selection, TIMEOUT)
+    return token
+
+
+def load_selection(token):
+    """Return the selection stored under ``token`` or ``None`` if it has
+    expired, extending its life.
+    """
+    key = selection_cache_key(token)
+    selection = cache.get(key)
+    if selection is not None:
+        cache.set(key, selection, TIMEOUT)
+    return selection
+
+
+def pk_ranges(ids):
+    """Return ``(ranges, singles)``: ``(first, last)`` pairs of runs of
+    consecutive integer ``ids`` and the other ids.
+    """
+    try:
+        values = sorted(set(int(pk) for pk in ids))
+    except (TypeError, ValueError):
+        return [], list(ids)
+    ranges = []
+    singles = []
+    start = previous = None
+    for value in values + [None]:
+        if previous is not None and value == previous + 1:
+            previous = value
+            continue
+        if start is not None:
+            if previous - start >= 2:
+                ranges.append((start, previous))
+            else:
+                singles.extend(range(start, previous + 1))
+        start = previous = value
+    return ranges, singles
+
+
+def has_integer_pk(model):
+    pk = model._meta.pk
+    # Primary keys which are relations (eg. of inherited models) have the
+    # type of the related field.
+    while getattr(pk, 'rel', None) is not None:
+        pk = pk.rel.get_related_field()
+    return pk.get_internal_type() in INTEGER_FIELDS
+
+
+def pk_query(ids, model):
+    """Return Q object selecting objects of ``model`` with primary keys in
+    ``ids``.
+    """
+    if not has_integer_pk(model):
+        # Ranges of eg. strings would match other keys, like "100" in
+        # "10".."12".
+        return Q(pk__in=list(ids))
+    ranges, singles = pk_ranges(ids)
+    q = None
+    for first, last in ranges:
+        range_q = Q(pk__gte=first, pk__lte=last)
+        q = range_q if q is None else q | range_q
+    if singles or q is None:
+        singles_q = Q(pk__in=singles)
+        q = singles_q if q is None else q | singles_q
+    return q
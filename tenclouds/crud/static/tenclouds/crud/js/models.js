@@ -5,6 +5,16 @@ crud.util.getValue = function(val) {
 };
 
 
+// Return a new random key under which a task reports its progress.
+crud.util.statusKey = function () {
+    var key = '';
+    for (var i = 0; i < 32; ++i) {
+        key += Math.floor(Math.random() * 16).toString(16);
+    }
+    return key;
+};
+
+
 crud.modelMeta = function (baseUrl, callback) {
     $.getJSON(crud.util.getValue(baseUrl) + 'schema/', {}, function (resp) {
         callback(resp);
@@ -132,12 +142,28 @@ crud.collection.PaginatedCollection = Backbone.Collection.extend({
 
     total: 0,
 
+    // ETag of the last response, sent back in If-None-Match
+    etag: null,
+
+    // ask for the compact list encoding: false, true, or 'dict' to have
+    // repeated strings dictionary encoded as well
+    compact: false,
+
+    // ask for facets: numbers of objects matching each filter choice, given
+    // in facetCounts as returned by the API
+    countFacets: false,
+    facetCounts: null,
+
     fetch: function (options) {
         var that = this;
         var o = options || {};
 
         this.trigger('reset:begin');
 
+        if (this.etag) {
+            o.headers = _.extend({'If-None-Match': this.etag}, o.headers);
+        }
+
         var success = o.success;
         // wrap default succes callback
         o.success = function (resp) {
@@ -156,27 +182,105 @@ crud.collection.PaginatedCollection = Backbone.Collection.extend({
         Backbone.Collection.prototype.fetch.call(this, o);
     },
 
-    parse: function (resp) {
+    // cursors to the neighbouring pages, provided by the cursor paginator
+    cursors: null,
+
+    parse: function (resp, xhr) {
+        // Backbone < 1.0 passes the xhr, later versions pass the options.
+        xhr = xhr && xhr.xhr || xhr;
+        if (xhr && xhr.status === 304) {
+            // Nothing has changed, keep the current models.
+            return this.models.slice();
+        }
+        if (xhr && xhr.getResponseHeader) {
+            this.etag = xhr.getResponseHeader('ETag');
+        }
         this.page = resp.page;
         this.total = resp.total;
+        this.totalKind = resp.total_kind || 'exact';
+        this.nextExists = resp.has_next;
         this.perPage = resp.per_page;
         this.ordering = resp.ordering;
+        this.cursors = {page: resp.page, next: resp.next, prev: resp.prev};
+        this.facetCounts = resp.facets || null;
+        if (resp.rows) {
+            return this.expandRows(resp);
+        }
         return resp.objects;
     },
 
+    // Turn rows of the compact list encoding back into objects.
+    expandRows: function (resp) {
+        var fields = resp.fieldsOrder;
+        var dictionaries = _.map(fields, function (name) {
+            return (resp.dictionaries || {})[name];
+        });
+        return _.map(resp.rows, function (row) {
+            var obj = {};
+            for (var i = 0; i < fields.length; ++i) {
+                var value = row[i];
+                if (dictionaries[i] && value !== null) {
+                    value = dictionaries[i][value];
+                }
+                obj[fields[i]] = value;
+            }
+            return obj;
+        });
+    },
+
+    compactParam: function (params) {
+        if (this.compact) {
+            params.compact = this.compact === 'dict' ? 'dict' : 1;
+        }
+        return params;
+    },
+
+    // Return the cursor leading to the current page, if the last response
+    // provided one. Pages not adjacent to the last fetched one are requested
+    // by their number.
+    pageCursor: function () {
+        var c = this.cursors;
+        if (!c) {
+            return null;
+        }
+        if (this.page === c.page + 1) {
+            return c.next || null;
+        }
+        if (this.page === c.page - 1) {
+            return c.prev || null;
+        }
+        return null;
+    },
+
     url: function () {
         var params = {page: this.page, per_page: this.perPage};
+        var cursor = this.pageCursor();
+        if (cursor) {
+            params.cursor = cursor;
+        }
+        this.compactParam(params);
         return crud.util.getValue(this.urlRoot) + '?' + $.param(params, true);
     },
 
     hasNext: function () {
+        if (this.nextExists === true || this.nextExists === false) {
+            // the API told us explicitly
+            return this.nextExists;
+        }
         if (this.total === null) {
             // if total is null, the API wishes not to provide total number of
             // arguments, so we don't really know if there is a next page
             // unless we get an empty one (call this "endless" stream)
             return this.models.length >= this.perPage;
         }
-        return this.page * this.perPage < this.total;
+        if (this.page * this.perPage < this.total) {
+            return true;
+        }
+        if (this.totalKind === 'capped' || this.totalKind === 'estimate') {
+            // the real total may be bigger than the one we got
+            return this.models.length >= this.perPage;
+        }
+        return false;
     },
 
     hasPrev: function () {
@@ -189,6 +293,21 @@ crud.collection.PaginatedCollection = Backbone.Collection.extend({
             return null;
         }
         return Math.ceil(this.total / this.perPage);
+    },
+
+    // Return the total formatted according to its kind: "10000+" when
+    // counting was capped, "~10000" when it's the database estimate.
+    totalDisplay: function () {
+        if (this.total === null) {
+            return null;
+        }
+        if (this.totalKind === 'capped') {
+            return this.total + '+';
+        }
+        if (this.totalKind === 'estimate') {
+            return '~' + this.total;
+        }
+        return '' + this.total;
     }
 
 });
@@ -229,8 +348,8 @@ crud.collection.Collection = crud.collection.PaginatedCollection.extend({
         }
     },
 
-    parse: function (resp) {
-        var orig = crud.collection.PaginatedCollection.prototype.parse.call(this, resp);
+    parse: function (resp, xhr) {
+        var orig = crud.collection.PaginatedCollection.prototype.parse.call(this, resp, xhr);
         if(!this.querySort) { this.makeOrderingDict(); }
         return orig;
     },
@@ -246,6 +365,7 @@ crud.collection.Collection = crud.collection.PaginatedCollection.extend({
 
     fetch: function (options) {
         this.allSelected = false;
+        this.selection = null;
         var that = this;
         var o = options || {};
         // wrap default error callback
@@ -289,6 +409,46 @@ crud.collection.Collection = crud.collection.PaginatedCollection.extend({
         return query;
     },
 
+    // Selections of more ids than this, and "select all" ones, are
+    // registered on the server, and only their token is sent to actions.
+    selectionThreshold: 100,
+
+    // the last registered selection: {spec: ..., token: ...}
+    selection: null,
+
+    shouldRegisterSelection: function (query) {
+        return !query.selection && (query.all ||
+            (query.id__in || []).length > this.selectionThreshold);
+    },
+
+    // Register the selection of the action `query` and call `callback` with
+    // its token. The token is reused while the selection stays the same.
+    registerSelection: function (query, callback, error) {
+        var that = this;
+        var spec = JSON.stringify({
+            all: query.all,
+            filter: query.filter,
+            id__in: query.id__in,
+            exclude: query.exclude || []
+        });
+        if (this.selection && this.selection.spec === spec) {
+            callback(this.selection.token);
+            return;
+        }
+        $.ajax({
+            url: this.url('_selection/'),
+            type: 'POST',
+            contentType: 'application/json',
+            dataType: 'json',
+            data: spec,
+            success: function (resp) {
+                that.selection = {spec: spec, token: resp.selection};
+                callback(resp.selection);
+            },
+            error: error
+        });
+    },
+
     /**
     * Converts the input ordering list into querySort structure and sets
     * this.querySort to the correct value.
@@ -373,6 +533,14 @@ crud.collection.Collection = crud.collection.PaginatedCollection.extend({
             if (this.paginate) {
                 params.page = this.page;
                 params.per_page = this.perPage;
+                var cursor = this.pageCursor();
+                if (cursor) {
+                    params.cursor = cursor;
+                }
+            }
+            this.compactParam(params);
+            if (this.countFacets) {
+                params.facets = 1;
             }
             order_by = this.querySortAsList();
             if (order_by && order_by.length > 0) {
@@ -397,7 +565,8 @@ crud.collection.Collection = crud.collection.PaginatedCollection.extend({
         var url = crud.util.getValue(this.urlRoot);
 
         if (forAction) {
-            url += '_actions/';
+            // forAction may name another endpoint, eg. '_selection/'
+            url += _.isString(forAction) ? forAction : '_actions/';
         }
 
         return (urlParams) ? url + '?' + urlParams : url;
@@ -438,6 +607,15 @@ crud.collection.Collection = crud.collection.PaginatedCollection.extend({
         var that = this;
         query = query || this.selectedQuery();
         var o = options || {};
+
+        if (this.shouldRegisterSelection(query)) {
+            this.registerSelection(query, function (token) {
+                that.runAction(actionName, options,
+                               {selection: token, sort: query.sort});
+            }, o.error);
+            return;
+        }
+
         // options.data should not overwrite our data
         var options_data = options.data || {};
         delete options.data;
@@ -445,10 +623,18 @@ crud.collection.Collection = crud.collection.PaginatedCollection.extend({
         // Whenever we run action, server might response with spawned offline
         // task status key. If he does, trigger global event with that key, so
         // that everybody would know about it.
+        // Chunked actions report their progress while they run, so with
+        // trackProgress the key is chosen here and announced right away.
+        if (o.trackProgress) {
+            query = _.extend({statuskey: crud.util.statusKey()}, query);
+            crud.event.Task.trigger('new', query.statuskey, {});
+            delete o.trackProgress;
+        }
+
         var success = o.success;
         o.success = function (resp) {
             if (_.isObject(resp)) {
-                if (resp.statuskey) {
+                if (resp.statuskey && resp.statuskey !== query.statuskey) {
                     crud.event.Task.trigger('new', resp.statuskey, resp);
                 }
 
@@ -479,20 +665,33 @@ crud.collection.Collection = crud.collection.PaginatedCollection.extend({
     //
     // TODO: this should be done automagically, and specified in CRUD
     // handler. It is quite a hell to do that, however.
-    runDownloadAction: function (actionName, options) {
+    //
+    // Works with streamed exports, eg. actions.export_action('csv'), the
+    // browser saves the file as it is received.
+    runDownloadAction: function (actionName, options, query) {
+        var that = this;
+        query = query || this.selectedQuery();
+        if (this.shouldRegisterSelection(query)) {
+            this.registerSelection(query, function (token) {
+                that.runDownloadAction(actionName, options,
+                                       {selection: token, sort: query.sort});
+            });
+            return;
+        }
+
         var data = JSON.stringify({
             action: actionName,
-            query: this.selectedQuery(),
-            data: options.data || {}
+            query: query,
+            data: (options && options.data) || {}
         });
 
-        var url = this.url().split('?')[0] + '_actions/';
-
-        // construct the inputs for form
-        var inputs = '<input type="hidden" name="data" value=' + data + ' />';
+        // set the values through jQuery, so that they are escaped
+        var input = jQuery('<input type="hidden" name="data" />').val(data);
 
         //send request using hidden form, and remove it
-        jQuery('<form action="' + url + '" method="post">' + inputs + '</form>')
+        jQuery('<form method="post"></form>')
+            .attr('action', this.url(true))
+            .append(input)
             .appendTo('body').submit().remove();
     },
 
@@ -528,23 +727,48 @@ crud.model.Message = crud.model.Model.extend({
 
     isCompleted: function () {
         // we cannot check state of models with no id anyway
-        return this.id === undefined || this.progress === 100;
+        var progress = this.get('progress');
+        if (progress === undefined) {
+            progress = this.get('completed');
+        }
+        return this.id === undefined || progress >= 100;
     }
 
 });
 
 
+// Statuses of all pending tasks are polled with one request to urlRoot
+// (the resource's "_status/" URL), slowing down while nothing changes, or
+// pushed by the server as they change, if enabled with useStream and the
+// browser supports server-sent events.
 crud.collection.Messages = crud.collection.Collection.extend({
 
     model: crud.model.Message,
 
     checkInterval: 1500,
 
+    // polling slows down by backoff times, up to maxCheckInterval, while
+    // statuses don't change
+    maxCheckInterval: 15000,
+    backoff: 1.5,
+
+    // listen to server-sent events rather than poll, if possible. Off by
+    // default: every open stream holds a server worker (for up to 30 s per
+    // connection), and Django < 1.5 can't stream responses at all. Opt in
+    // with a server running asynchronous workers (eg. gunicorn with
+    // gevent), eg. crud.collection.Messages.prototype.useStream = true
+    useStream: false,
+
     initialize: function () {
         var args = Array.prototype.slice.call(arguments);
         crud.collection.Collection.prototype.initialize.call(this, args);
 
-        _.bindAll(this, 'onNewTask');
+        _.bindAll(this, 'onNewTask', 'poll');
+
+        this.etag = null;
+        this.timer = null;
+        this.stream = null;
+        this.interval = this.checkInterval;
 
         crud.event.Task.bind('new', this.onNewTask);
     },
@@ -555,49 +779,134 @@ crud.collection.Messages = crud.collection.Collection.extend({
         });
     },
 
+    pendingIds: function () {
+        return _.pluck(this.reject(function (m) {
+            return m.isCompleted();
+        }), 'id');
+    },
+
     onNewTask: function (statusKey, resp) {
+        if (this.get(statusKey)) {
+            return;
+        }
         var data = {id: statusKey};
         _.extend(data, resp);
         var m = new this.model(data);
         this.add(m);
+        this.interval = this.checkInterval;
         this.update();
     },
 
     update: function () {
-        // for every model in collection, check if it's completed. If yes,
-        // remove from collection, else call 'fetch' method
-
+        // remove completed models from collection, then watch the statuses
+        // of the others
         var that = this;
-        var ids = this.pluck('id');
+        _.each(this.filter(function (m) {
+            return m.isCompleted();
+        }), function (m) {
+            that.remove(m);
+        });
+        this.trigger('reset', 'update');
+        this.watch();
+    },
 
-        _.each(ids, function (mId) {
-            var m = that.get(mId);
-            if (m.isCompleted()) {
-                that.remove(m);
-                return;
+    watch: function () {
+        clearTimeout(this.timer);
+        this.timer = null;
+        var ids = this.pendingIds();
+        if (!ids.length || this.checkInterval <= 0) {
+            this.closeStream();
+            return;
+        }
+        if (this.useStream && window.EventSource) {
+            this.openStream(ids);
+        } else {
+            this.poll();
+        }
+    },
+
+    statusUrl: function (path, ids) {
+        return crud.util.getValue(this.urlRoot) + path + '?' +
+            $.param({keys: ids.join(',')});
+    },
+
+    setStatuses: function (statuses) {
+        var that = this;
+        _.each(statuses, function (status) {
+            var m = that.get(status.id);
+            if (m) {
+                m.set(status);
             }
-            var success = function (m, resp) {
-                if (that.repeatFetch() && that.checkInterval > 0) {
-                    setTimeout(function () {
-                        // Re-check in case user has closed the notification in
-                        // the meantime.
-                        if (that.repeatFetch())
-                            m.fetch({success: success, error: error});
-                    }, that.checkInterval);
+        });
+    },
+
+    schedule: function (changed) {
+        if (changed) {
+            this.interval = this.checkInterval;
+        } else {
+            this.interval = Math.min(this.interval * this.backoff,
+                                     this.maxCheckInterval);
+        }
+        // Re-check in case user has closed the notification in the meantime.
+        if (this.repeatFetch()) {
+            this.timer = setTimeout(this.poll, this.interval);
+        }
+    },
+
+    poll: function () {
+        var that = this;
+        var ids = this.pendingIds();
+        if (!ids.length) {
+            return;
+        }
+        $.ajax({
+            url: this.statusUrl('', ids),
+            dataType: 'json',
+            headers: this.etag ? {'If-None-Match': this.etag} : {},
+            success: function (resp, textStatus, xhr) {
+                var changed = xhr.status !== 304 && !!resp;
+                if (changed) {
+                    that.etag = xhr.getResponseHeader('ETag');
+                    that.setStatuses(resp.objects);
                 }
-            };
-            var error = function (m, resp) {
-                setTimeout(function() {
-                    // Re-check in case user has closed the notification in
-                    // the meantime.
-                    if (that.repeatFetch())
-                        m.fetch({success: success, error: error});
-                }, 2000);
-            };
-
-            m.fetch({success: success, error: error});
+                that.schedule(changed);
+            },
+            error: function () {
+                that.schedule(false);
+            }
         });
-        this.trigger('reset', 'update');
+    },
+
+    openStream: function (ids) {
+        var that = this;
+        var url = this.statusUrl('stream/', ids);
+        if (this.stream && this.stream.url === url) {
+            return;
+        }
+        this.closeStream();
+        this.stream = new window.EventSource(url);
+        this.stream.onmessage = function (e) {
+            that.setStatuses([JSON.parse(e.data)]);
+        };
+        this.stream.addEventListener('end', function () {
+            that.closeStream();
+        });
+        this.stream.onerror = function () {
+            // The browser reconnects to streams closed after a while, but
+            // gives up on failing ones. Fall back to polling then.
+            if (that.stream && that.stream.readyState === 2) {
+                that.closeStream();
+                that.useStream = false;
+                that.watch();
+            }
+        };
+    },
+
+    closeStream: function () {
+        if (this.stream) {
+            this.stream.close();
+            this.stream = null;
+        }
     }
 
 });
@@ -430,7 +430,7 @@ crud.view.Table = crud.view.View.extend({
         if (selectOn) {
             var allStr;
             var allPromprStr;
-            var total = this.collection.total;
+            var total = this.collection.totalDisplay();
 
             if (total === null) {
                 allStr = 'All';
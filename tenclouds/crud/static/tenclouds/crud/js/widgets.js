@@ -365,7 +365,8 @@ crud.view.ActionsMenuWidget = crud.view.DropdownMenuWidget.extend({
             return this.displayActionDialog(action);
         }
 
-        var options = {success: this.actionDone, error: this.actionDone};
+        var options = {success: this.actionDone, error: this.actionDone,
+                       trackProgress: !!action.chunked};
         if (this.data) {
             options.data = data;
         }
@@ -405,7 +406,8 @@ crud.view.ActionsMenuWidget = crud.view.DropdownMenuWidget.extend({
                     that.render();
                 };
 
-                var options = {success: done, error: error, data: formData};
+                var options = {success: done, error: error, data: formData,
+                               trackProgress: !!action.chunked};
                 that.actionsInProgress += 1;
                 that.render();
                 that.collection.runAction(action.codename, options, that.options.actionQuery);
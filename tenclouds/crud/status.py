@@ -0,0 +1,180 @@
+"""Progress of long running actions, shared through Django's cache.
+
+A task reports its progress with ``Progress``, under a status key returned
+to the client in ``ProcessingOffline``. The ``crud.collection.Messages``
+JavaScript collection polls the resource's ``_status/<key>/`` URL for the
+status, a dict with:
+
+    * ``id`` - the status key,
+    * ``description`` - what is being done,
+    * ``total`` and ``done`` - numbers of objects to process and processed,
+    * ``completed`` and ``progress`` - percentage done,
+    * ``message`` - last message of the task,
+    * ``failed`` - whether the task has stopped on an error,
+    * ``result`` - what the task has returned, if it's JSONable.
+
+Many statuses are read at once from ``_status/?keys=<key>,<key>``, or
+pushed as server-sent events by ``_status/stream/?keys=...`` as they
+change. Keys not found (expired or unknown) get ``expired_status``, which
+reads as completed, so the client stops asking for them.
+
+Statuses are stored in the cache named by the ``CRUD_STATUS_CACHE``
+setting, ``default`` by default. Tasks run in other processes (see
+``tenclouds.crud.tasks``) need a cache shared between processes, eg. the
+database or memcached one, not the local memory cache.
+"""
+import json
+import re
+import time
+import uuid
+
+from django.conf import settings
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+
+KEY_PREFIX = 'crud:status'
+TIMEOUT = 60 * 60 * 24
+# Most statuses read by one request.
+MAX_KEYS = 100
+
+_valid_key = re.compile(r'^[\w-]{8,64}$')
+
+
+def new_status_key():
+    return uuid.uuid4().hex
+
+
+def is_status_key(key):
+    return bool(key) and _valid_key.match(key) is not None
+
+
+def status_cache_key(key):
+    return '%s:%s' % (KEY_PREFIX, key)
+
+
+def status_cache():
+    return get_cache(getattr(settings, 'CRUD_STATUS_CACHE', 'default'))
+
+
+def get_status(key):
+    """Return the status stored under ``key`` or ``None``."""
+    return status_cache().get(status_cache_key(key))
+
+
+def set_status(key, status):
+    status_cache().set(status_cache_key(key), status, TIMEOUT)
+
+
+def expired_status(key):
+    return {'id': key, 'completed': 100, 'progress': 100, 'expired': True}
+
+
+def get_statuses(keys):
+    """Return a list of statuses stored under ``keys``, in the same order,
+    with ``expired_status`` for the keys not found.
+    """
+    cache_keys = [status_cache_key(key) for key in keys]
+    found = status_cache().get_many(cache_keys)
+    return [found.get(cache_key) or expired_status(key)
+            for key, cache_key in zip(keys, cache_keys)]
+
+
+def status_events(keys, interval=1, duration=30):
+    """Yield server-sent events of the statuses stored under ``keys``: one
+    when each is first read and whenever it changes.
+
+    Statuses are read every ``interval`` seconds, until all are completed
+    (an ``end`` event is sent then) or ``duration`` seconds pass. The
+    client reconnects after the latter, so a worker isn't held forever.
+    """
+    last = {}
+    deadline = time.time() + duration
+    yield 'retry: %d\n\n' % (interval * 1000)
+    while True:
+        completed = True
+        for status in get_statuses(keys):
+            if status != last.get(status['id']):
+                last[status['id']] = status
+                yield 'data: %s\n\n' % json.dumps(status)
+            completed = completed and status.get('progress', 0) >= 100
+        if completed:
+            yield 'event: end\ndata: {}\n\n'
+            return
+        if time.time() >= deadline:
+            return
+        time.sleep(interval)
+
+
+class Progress(object):
+    """Progress of a task processing ``total`` objects, stored under
+    ``key`` (a new one by default).
+    """
+
+    def __init__(self, key=None, description='', total=None):
+        self.key = key or new_status_key()
+        self.status = {
+            'id': self.key,
+            'description': description,
+            'total': total,
+            'done': 0,
+            'completed': 0,
+            'progress': 0,
+            'message': '',
+            'failed': False,
+            'result': None,
+        }
+        self.save()
+
+    @classmethod
+    def resume(cls, key):
+        """Return ``Progress`` of the status stored under ``key``, eg. to
+        continue reporting it in another process.
+        """
+        progress = cls.__new__(cls)
+        progress.key = key
+        progress.status = get_status(key)
+        if progress.status is None:
+            progress.status = cls(key).status
+        return progress
+
+    def save(self):
+        set_status(self.key, self.status)
+
+    def update(self, done, message=None):
+        """Record ``done`` objects processed so far."""
+        total = self.status['total']
+        percent = 100 * done // total if total else 0
+        # Only finish() reports the task as completed.
+        percent = min(percent, 99)
+        self.status.update(done=done, completed=percent, progress=percent)
+        if message is not None:
+            self.status['message'] = message
+        self.save()
+
+    def set_total(self, total):
+        self.status['total'] = total
+        self.save()
+
+    def finish(self, message=None, result=None):
+        self.status.update(completed=100, progress=100, result=result)
+        if self.status['total'] is not None:
+            self.status['done'] = self.status['total']
+        if message is not None:
+            self.status['message'] = message
+        self.save()
+
+    def fail(self, message):
+        """Record the task has stopped on an error. The client stops
+        polling, as with a finished task.
+        """
+        self.status.update(completed=100, progress=100, failed=True,
+                           message=message)
+        self.save()
@@ -0,0 +1,165 @@
+"""Streaming JSON list responses and exports.
+
+A streamed list is serialized the same way as a regular one, but the
+objects are read from ``queryset.iterator()`` and dehydrated and serialized
+a chunk at a time, so the memory used does not grow with the page size.
+The page data, except the objects, is written first and ``has_next`` comes
+last, once the extra row from the next page has been looked for.
+
+Exports stream every object of a queryset as CSV or NDJSON rows.
+"""
+import csv
+import json
+from cStringIO import StringIO
+from itertools import islice
+
+import django
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.query import prefetch_related_objects
+from django.http import HttpResponse
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5 consumes iterators lazily with plain responses.
+    StreamingHttpResponse = HttpResponse
+
+from tenclouds.crud.keyset import can_seek, iter_sought, query_ordering
+
+
+def dumps(data):
+    return json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+
+
+def prefetch(objects, lookups):
+    """Prefetch ``lookups`` for a chunk of model instances, since
+    ``iterator()`` ignores ``prefetch_related``.
+    """
+    if django.VERSION >= (1, 10):
+        prefetch_related_objects(objects, *lookups)
+    else:
+        prefetch_related_objects(objects, lookups)
+
+
+def iter_objects(objects):
+    if hasattr(objects, 'iterator'):
+        return objects.iterator()
+    return iter(objects)
+
+
+def stream_page(page, dehydrate, to_simple, chunk_size=100):
+    """Yield a JSON page of objects in pieces.
+
+    ``page`` is the page data from ``Paginator.stream_page()``, with the
+    unevaluated slice of objects, one longer than ``per_page``, unless it
+    has ``has_next`` already.
+    ``dehydrate(objects)`` returns a list of dehydrated chunk of objects and
+    ``to_simple`` turns each of them into data that can be dumped to JSON.
+    """
+    objects = page.pop('objects')
+    has_next = page.pop('has_next', None)
+    per_page = page['per_page']
+    lookups = getattr(objects, '_prefetch_related_lookups', None)
+
+    head = dumps(page)
+    yield head[:-1] + (', ' if page else '') + '"objects": ['
+
+    rows = iter_objects(objects)
+    left = per_page
+    separator = ''
+    while left > 0:
+        chunk = list(islice(rows, min(chunk_size, left)))
+        if not chunk:
+            break
+        left -= len(chunk)
+        if lookups and not isinstance(chunk[0], dict):
+            prefetch(chunk, lookups)
+        for obj in dehydrate(chunk):
+            yield separator + dumps(to_simple(obj))
+            separator = ', '
+
+    if has_next is None:
+        has_next = left == 0 and next(rows, None) is not None
+    yield '], "has_next": %s}' % dumps(has_next)
+
+
+def streaming_response(content, content_type):
+    return StreamingHttpResponse(content, content_type=content_type)
+
+
+def iter_chunks(objects, chunk_size):
+    """Yield lists of up to ``chunk_size`` objects.
+
+    Querysets are read one query per chunk, so neither the database driver
+    nor the queryset hold more than a chunk. The query seeks past the last
+    row by the ordering columns and the primary key (see
+    ``tenclouds.crud.keyset``). If the ordering can't be sought (eg. a
+    column is nullable), chunks are sliced with ``OFFSET`` instead. Other
+    iterables, and sliced querysets, are read with ``iterator()``, whose
+    memory use depends on the database driver.
+    """
+    query = getattr(objects, 'query', None)
+    if query is not None and not query.low_mark and query.high_mark is None:
+        ordering = query_ordering(objects)
+        if can_seek(objects.model, ordering):
+            for chunk in iter_sought(objects, ordering, chunk_size):
+                yield chunk
+            return
+
+        offset = 0
+        while True:
+            chunk = list(objects[offset:offset + chunk_size])
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            offset += chunk_size
+
+    lookups = getattr(objects, '_prefetch_related_lookups', None)
+    rows = iter_objects(objects)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        if lookups:
+            prefetch(chunk, lookups)
+        yield chunk
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict)):
+        value = dumps(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def stream_csv(chunks, columns, header, dehydrate):
+    """Yield CSV with the ``header`` row followed by ``columns`` of objects
+    dehydrated to simple data by ``dehydrate(chunk)``, a chunk at a time.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    def flush():
+        content = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return content
+
+    writer.writerow([_csv_value(title) for title in header])
+    yield flush()
+    for chunk in chunks:
+        for data in dehydrate(chunk):
+            writer.writerow([_csv_value(data.get(name)) for name in columns])
+        yield flush()
+
+
+def stream_ndjson(chunks, columns, dehydrate):
+    """Yield one JSON object with ``columns`` of each object per line."""
+    for chunk in chunks:
+        yield ''.join(
+            dumps(dict((name, data.get(name)) for name in columns)) + '\n'
+            for data in dehydrate(chunk))
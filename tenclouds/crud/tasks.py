@@ -0,0 +1,134 @@
+"""Running tasks in a local pool of worker processes.
+
+``submit(func, *args)`` calls ``func(progress, *args)`` in a worker and
+returns at once the status key under which ``progress`` (a
+``tenclouds.crud.status.Progress``) reports how the task is doing, its
+result or error. No broker is needed: the pool is a
+``multiprocessing.Pool`` started by the web process on first use.
+
+``func`` and ``args`` are pickled, so ``func`` must be a module level
+function. Settings:
+
+    * ``CRUD_TASK_WORKERS`` - number of worker processes, 2 by default;
+      with 0 tasks run in the calling process, before ``submit`` returns,
+    * ``CRUD_TASK_MAX_TASKS`` - number of tasks after which a worker is
+      replaced by a fresh one, 100 by default.
+
+Statuses must be stored in a cache shared between processes, see
+``tenclouds.crud.status``.
+"""
+import cPickle as pickle
+import multiprocessing
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import connections
+
+from tenclouds.crud.status import Progress
+
+
+_pool = None
+_lock = threading.Lock()
+
+
+def worker_count():
+    return getattr(settings, 'CRUD_TASK_WORKERS', 2)
+
+
+def _init_worker():
+    # Connections inherited from the web process are still used by it, so
+    # they are dropped without being closed. Workers open their own.
+    for connection in connections.all():
+        connection.connection = None
+
+
+def get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(
+                worker_count(), initializer=_init_worker,
+                maxtasksperchild=getattr(settings, 'CRUD_TASK_MAX_TASKS', 100))
+        return _pool
+
+
+def shutdown():
+    """Wait for submitted tasks to finish and stop the workers."""
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (basestring, bool, int, long,
+                                           float)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_jsonable(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, basestring) and _jsonable(v)
+                   for k, v in value.iteritems())
+    return False
+
+
+def _record_error(progress, e):
+    # Called in the except clause handling ``e``.
+    progress.status['error'] = traceback.format_exc()
+    progress.fail(unicode(e) or e.__class__.__name__)
+
+
+def run_task(key, func, args):
+    """Call ``func(progress, *args)``, recording its result or error in
+    the status stored under ``key``.
+    """
+    progress = Progress.resume(key)
+    try:
+        result = func(progress, *args)
+    except Exception, e:
+        _record_error(progress, e)
+        return
+    progress.finish(result=result if _jsonable(result) else None)
+
+
+def _run_in_worker(key, payload):
+    try:
+        try:
+            func, args = pickle.loads(payload)
+        except Exception, e:
+            # Eg. the function can't be imported in the worker.
+            _record_error(Progress.resume(key), e)
+            return
+        run_task(key, func, args)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+def submit(func, *args, **kwargs):
+    """Run ``func(progress, *args)`` in the pool and return its status key.
+
+    :param key: (optional) the status key, a new one by default
+    :param description: (optional) description of the task in its status
+
+    Raises the pickling error if ``func`` or ``args`` can't be sent to a
+    worker, the task being recorded as failed.
+    """
+    progress = Progress(kwargs.get('key'),
+                        description=kwargs.get('description', ''))
+    if worker_count() == 0:
+        run_task(progress.key, func, args)
+        return progress.key
+
+    # The pool pickles tasks in a background thread, which drops errors and
+    # leaves the task pending forever. They are pickled here instead.
+    try:
+        payload = pickle.dumps((func, args), pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        progress.fail(unicode(e) or e.__class__.__name__)
+        raise
+    get_pool().apply_async(_run_in_worker, (progress.key, payload))
+    return progress.key
@@ -1,16 +1,57 @@
+import csv
+import functools
 import json
+import os
+import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
+from django.core.exceptions import FieldError
 from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from django.db.models import loading
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import unittest
+from django.db import connections
+from django.db.models import CharField, F, Q, loading
 from django import test
 
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse
+from tastypie.paginator import Paginator as TastypiePaginator
 
-from tenclouds.crud.tests.books.models import Book
+
+from tenclouds.crud import actions
+from tenclouds.crud import columnar
+from tenclouds.crud import concurrency
+from tenclouds.crud import counting
+from tenclouds.crud import fields
+from tenclouds.crud import keyset
+from tenclouds.crud import qfilters
+from tenclouds.crud import resources
+from tenclouds.crud import streaming
+from tenclouds.crud import tasks
+from tenclouds.crud.dataset import Dataset
+from tenclouds.crud.dehydration import Projection
+from tenclouds.crud.facets import count_facets
+from tenclouds.crud.http import HttpDone
+from tenclouds.crud.paginator import CursorPaginator, Paginator
+from tenclouds.crud.qtree import optimize
+from tenclouds.crud.queryset import QuerySetAdapter
+from tenclouds.crud.search import SqliteFTSSearch
+from tenclouds.crud.selections import pk_query, pk_ranges
+from tenclouds.crud.status import Progress, get_status
+from tenclouds.crud.tests.books.models import Book, Publisher
 from tenclouds.crud.tests.books.resources import BookResource
 
 
+def count_words(progress, text):
+    # A task run by the pool in test_offline_action.
+    progress.update(0, message='Counting')
+    return len(text.split())
+
+
 class TestCase(test.TestCase):
     apps = ('tenclouds.crud.tests.books', )
     urls = 'tenclouds.crud.tests.books.urls'
@@ -91,6 +132,1067 @@ class TestCase(test.TestCase):
         response = self.c.delete(list_url, {}, "text/json")
         self.assertEqual(response.status_code, 405)
 
+    def test_cursor_pagination(self):
+        objects = Book.objects.order_by('-is_available', 'title')
+        expected = list(objects.order_by('-is_available', 'title', 'pk'))
+
+        page = CursorPaginator({'page': 1}, objects, per_page=5).page()
+        self.assertEqual(page['objects'], expected[:5])
+        self.assertEqual(page['prev'], None)
+
+        page = CursorPaginator({'page': 2, 'cursor': page['next']}, objects,
+                               per_page=5).page()
+        self.assertEqual(page['objects'], expected[5:10])
+
+        last = CursorPaginator({'page': 3, 'cursor': page['next']}, objects,
+                               per_page=5).page()
+        self.assertEqual(last['objects'], expected[10:])
+        self.assertEqual(last['next'], None)
+
+        page = CursorPaginator({'page': 2, 'cursor': last['prev']}, objects,
+                               per_page=5).page()
+        self.assertEqual(page['objects'], expected[5:10])
+
+        # Cursors are bound to the ordering they were created for.
+        self.assertRaises(BadRequest, CursorPaginator(
+            {'cursor': last['prev']}, Book.objects.order_by('title'),
+            per_page=5).page)
+
+        # Relations are ordered like Django does, by the related ordering.
+        for i, name in enumerate(['Penguin', 'Pelican', 'Puffin']):
+            Book.objects.filter(pk__in=range(i + 1, 13, 3)).update(
+                publisher=Publisher.objects.create(name=name))
+        self.assertEqual(keyset.query_ordering(
+            Book.objects.order_by('-publisher')), ['-publisher__id', 'pk'])
+        Publisher._meta.ordering = ['-name']
+        # Every book has a publisher, the relation can be sought.
+        Book._meta.get_field('publisher').null = False
+        try:
+            objects = Book.objects.order_by('publisher')
+            self.assertEqual(keyset.query_ordering(objects),
+                             ['-publisher__name', 'pk'])
+            expected = list(Book.objects.order_by('-publisher__name', 'pk'))
+            cursor, pages = None, []
+            for i in range(3):
+                page = CursorPaginator({'cursor': cursor}, objects,
+                                       per_page=5).page()
+                pages.extend(page['objects'])
+                cursor = page['next']
+            self.assertEqual(pages, expected)
+        finally:
+            Publisher._meta.ordering = []
+            Book._meta.get_field('publisher').null = True
+
+        # Orderings by nullable columns are paginated with offsets only.
+        Book.objects.filter(pk=1).update(publisher=None)
+        objects = Book.objects.order_by('publisher__name')
+        page = CursorPaginator({'page': 2}, objects, per_page=5).page()
+        self.assertEqual(page['objects'],
+                         list(objects.order_by('publisher__name', 'pk')[5:10]))
+        self.assertEqual((page['next'], page['prev']), (None, None))
+        self.assertRaises(BadRequest, CursorPaginator(
+            {'cursor': last['prev']}, objects, per_page=5).page)
+        self.assertEqual(keyset.ordering_value(Book.objects.get(pk=1),
+                                               'publisher__name'), None)
+
+    def test_count_strategies(self):
+        objects = Book.objects.all()
+        self.assertEqual(counting.CappedCount(limit=5).count(objects),
+                         (5, 'capped'))
+        self.assertEqual(counting.CappedCount(limit=20).count(objects),
+                         (12, 'exact'))
+        # SQLite provides no planner estimate.
+        self.assertEqual(counting.EstimatedCount(threshold=1).count(objects),
+                         (12, 'exact'))
+
+        strategy = counting.CachedCount()
+        self.assertEqual(strategy.count(objects), (12, 'cached'))
+        Book.objects.filter(pk=1).delete()
+        self.assertEqual(strategy.count(objects), (12, 'cached'))
+        self.assertEqual(strategy.count(objects.filter(is_available=True)),
+                         (Book.objects.filter(is_available=True).count(),
+                          'cached'))
+
+        page = Paginator({}, objects, per_page=5,
+                         count_strategy=counting.CappedCount(limit=5)).page()
+        self.assertEqual((page['total'], page['total_kind']), (5, 'capped'))
+        # Pages past a capped total can be reached.
+        page = Paginator({'page': 2}, objects, per_page=5,
+                         count_strategy=counting.CappedCount(limit=5)).page()
+        self.assertEqual((page['page'], len(page['objects']), page['has_next']),
+                         (2, 5, True))
+        page = Paginator({'page': 5}, objects, per_page=5).page()
+        self.assertEqual((page['page'], page['total_kind']), (3, 'exact'))
+
+    def test_custom_paginator(self):
+        # Paginators not based on CRUD's get only tastypie's arguments.
+        class LegacyPaginator(TastypiePaginator):
+            def __init__(self, request_data, objects, resource_uri=None,
+                         per_page=None):
+                super(LegacyPaginator, self).__init__(
+                    request_data, objects, resource_uri=resource_uri,
+                    limit=per_page)
+
+        class LegacyBookResource(BookResource):
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                paginator_class = LegacyPaginator
+
+        resource = LegacyBookResource(api_name='test_api')
+        response = resource.get_list(RequestFactory().get('/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['objects']), 10)
+
+    def test_endless_has_next(self):
+        list_url = reverse('api_dispatch_list', kwargs=self.url_kwargs)
+        response = self.c.get(list_url, {'endless': 1, 'per_page': 10})
+        content = json.loads(response.content)
+        self.assertEqual(content['total'], None)
+        self.assertEqual(len(content['objects']), 10)
+        self.assertTrue(content['has_next'])
+
+        # 12 books fill exactly two pages of 6.
+        page = Paginator({'endless': '1', 'page': 2}, Book.objects.all(),
+                         per_page=6).page()
+        self.assertEqual(len(page['objects']), 6)
+        self.assertFalse(page['has_next'])
+
+    def test_concurrent_count(self):
+        objects = Book.objects.order_by('title')
+        for params in ({'page': 2}, {'page': 5}):
+            sequential = Paginator(params, objects, per_page=5).page()
+            concurrent = Paginator(params, objects, per_page=5,
+                                   concurrent=True).page()
+            self.assertEqual(sequential, concurrent)
+
+    def test_concurrent_pool(self):
+        main = connections['default']
+        main.allow_thread_sharing = True
+
+        def share():
+            # The in-memory test database is private to its connection.
+            connections['default'] = main
+
+        pool = ThreadPool(1, initializer=share)
+        threads = []
+
+        class RecordingCount(counting.ExactCount):
+            def count(self, objects):
+                threads.append(threading.current_thread())
+                return super(RecordingCount, self).count(objects)
+
+        can_query_concurrently = concurrency.can_query_concurrently
+        get_pool = concurrency.get_pool
+        concurrency.can_query_concurrently = lambda using: True
+        concurrency.get_pool = lambda: pool
+        try:
+            objects = Book.objects.order_by('title')
+            sequential = Paginator({'page': 2}, objects, per_page=5).page()
+            concurrent = Paginator({'page': 2}, objects, per_page=5,
+                                   count_strategy=RecordingCount(),
+                                   concurrent=True).page()
+            self.assertEqual(sequential, concurrent)
+            self.assertEqual(len(threads), 1)
+            self.assertNotEqual(threads[0], threading.current_thread())
+        finally:
+            concurrency.can_query_concurrently = can_query_concurrently
+            concurrency.get_pool = get_pool
+            pool.close()
+            pool.join()
+            main.allow_thread_sharing = False
+
+    def test_related_inference(self):
+        class PublishedBookResource(BookResource):
+            publisher = fields.CharField(attribute='publisher__name', null=True)
+
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                prefetch_related = ['publisher__book_set']
+
+        self.assertEqual(PublishedBookResource._meta.select_related,
+                         ['publisher'])
+        self.assertEqual(PublishedBookResource._meta.prefetch_related,
+                         ['publisher__book_set'])
+        self.assertEqual(BookResource._meta.select_related, [])
+
+        # Lists are dehydrated in the detail mode, like in tastypie.
+        for use_in, select_related in (('detail', ['publisher']),
+                                       ('list', [])):
+            class UsedInBookResource(BookResource):
+                publisher = fields.CharField(attribute='publisher__name',
+                                             null=True, use_in=use_in)
+
+                class Meta(BookResource.Meta):
+                    resource_name = 'book'
+
+            self.assertEqual(UsedInBookResource._meta.select_related,
+                             select_related)
+
+        PublishedBookResource._meta.prefetch_related = []
+        publisher = Publisher.objects.create(name='Penguin')
+        Book.objects.update(publisher=publisher)
+        resource = PublishedBookResource(api_name='test_api')
+        request = RequestFactory().get('/', {'endless': 1})
+        with self.assertNumQueries(1):
+            response = resource.get_list(request)
+        content = json.loads(response.content)
+        self.assertEqual(content['objects'][0]['publisher'], 'Penguin')
+
+    def test_projection(self):
+        class PlainBookResource(resources.ModelResource):
+            title = fields.CharField(attribute='title', url='resource_uri')
+            author_name = fields.CharField(attribute='author_name')
+
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                fields = ['title', 'author_name']
+
+        request = RequestFactory().get('/', {'order_by': 'title'})
+
+        for resource_class in (BookResource, PlainBookResource):
+            resource = resource_class(api_name='test_api')
+            regular = json.loads(resource.get_list(request).content)
+            resource._meta.projection = True
+            try:
+                projected = json.loads(resource.get_list(request).content)
+            finally:
+                resource._meta.projection = False
+            self.assertEqual(regular, projected)
+
+        resource = PlainBookResource(api_name='test_api')
+        self.assertTrue(Projection(resource.get_dehydration_plan()).use_values)
+        resource = BookResource(api_name='test_api')
+        self.assertFalse(Projection(resource.get_dehydration_plan()).use_values)
+
+    def test_dehydration_plan(self):
+        resource = BookResource(api_name='test_api')
+        request = RequestFactory().get('/')
+        plan = resource.get_dehydration_plan()
+        self.assertIn('dehydrate_is_available', plan.plan.hooks)
+        self.assertEqual(plan.plan.url_fields, {'title': 'resource_uri'})
+        self.assertEqual(resource.get_model_fields_to_api_fields_map()['author_name'],
+                         'author_name')
+        for book in Book.objects.all():
+            bundle = resource.build_bundle(obj=book, request=request)
+            self.assertEqual(plan.dehydrate(book, request).data,
+                             resource.full_dehydrate(bundle).data)
+
+        # Fields overriding dehydrate() are dehydrated by it.
+        class UpperField(fields.CharField):
+            def dehydrate(self, bundle):
+                return super(UpperField, self).dehydrate(bundle).upper()
+
+        class UpperBookResource(resources.ModelResource):
+            title = UpperField(attribute='title')
+
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                fields = ['title']
+
+        resource = UpperBookResource(api_name='test_api')
+        book = Book.objects.all()[0]
+        data = resource.get_dehydration_plan().dehydrate(book, request).data
+        self.assertEqual(data['title'], book.title.upper())
+        self.assertFalse(Projection(resource.get_dehydration_plan()).use_values)
+
+    def test_streamed_list(self):
+        resource = BookResource(api_name='test_api')
+        for params in ({'order_by': 'title'}, {'page': 2},
+                       {'endless': 1, 'per_page': 10}):
+            request = RequestFactory().get('/', params)
+            regular = json.loads(resource.get_list(request).content)
+            resource._meta.stream_list = True
+            resource._meta.stream_chunk_size = 3
+            try:
+                streamed = json.loads(''.join(resource.get_list(request)))
+            finally:
+                resource._meta.stream_list = False
+                resource._meta.stream_chunk_size = 100
+            self.assertEqual(regular, streamed)
+
+        # Only the compact encoding, not compact=0, disables streaming.
+        resource._meta.stream_list = True
+        try:
+            for compact, streamed in (('0', True), ('false', True),
+                                      ('1', False), ('dict', False)):
+                request = RequestFactory().get('/', {'compact': compact})
+                self.assertEqual(resource.should_stream_list(request),
+                                 streamed)
+        finally:
+            resource._meta.stream_list = False
+
+    def test_list_cache(self):
+        class CachedBookResource(BookResource):
+            publisher = fields.CharField(attribute='publisher__name', null=True)
+
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                cache_list = True
+
+        self.assertEqual(CachedBookResource._meta.list_models,
+                         [Book, Publisher])
+        resource = CachedBookResource(api_name='test_api')
+        request = RequestFactory().get('/', {'order_by': 'title',
+                                          'filters': ['b', 'a'], '_': 1})
+        response = resource.get_list(request)
+        with self.assertNumQueries(0):
+            cached = resource.get_list(
+                RequestFactory().get('/', {'filters': ['a', 'b'], '_': 2,
+                                            'order_by': 'title'}))
+        self.assertEqual(response.content, cached.content)
+
+        book = Book.objects.order_by('title')[0]
+        book.title = 'A'
+        book.save()
+        content = json.loads(resource.get_list(request).content)
+        self.assertEqual(content['objects'][0]['title'], 'A')
+
+        publisher = Publisher.objects.create(name='Penguin')
+        Book.objects.filter(pk=book.pk).update(publisher=publisher)
+        publisher.save()
+        content = json.loads(resource.get_list(request).content)
+        self.assertEqual(content['objects'][0]['publisher'], 'Penguin')
+
+    def test_conditional_get(self):
+        list_url = reverse('api_dispatch_list', kwargs=self.url_kwargs)
+        schema_url = reverse('api_get_schema', kwargs=self.url_kwargs)
+        for url in (schema_url, list_url):
+            response = self.c.get(url)
+            etag = response['ETag']
+            response = self.c.get(url, HTTP_IF_NONE_MATCH='"x", %s' % etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+        response = self.c.get(list_url, {'page': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        class TrackedBookResource(BookResource):
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                track_changes = True
+
+        resource = TrackedBookResource(api_name='test_api')
+        etag = resource.get_list(RequestFactory().get('/'))['ETag']
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag)
+        with self.assertNumQueries(0):
+            self.assertEqual(resource.get_list(request).status_code, 304)
+        Book.objects.all()[0].save()
+        self.assertEqual(resource.get_list(request).status_code, 200)
+
+    def test_schema_cache(self):
+        class FilteredBookResource(BookResource):
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                filters = (
+                    qfilters.Group('Publisher', qfilters.QueryFilter(
+                        Publisher.objects.values_list('pk', 'name'),
+                        'publisher')),
+                )
+
+        def publishers(resource):
+            schema = resource.get_cached_schema()
+            return [f['name'] for f in schema['filterGroups'][0]['filters']]
+
+        resource = FilteredBookResource(api_name='test_api')
+        self.assertEqual(resource._meta.schema_models, [Publisher])
+        publisher = Publisher.objects.create(name='Penguin')
+        self.assertEqual(publishers(resource), ['Penguin'])
+        version = resource.get_schema_version()
+        with self.assertNumQueries(0):
+            self.assertEqual(publishers(resource), ['Penguin'])
+
+        publisher.name = 'Pelican'
+        publisher.save()
+        self.assertEqual(publishers(resource), ['Pelican'])
+
+        Publisher.objects.update(name='Puffin')
+        self.assertEqual(publishers(resource), ['Pelican'])
+        FilteredBookResource.invalidate_schema()
+        self.assertEqual(publishers(resource), ['Puffin'])
+        self.assertNotEqual(resource.get_schema_version(), version)
+
+        # Schemas built by overridden methods aren't cached.
+        class UserBookResource(FilteredBookResource):
+            def build_schema(self):
+                schema = super(UserBookResource, self).build_schema()
+                schema['data'] = {'calls': len(calls)}
+                calls.append(True)
+                return schema
+
+        calls = []
+        resource = UserBookResource(api_name='test_api')
+        self.assertFalse(resource.should_cache_schema())
+        request = RequestFactory().get('/')
+        for i in range(2):
+            response = resource.get_schema(request)
+            self.assertEqual(json.loads(response.content)['data'], {'calls': i})
+            self.assertFalse(response.has_header('ETag'))
+        resource._meta.cache_schema = True
+        self.assertTrue(resource.should_cache_schema())
+
+    def test_export_action(self):
+        class ExportedBookResource(BookResource):
+            export_csv = actions.export_action('csv', chunk_size=5)
+            export_ndjson = actions.export_action('ndjson', chunk_size=5)
+
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+
+        resource = ExportedBookResource(api_name='test_api')
+        titles = sorted(Book.objects.values_list('title', flat=True))
+
+        def export(action, query):
+            data = json.dumps({'action': action, 'query': query, 'data': {}})
+            request = RequestFactory().post('/', {'data': data})
+            response = resource.dispatch_actions(request)
+            self.assertTrue(response['Content-Disposition'].endswith(
+                'book.%s' % action.split('_')[1]))
+            return ''.join(response)
+
+        content = export('export_csv', {'all': True, 'filter': {},
+                                        'id__in': [], 'sort': ['title']})
+        rows = list(csv.reader(content.splitlines()))
+        self.assertEqual(rows[0], ['Id', 'Title', 'Is_available', 'Author'])
+        self.assertEqual([row[1].decode('utf-8') for row in rows[1:]], titles)
+
+        # Unsorted exports are read in chunks seeking by the primary key.
+        content = export('export_ndjson', {'all': True, 'filter': {},
+                                           'id__in': []})
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows],
+                         sorted(Book.objects.values_list('pk', flat=True)))
+        self.assertEqual(sorted(rows[0]),
+                         ['author_name', 'id', 'is_available', 'title'])
+
+        # Sorted ones too, unless an ordering column is nullable.
+        self.assertTrue(keyset.can_seek(Book, ['-is_available', 'title',
+                                               'pk']))
+        self.assertFalse(keyset.can_seek(Book, ['publisher__name', 'pk']))
+        self.assertFalse(keyset.can_seek(Book, ['publisher', 'pk']))
+        for objects in (Book.objects.order_by('-is_available', 'title'),
+                        Book.objects.order_by('publisher__name', '-pk')):
+            chunks = list(streaming.iter_chunks(objects, 5))
+            self.assertEqual([len(chunk) for chunk in chunks], [5, 5, 2])
+            self.assertEqual(sum(chunks, []),
+                             list(objects.order_by(*keyset.query_ordering(
+                                 objects))))
+
+    def test_chunked_action(self):
+        batches = []
+
+        class BatchedBookResource(BookResource):
+            @actions.action_handler(chunked=5)
+            def withdraw(self, request, objects):
+                batches.append(sorted(objects.values_list('pk', flat=True)))
+                if 12 in batches[-1]:
+                    raise ValueError('Book 12 is locked')
+                objects.update(is_available=False)
+
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+
+        self.assertEqual(BatchedBookResource.actions.public[-1],
+                         {'codename': 'withdraw', 'name': 'Withdraw',
+                          'chunked': True})
+        resource = BatchedBookResource(api_name='test_api')
+
+        def run(query):
+            data = json.dumps({'action': 'withdraw', 'query': query})
+            request = RequestFactory().post('/', {'data': data})
+            return resource.dispatch_actions(request)
+
+        # Batches are selected by primary key ranges.
+        self.assertEqual(
+            [str(batch.query).count(' IN ') for batch in
+             actions.iter_pk_ranges(Book.objects.all(), 5)], [0, 0, 0])
+
+        available = list(Book.objects.filter(is_available=True, pk__lt=12)
+                         .values_list('pk', flat=True))
+        response = run({'all': False, 'filter': {}, 'id__in': available,
+                        'statuskey': 'withdraw-1'})
+        self.assertEqual(json.loads(response.content),
+                         {'statuskey': 'withdraw-1'})
+        self.assertEqual(batches, [[1, 2, 5, 6, 7], [8, 9, 10, 11]])
+        self.assertEqual(list(Book.objects.filter(is_available=True)
+                              .values_list('pk', flat=True)), [12])
+
+        status_url = reverse('api_get_action_status', kwargs=dict(
+            self.url_kwargs, status_key='withdraw-1'))
+        status = json.loads(self.c.get(status_url).content)
+        self.assertEqual((status['total'], status['done'], status['progress'],
+                          status['failed']), (9, 9, 100, False))
+
+        # A failing batch is rolled back, the ones before it stay committed.
+        Book.objects.update(is_available=True)
+        del batches[:]
+        with self.assertRaises(ValueError):
+            run({'all': True, 'filter': {}, 'id__in': [],
+                 'statuskey': 'withdraw-2'})
+        self.assertEqual(sorted(Book.objects.filter(is_available=True)
+                                .values_list('pk', flat=True)), [11, 12])
+        status = json.loads(self.c.get(reverse('api_get_action_status', kwargs=dict(
+            self.url_kwargs, status_key='withdraw-2'))).content)
+        self.assertEqual((status['done'], status['failed'], status['message']),
+                         (10, True, 'Book 12 is locked'))
+
+    @override_settings(CRUD_TASK_WORKERS=0)
+    def test_offline_action(self):
+        class OfflineBookResource(BookResource):
+            @actions.action_handler(offline=True)
+            def count_available(self, request, objects):
+                return objects.filter(is_available=True).count()
+
+            @actions.action_handler(offline=True, chunked=5)
+            def withdraw(self, request, objects):
+                if objects.filter(pk=12).exists():
+                    raise ValueError('Book 12 is locked')
+                objects.update(is_available=False)
+
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+
+        resource = OfflineBookResource(api_name='test_api')
+
+        def run(action):
+            data = json.dumps({'action': action, 'query': {
+                'all': True, 'filter': {}, 'id__in': []}})
+            response = resource.dispatch_actions(
+                RequestFactory().post('/', {'data': data}))
+            return get_status(json.loads(response.content)['statuskey'])
+
+        status = run('count_available')
+        self.assertEqual((status['progress'], status['failed'],
+                          status['result']), (100, False, 10))
+
+        status = run('withdraw')
+        self.assertEqual((status['done'], status['failed'], status['message']),
+                         (10, True, 'Book 12 is locked'))
+        self.assertIn('ValueError', status['error'])
+        self.assertEqual(list(Book.objects.filter(is_available=True)
+                              .values_list('pk', flat=True)), [11, 12])
+
+        # Statuses written by worker processes are read from a shared cache.
+        location = tempfile.mkdtemp()
+        caches = dict(settings.CACHES, status={
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': location,
+        })
+        try:
+            with self.settings(CACHES=caches, CRUD_STATUS_CACHE='status',
+                               CRUD_TASK_WORKERS=1):
+                key = tasks.submit(count_words, 'Nineteen Eighty-Four')
+                tasks.shutdown()
+                status = get_status(key)
+
+                # Tasks which can't be sent to a worker fail at once.
+                self.assertRaises(Exception, tasks.submit,
+                                  lambda progress: None, key='unpicklable')
+                unpicklable = get_status('unpicklable')
+        finally:
+            shutil.rmtree(location)
+        self.assertEqual((status['progress'], status['message'],
+                          status['result']), (100, 'Counting', 2))
+        self.assertEqual((unpicklable['progress'], unpicklable['failed']),
+                         (100, True))
+
+        # So do tasks which can't be unpickled by the worker.
+        key = Progress(description='Missing').key
+        tasks._run_in_worker(key, 'cmissing_module\nmissing_task\n.')
+        status = get_status(key)
+        self.assertEqual((status['progress'], status['failed']), (100, True))
+        self.assertIn('ImportError', status['error'])
+
+    def test_action_statuses(self):
+        first = Progress(description='First', total=4)
+        second = Progress(description='Second')
+        first.update(1)
+        second.finish(result='Done')
+        keys = [first.key, second.key, 'expired-key']
+        url = reverse('api_get_action_statuses', kwargs=self.url_kwargs)
+
+        response = self.c.get(url, {'keys': ','.join(keys)})
+        statuses = json.loads(response.content)['objects']
+        self.assertEqual([status['id'] for status in statuses], keys)
+        self.assertEqual([status['progress'] for status in statuses],
+                         [25, 100, 100])
+        self.assertTrue(statuses[2]['expired'])
+
+        etag = response['ETag']
+        response = self.c.get(url, {'keys': ','.join(keys)},
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        first.update(2)
+        response = self.c.get(url, {'keys': ','.join(keys)},
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # The stream ends once all statuses are completed.
+        first.finish()
+        stream_url = reverse('api_stream_action_statuses',
+                             kwargs=self.url_kwargs)
+        response = self.c.get(stream_url, {'keys': keys})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = ''.join(response).split('\n\n')
+        self.assertEqual(events[0], 'retry: 1000')
+        self.assertEqual([json.loads(event[len('data: '):])['id']
+                          for event in events[1:4]], keys)
+        self.assertEqual(events[4], 'event: end\ndata: {}')
+
+    def test_queryset_adapter(self):
+        read = []
+        counted = []
+
+        def rows():
+            for i in xrange(10 ** 6):
+                read.append(i)
+                yield {'id': i}
+
+        def count():
+            counted.append(True)
+            return 10 ** 6
+
+        objects = QuerySetAdapter(rows(), count)
+        paginator = Paginator({'page': 3}, objects, per_page=25)
+        page = paginator.page()
+        self.assertEqual([obj['id'] for obj in page['objects']], range(50, 75))
+        self.assertTrue(page['has_next'])
+        self.assertEqual(len(read), 76)
+        self.assertEqual((page['total'], len(objects), objects.count()),
+                         (10 ** 6, 10 ** 6, 10 ** 6))
+        self.assertEqual(len(counted), 1)
+
+        # Slices are passed to iterables supporting them.
+        class Report(object):
+            def __init__(self):
+                self.slices = []
+
+            def __getitem__(self, k):
+                self.slices.append((k.start, k.stop))
+                return [{'id': i} for i in range(k.start, k.stop)]
+
+        report = Report()
+        objects = QuerySetAdapter(report, 100)
+        self.assertEqual(len(objects[90:200]), 10)
+        self.assertEqual(objects[5]['id'], 5)
+        self.assertEqual(report.slices, [(90, 200), (5, 6)])
+        page = Paginator({'page': 2}, objects, per_page=10).page()
+        self.assertEqual(page['objects'][0]['id'], 10)
+        self.assertEqual(report.slices[-1], (10, 21))
+
+    def test_dataset(self):
+        dataset = Dataset({'id': i, 'title': 'Book %d' % i, 'year': year,
+                           'author': author}
+                          for i, (year, author) in enumerate(
+                              [(2001, 'Ann'), (1999, None), (2001, 'Bob'),
+                               (2010, 'ann'), (None, 'Bob')]))
+        objects = dataset.all()
+
+        def ids(objects):
+            return [obj['id'] for obj in objects]
+
+        self.assertEqual(ids(objects.filter(year=2001)), [0, 2])
+        self.assertEqual(ids(objects.filter(year__gt=1999).order_by('-year',
+                                                                    'id')),
+                         [3, 0, 2])
+        self.assertEqual(ids(objects.filter(year__range=(1999, 2001))),
+                         [0, 1, 2])
+        self.assertEqual(ids(objects.filter(author__icontains='AN')), [0, 3])
+        self.assertEqual(ids(objects.filter(Q(author__in=['Bob']) |
+                                            Q(year__lte=1999))), [1, 2, 4])
+        self.assertEqual(ids(objects.exclude(author='Bob', year=2001)),
+                         [0, 1, 3, 4])
+        self.assertEqual(ids(objects.filter(year__isnull=True)), [4])
+        # Values from the query string are converted like by the ORM.
+        self.assertEqual(ids(objects.filter(year='2001')), [0, 2])
+        self.assertEqual(ids(objects.filter(year__in=['1999', '2010'])),
+                         [1, 3])
+        self.assertEqual(ids(objects.filter(year__lt='2000')), [1])
+        self.assertRaises(FieldError, objects.filter, yaer=2001)
+        self.assertEqual(ids(objects.order_by('year', '-pk')), [4, 1, 2, 0, 3])
+        self.assertEqual(ids(objects.order_by('-year')), [3, 2, 0, 1, 4])
+
+        filtered = objects.exclude(pk=3).order_by('-title')
+        self.assertEqual(filtered.count(), 4)
+        page = Paginator({'page': 2}, filtered, per_page=3).page()
+        self.assertEqual((ids(page['objects']), page['total']), ([0], 4))
+        self.assertEqual(filtered[1]['id'], 2)
+
+        # Indexes are built once per field.
+        index = dataset.sorted_index('year')
+        objects.filter(year__lt=2000)
+        self.assertTrue(dataset.sorted_index('year') is index)
+
+    @unittest.skipIf(columnar.numpy is None, 'NumPy is not installed.')
+    def test_columnar_dataset(self):
+        records = [{'id': i, 'title': title, 'year': year, 'price': price,
+                    'available': i % 2 == 0}
+                   for i, (title, year, price) in enumerate(
+                       [(u'B\xf3k', 2001, 9.5), ('alpha', 1999, None),
+                        ('Beta', 2001, 12.0), (None, 2010, 9.5),
+                        ('alphabet', None, 3.0)])]
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'books')
+        columnar.ColumnarDataset.write(path, records)
+        objects = columnar.ColumnarDataset(path).all()
+        # Results are the same as of the records kept in memory.
+        expected = Dataset(records).all()
+
+        def ids(objects):
+            return [obj['id'] for obj in objects]
+
+        for filtered in [
+                lambda o: o.filter(year=2001),
+                lambda o: o.filter(year__gt=1999).order_by('-year', 'id'),
+                lambda o: o.filter(price__range=(3, 9.5)),
+                lambda o: o.filter(title__icontains='B'),
+                lambda o: o.filter(title__contains='alp', available=True),
+                lambda o: o.filter(title__gte='alpha', title__lt='alphabet'),
+                lambda o: o.filter(Q(title__in=['Beta', 'x']) |
+                                   Q(year__lte=1999)),
+                lambda o: o.exclude(price=9.5, year=2001),
+                lambda o: o.filter(title__isnull=True),
+                lambda o: o.exclude(price=None).order_by('-price', '-pk'),
+                lambda o: o.order_by('title'),
+                lambda o: o.order_by('-available', '-title')]:
+            self.assertEqual(ids(filtered(objects)), ids(filtered(expected)))
+
+        filtered = objects.exclude(pk=3).order_by('-title')
+        page = Paginator({'page': 2}, filtered, per_page=3).page()
+        self.assertEqual((ids(page['objects']), page['total']), ([2], 4))
+        self.assertEqual(filtered[2], records[0])
+        self.assertEqual(type(filtered[2]['price']), float)
+
+        # Writing again switches to a new version of the files, the open
+        # dataset keeps reading the old one.
+        changed = [dict(record, title=i, price=1.0)
+                   for i, record in enumerate(records)]
+        rewritten = columnar.ColumnarDataset.write(path, changed)
+        self.assertEqual(list(rewritten.all().order_by('id')), changed)
+        self.assertEqual(list(filtered.order_by('id'))[0], records[0])
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_selection(self):
+        self.assertEqual(pk_ranges([10, 1, 2, 3, 4, 7, 9, 3]),
+                         ([(1, 4)], [7, 9, 10]))
+        self.assertEqual(str(pk_query(['1', '2', '3', '7'], Book)),
+                         str(Q(pk__gte=1, pk__lte=3) | Q(pk__in=[7])))
+
+        # Other primary keys aren't turned into ranges nor numbers.
+        class Options(object):
+            pk = CharField(max_length=3, primary_key=True)
+
+        class Coded(object):
+            _meta = Options()
+
+        self.assertEqual(pk_query(['10', '11', '12', '007'], Coded).children,
+                         [('pk__in', ['10', '11', '12', '007'])])
+        selected = []
+
+        class SelectingBookResource(BookResource):
+            @actions.action_handler()
+            def select(self, request, objects):
+                selected.append((str(objects.query),
+                                 sorted(objects.values_list('pk', flat=True))))
+                return HttpDone()
+
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+
+        resource = SelectingBookResource(api_name='test_api')
+        factory = RequestFactory()
+
+        def register(selection):
+            response = resource.register_selection(factory.post(
+                '/', json.dumps(selection), 'application/json'))
+            self.assertEqual(response.status_code, 201)
+            return json.loads(response.content)['selection']
+
+        def run(query):
+            data = json.dumps({'action': 'select', 'query': query})
+            return resource.dispatch_actions(factory.post('/', {'data': data}))
+
+        token = register({'id__in': range(1, 10) + [11]})
+        run({'selection': token})
+        sql, pks = selected.pop()
+        self.assertEqual(pks, range(1, 10) + [11])
+        self.assertNotIn('IN (1, 2', sql)
+
+        token = register({'all': True, 'filter': {}, 'exclude': [2, 3, 4]})
+        run({'selection': token})
+        self.assertEqual(selected.pop()[1], [1] + range(5, 13))
+
+        with self.assertRaises(ImmediateHttpResponse) as raised:
+            run({'selection': 'unknown'})
+        self.assertEqual(raised.exception.response.status_code, 410)
+
+    def test_compact_list(self):
+        list_url = reverse('api_dispatch_list', kwargs=self.url_kwargs)
+        regular = json.loads(self.c.get(list_url).content)
+        for compact in ('1', 'dict'):
+            content = json.loads(
+                self.c.get(list_url, {'compact': compact}).content)
+            self.assertNotIn('objects', content)
+            fields_order = content['fieldsOrder']
+            dictionaries = content.get('dictionaries', {})
+            if compact == 'dict':
+                self.assertEqual(sorted(dictionaries), ['is_available'])
+            objects = []
+            for row in content['rows']:
+                obj = {}
+                for name, value in zip(fields_order, row):
+                    if name in dictionaries:
+                        value = dictionaries[name][value]
+                    obj[name] = value
+                objects.append(obj)
+            self.assertEqual(objects, regular['objects'])
+
+    def test_filter_index(self):
+        publisher = Publisher.objects.create(name='Penguin')
+        Book.objects.filter(title__icontains='the').update(publisher=publisher)
+        group = qfilters.Group(
+            'Books',
+            qfilters.QueryFilter(Publisher.objects.values_list('pk', 'name'),
+                                 'publisher'),
+            qfilters.FullTextSearch('title', 'title__icontains'),
+            qfilters.AliasFilter({'available': {
+                'yes': Q(is_available=True),
+                'no': lambda request: Q(is_available=False),
+            }}),
+        )
+        self.assertTrue(group.dynamic)
+        request = RequestFactory().get('/')
+        keys = ['publisher:%d' % publisher.pk, 'title:the', 'available:yes']
+        with self.assertNumQueries(1):
+            for i in range(2):
+                objects = group.apply_filters(request, Book.objects.all(), keys)
+        self.assertEqual(
+            set(objects),
+            set(Book.objects.filter(title__icontains='the', is_available=True)))
+        self.assertIsNone(group.filter_by_key('unknown', request))
+        self.assertEqual(group.filter_by_key('available:no', request).key,
+                         'available:no')
+
+        static = qfilters.Group('Static', qfilters.ChoicesFilter(
+            [(True, 'Yes'), (False, 'No')], 'is_available'))
+        self.assertFalse(static.dynamic)
+        self.assertIs(static.filter_by_key('is_available:True', None),
+                      static.filter_by_key('is_available:True', request))
+
+        # Choices read from the database are read on use, not when defined.
+        with self.assertNumQueries(0):
+            lazy = qfilters.Group('Lazy', qfilters.ChoicesFilter(
+                Publisher.objects.values_list('pk', 'name'), 'publisher'),
+                qfilters.RadioFilter(
+                    Publisher.objects.values_list('name', 'pk'), 'publisher'))
+        self.assertTrue(lazy.dynamic)
+        Publisher.objects.create(name='Pelican')
+        self.assertIn('Pelican', [f.name for f in lazy.filter_fields(request)])
+
+    def test_filter_cache(self):
+        publisher = Publisher.objects.create(name='Penguin')
+        choices = Publisher.objects.values_list('pk', 'name')
+
+        def names(f):
+            return [ff.name for ff in f.filter_fields(None)]
+
+        f = qfilters.QueryFilter(choices, 'publisher',
+                                 cache=qfilters.CachePolicy(invalidate=True))
+        self.assertEqual(names(f), ['Penguin'])
+        with self.assertNumQueries(0):
+            self.assertEqual(names(f), ['Penguin'])
+        publisher.name = 'Pelican'
+        publisher.save()
+        self.assertEqual(names(f), ['Pelican'])
+
+        policy = qfilters.CachePolicy(timeout=60, shared=True)
+        self.assertEqual(names(qfilters.QueryFilter(choices, 'publisher',
+                                                    cache=policy)), ['Pelican'])
+        Publisher.objects.update(name='Puffin')
+        other = qfilters.QueryFilter(
+            choices, 'publisher',
+            cache=qfilters.CachePolicy(timeout=60, shared=True))
+        with self.assertNumQueries(0):
+            self.assertEqual(names(other), ['Pelican'])
+
+        calls = []
+
+        def available(request):
+            calls.append(request)
+            return Q(is_available=True)
+
+        f = qfilters.AliasFilter({'available': {'yes': available}},
+                                 cache=qfilters.CachePolicy(timeout=60))
+        for i in range(2):
+            request = RequestFactory().get('/')
+            self.assertEqual(
+                list(f.filter_fields(request))[0].build_filters(None).children,
+                [('is_available', True)])
+        self.assertEqual(len(calls), 1)
+
+        # Every request gets its own copy of the cached Q.
+        request = RequestFactory().get('/')
+        q = list(f.filter_fields(request))[0].build_filters(None)
+        q.add(Q(title='1984'), Q.AND)
+        self.assertEqual(
+            list(f.filter_fields(request))[0].build_filters(None).children,
+            [('is_available', True)])
+
+        # Callables without a name are cached too, shared values aren't.
+        for shared, count in ((False, 1), (True, 2)):
+            del calls[:]
+            f = qfilters.AliasFilter(
+                {'available': {'yes': functools.partial(available)}},
+                cache=qfilters.CachePolicy(timeout=60, shared=shared))
+            for i in range(2):
+                list(f.filter_fields(RequestFactory().get('/')))
+            self.assertEqual(len(calls), count)
+
+    def test_facets(self):
+        publisher = Publisher.objects.create(name='Penguin')
+        Book.objects.filter(pk__in=[3, 5]).update(publisher=publisher)
+
+        class FacetedBookResource(BookResource):
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                filters = (
+                    qfilters.Group('Availability', qfilters.RadioFilter(
+                        [('Available', True), ('Not available', False)],
+                        'is_available', no_filter='All')),
+                    qfilters.Group(
+                        'Author',
+                        qfilters.ChoicesFilter([('George Orwell', 'Orwell'),
+                                                ('King', 'King')],
+                                               'author_name'),
+                        qfilters.AliasFilter({'author': {
+                            'george': Q(author_name__startswith='George')}}),
+                        join='or'),
+                    qfilters.Group('Publisher', qfilters.QueryFilter(
+                        Publisher.objects.values_list('pk', 'name'),
+                        'publisher')),
+                    qfilters.Group('Title', qfilters.MultiSelectFilter(
+                        [('1984', '1984'), ('CATCH-22', 'Catch-22')],
+                        'title')),
+                )
+
+        resource = FacetedBookResource(api_name='test_api')
+        request = RequestFactory().get('/', {
+            'filters': ['is_available:True', 'author_name:George Orwell'],
+            'facets': '1'})
+        bundle = resource.build_bundle(request=request)
+        # One query per group and one reading the publishers.
+        with self.assertNumQueries(5):
+            facets = resource.get_facets(bundle)
+        self.assertEqual([facet['title'] for facet in facets],
+                         ['Availability', 'Author', 'Publisher', 'Title'])
+        self.assertEqual(facets[0]['counts'], {
+            'is_available': 2, 'is_available:True': 2, 'is_available:False': 0})
+        # Choices of "or" groups are counted without the group's filters.
+        self.assertEqual(facets[1]['counts'], {
+            'author_name:George Orwell': 2, 'author_name:King': 0,
+            'author:george': 2})
+        self.assertEqual(facets[2]['counts'], {'publisher:%d' % publisher.pk: 1})
+        self.assertEqual(facets[3]['counts'],
+                         {'title:1984': 1, 'title:CATCH-22': 0})
+
+        content = json.loads(resource.get_list(request).content)
+        self.assertEqual(content['facets'], facets)
+        self.assertEqual(len(content['objects']), 2)
+
+        # Objects repeated by joins of multi-valued relations count once.
+        publishers = Publisher.objects.filter(book__pk__in=[3, 5])
+        self.assertEqual(publishers.count(), 2)
+        self.assertEqual(
+            count_facets(publishers, [('all', Q()),
+                                      ('penguin', Q(name='Penguin')),
+                                      ('books', Q(book__title='1984'))]),
+            {'all': 1, 'penguin': 1, 'books': 1})
+
+    def test_query_optimizer(self):
+        q = (Q(title='1984') | (Q(title='CATCH-22') | Q(title='1984')) |
+             Q(author_name__icontains='orwell') | Q(title__in=['Nostromo']))
+        optimized = optimize(q)
+        self.assertEqual(optimized.connector, Q.OR)
+        self.assertEqual(optimized.children, [
+            ('title__in', ['1984', 'CATCH-22', 'Nostromo']),
+            ('author_name__icontains', 'orwell')])
+        naive = Book.objects.filter(q)
+        fast = Book.objects.filter(optimized)
+        self.assertLess(len(str(fast.query)), len(str(naive.query)))
+        self.assertEqual(set(fast), set(naive))
+        self.assertEqual(len(fast), 4)
+
+        # Expressions compare with columns, they aren't merged into __in.
+        Book.objects.filter(pk=1).update(title='x', author_name='x')
+        Book.objects.filter(pk=2).update(title='y', note='y')
+        q = Q(title=F('author_name')) | Q(title=F('note'))
+        self.assertEqual(len(optimize(q).children), 2)
+        self.assertEqual(
+            sorted(Book.objects.filter(optimize(q)).values_list('title',
+                                                                flat=True)),
+            ['x', 'y'])
+
+        select = qfilters.MultiSelectFilter(
+            [('1984', '1984'), ('CATCH-22', 'Catch-22')], 'title', join='or')
+        queries = [select.build_filters('title:1984:CATCH-22'),
+                   Q(is_available=True), Q(is_available=True)]
+        query = self.resource.apply_queries(Book.objects.all(), queries)
+        self.assertEqual(str(query.query),
+                         str(Book.objects.filter(title__in=['1984', 'CATCH-22'],
+                                                 is_available=True).query))
+
+        # Lookups crossing multi-valued relations keep their own joins.
+        publisher = Publisher.objects.create(name='Penguin')
+        Book.objects.filter(pk__in=[3, 5]).update(publisher=publisher)
+        query = self.resource.apply_queries(
+            Publisher.objects.all(),
+            [Q(book__title='1984'), Q(book__is_available=False)])
+        self.assertEqual(list(query), [publisher])
+        self.assertEqual(str(query.query).count('JOIN'), 2)
+
+    def test_search_backend(self):
+        lookups = ('title__icontains', 'author_name__icontains')
+        search = qfilters.FullTextSearch('q', *lookups,
+                                         backend=SqliteFTSSearch(Book))
+        search.install()
+
+        def found(key):
+            return sorted(Book.objects.filter(search.build_filters(key))
+                          .values_list('pk', flat=True))
+
+        self.assertEqual(found('q:george'), [5, 9])
+        self.assertEqual(found('q:the lord'), [2])
+        self.assertEqual(found('q:Tolk'), [2])
+        # Empty searches match everything, like the Q backend.
+        self.assertEqual(len(found('q:')), 12)
+
+        book = Book.objects.get(pk=1)
+        book.title = 'Snow Crash'
+        book.save()
+        self.assertEqual(found('q:crash'), [1])
+        self.assertEqual(found('q:cryptonomicon'), [])
+
+        class SearchedBookResource(BookResource):
+            class Meta(BookResource.Meta):
+                resource_name = 'book'
+                filters = (qfilters.Group('Search', search),)
+
+        resource = SearchedBookResource(api_name='test_api')
+        request = RequestFactory().get('/', {'filters': 'q:the',
+                                             'order_by': 'search_rank'})
+        content = json.loads(resource.get_list(request).content)
+        # The ordering is reported as requested, to be sent back as is.
+        self.assertEqual(content['ordering'], ['search_rank'])
+        self.assertEqual(sorted(obj['id'] for obj in content['objects']),
+                         [2, 3, 7, 12])
+        request = RequestFactory().get('/', {
+            'filters': 'q:the', 'order_by': content['ordering'][0]})
+        again = json.loads(resource.get_list(request).content)
+        self.assertEqual(again['objects'], content['objects'])
+        request = RequestFactory().get('/', {'filters': 'q:the',
+                                             'order_by': '-search_rank'})
+        content = json.loads(resource.get_list(request).content)
+        self.assertEqual(content['ordering'], ['-search_rank'])
+
     def _post_teardown(self):
         # Call the original method.
         super(TestCase, self)._post_teardown()
@@ -0,0 +1,129 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.test.client import RequestFactory
+
+from tenclouds.crud.qtree import optimize
+from tenclouds.crud.tests.books.models import Book
+from tenclouds.crud.tests.books.resources import BookResource
+
+
+class Command(BaseCommand):
+    """Benchmark CRUD list requests of the books test app.
+
+    Run it against a real database server with a project that has
+    ``tenclouds.crud.tests.books`` installed::
+
+        ./manage.py syncdb
+        ./manage.py crud_benchmark --rows 1000000 count
+
+    SQLite serializes queries, so the ``count`` benchmark (sequential vs
+    concurrent counting) needs a database server with several cores.
+    """
+    args = '<benchmark benchmark ...>'
+    help = 'Benchmark CRUD list requests on a generated books dataset.'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=1000000,
+                    help='Generate books until there are that many.'),
+        make_option('--repeat', type='int', default=10,
+                    help='Number of timed requests per variant.'),
+    )
+
+    benchmarks = {
+        'count': 'benchmark_count',
+        'dehydrate': 'benchmark_dehydrate',
+        'filters': 'benchmark_filters',
+    }
+
+    def handle(self, *names, **options):
+        names = names or sorted(self.benchmarks)
+        for name in names:
+            if name not in self.benchmarks:
+                raise CommandError('Unknown benchmark: %s' % name)
+
+        self.rows = options['rows']
+        self.repeat = options['repeat']
+        self.resource = BookResource()
+        for name in names:
+            getattr(self, self.benchmarks[name])()
+
+    def generate(self, rows):
+        missing = rows - Book.objects.count()
+        batch_size = 10000
+        while missing > 0:
+            size = min(missing, batch_size)
+            Book.objects.bulk_create([
+                Book(title='Book %d' % i, author_name='Author %d' % (i % 997),
+                     is_available=bool(i % 3), note='')
+                for i in xrange(missing - size, missing)])
+            missing -= size
+
+    def time(self, func, *args):
+        timings = []
+        for i in xrange(self.repeat):
+            start = time.time()
+            func(*args)
+            timings.append(time.time() - start)
+        timings.sort()
+        return timings[len(timings) // 2] * 1000
+
+    def time_list(self, params):
+        return self.time(self.resource.get_list,
+                         RequestFactory().get('/', params))
+
+    def report(self, title, timings):
+        self.stdout.write('%s\n' % title)
+        for variant, timing in timings:
+            self.stdout.write('  %-12s %8.2f ms (median)\n' % (variant, timing))
+
+    def benchmark_count(self):
+        """Sequential vs concurrent count and page queries."""
+        self.generate(self.rows)
+        meta = self.resource._meta
+        params = {'page': 1000, 'order_by': 'title'}
+        timings = []
+        try:
+            for concurrent in (False, True):
+                meta.concurrent_count = concurrent
+                timings.append(('concurrent' if concurrent else 'sequential',
+                                self.time_list(params)))
+        finally:
+            meta.concurrent_count = False
+        self.report('get_list, count and page queries', timings)
+
+    def benchmark_dehydrate(self):
+        """full_dehydrate vs the precompiled dehydration plan, in memory."""
+        request = RequestFactory().get('/')
+        objects = [Book(id=i, title='Book %d' % i, author_name='Author',
+                        is_available=bool(i % 3), note='')
+                   for i in xrange(1000)]
+        resource = self.resource
+        plan = resource.get_dehydration_plan()
+
+        def full_dehydrate():
+            for obj in objects:
+                resource.full_dehydrate(
+                    resource.build_bundle(obj=obj, request=request))
+
+        self.report('dehydration of %d objects' % len(objects), [
+            ('full', self.time(full_dehydrate)),
+            ('plan', self.time(plan.dehydrate_page, objects, request)),
+        ])
+
+    def benchmark_filters(self):
+        """ORed equalities of a multiselect filter vs the optimized Q."""
+        self.generate(self.rows)
+        q = None
+        for i in xrange(0, 997, 10):
+            value = Q(author_name='Author %d' % i)
+            q = value if q is None else q | value
+
+        def count(q):
+            Book.objects.filter(q).count()
+
+        self.report('count of books by %d authors' % len(q.children), [
+            ('naive', self.time(count, q)),
+            ('optimized', self.time(count, optimize(q))),
+        ])
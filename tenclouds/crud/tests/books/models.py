@@ -1,8 +1,13 @@
 from django.db import models
 
 
+class Publisher(models.Model):
+    name = models.CharField(max_length=100)
+
+
 class Book(models.Model):
     title = models.CharField(max_length=200)
     is_available = models.BooleanField(default=True)
     author_name = models.CharField(max_length=100)
     note = models.TextField()
+    publisher = models.ForeignKey(Publisher, null=True, blank=True)